@@ -180,6 +180,8 @@ class Packet_metaclass(type):
         newcls = super(Packet_metaclass, cls).__new__(cls, name, bases, dct)
         if hasattr(newcls,"register_variant"):
             newcls.register_variant()
+        if hasattr(newcls,"compile_struct_plan"):
+            newcls.compile_struct_plan()
         for f in newcls.fields_desc:                
             f.register_owner(newcls)
         config.conf.layers.register(newcls)
@@ -315,6 +315,9 @@ resolve   : holds list of fields for which resolution should be done
 noenum    : holds list of enum fields for which conversion to string should NOT be done
 AS_resolver: choose the AS resolver class to use
 extensions_paths: path or list of paths where extensions are to be looked for
+struct_plans: if 1, dissect and build the leading fixed-size fields of the packets with one precompiled struct format
+mptcp_fast_decode: if 1, dissect and build the MPTCP DSS options with their precompiled layouts
+tcp_lazy_options: if 1, TCP options are kept raw at dissection and dissected on first access
 """
     version = "2.2.0"
     session = ""
@@ -365,6 +368,9 @@ extensions_paths: path or list of paths where extensions are to be looked for
     services_tcp = TCP_SERVICES
     services_udp = UDP_SERVICES
     extensions_paths = "."
+    struct_plans = 1
+    mptcp_fast_decode = 1
+    tcp_lazy_options = 0
     manufdb = MANUFDB
     stats_classic_protocols = []
     stats_dot11_protocols = []
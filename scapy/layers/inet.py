@@ -334,10 +334,60 @@ class TCPOption_Mood(TCPOption):
                     StrLenField("mood", "", 
                         length_from = lambda pkt: pkt.length-2), ]
 
+def walk_tcp_options(s):
+    """Iterate over the raw TCP options area s, without dissecting it.
+    Yield a (kind, offset, length) tuple per option. Stops after EOL or at
+    the first malformed option."""
+    i, end = 0, len(s)
+    while i < end:
+        kind = ord(s[i])
+        if kind == 0: # EOL
+            yield (kind, i, 1)
+            return
+        if kind == 1: # NOP
+            yield (kind, i, 1)
+            i += 1
+            continue
+        if i+1 >= end:
+            return
+        l = ord(s[i+1])
+        if l < 2 or i+l > end:
+            return
+        yield (kind, i, l)
+        i += l
+
+class LazyTCPOptions:
+    """Raw TCP options kept by the dissector when conf.tcp_lazy_options is
+    set. They are dissected on first access to TCP.options"""
+    def __init__(self, raw):
+        self.raw = raw
+    def __repr__(self):
+        return "<LazyTCPOptions [%r]>" % self.raw
+
+class TCPOptionsField(PacketListField):
+    def getfield(self, pkt, s):
+        if not conf.tcp_lazy_options:
+            return PacketListField.getfield(self, pkt, s)
+        l = self.length_from(pkt)
+        if l <= 0:
+            return s, []
+        return s[l:], LazyTCPOptions(s[:l])
+    def parse(self, pkt, x):
+        """Return the list of TCPOption dissected from a LazyTCPOptions"""
+        return PacketListField.getfield(self, pkt, x.raw)[1]
+    def i2repr(self, pkt, x):
+        if isinstance(x, LazyTCPOptions):
+            x = pkt.getfieldval(self.name)
+        return PacketListField.i2repr(self, pkt, x)
+    def do_copy(self, x):
+        if isinstance(x, LazyTCPOptions):
+            return x
+        return PacketListField.do_copy(self, x)
+
 # if mptcp support is enabled
 if "mptcp" in conf.load_layers:
     try:
-        from scapy.layers.mptcp import MPOption
+        from scapy.layers.mptcp import MPOption, MPTCP_subtypes
     except:
         import traceback, sys
         traceback.print_exc(file=sys.stdout)
@@ -498,8 +548,42 @@ class TCP(Packet):
                     ShortField("window", 8192),
                     XShortField("chksum", None),
                     ShortField("urgptr", 0),
-                    PacketListField("options", [], TCPOption, 
+                    TCPOptionsField("options", [], TCPOption, 
                         length_from=lambda p:(p.dataofs-5)*4) ]
+    def getfieldval(self, attr):
+        if attr == "options":
+            self.parse_options()
+        return Packet.getfieldval(self, attr)
+    def getfield_and_val(self, attr):
+        if attr == "options":
+            self.parse_options()
+        return Packet.getfield_and_val(self, attr)
+    def parse_options(self):
+        """Dissect the options kept raw by a lazy dissection, if any"""
+        opts = self.fields.get("options")
+        if isinstance(opts, LazyTCPOptions):
+            self.fields["options"] = self.get_field("options").parse(self, opts)
+    def tcp_has_option(self, kind, subtype=None):
+        """True if the segment carries an option of kind kind (and of MPTCP
+        subtype subtype if given). Kind and subtype may be given as names.
+        Options kept raw are scanned without being dissected."""
+        if type(kind) is str:
+            kind = TCPOption.kind.s2i[kind]
+        if type(subtype) is str:
+            subtype = dict((v,k) for k,v in MPTCP_subtypes.iteritems())[subtype]
+        opts = self.fields.get("options")
+        if isinstance(opts, LazyTCPOptions):
+            raw = opts.raw
+            for k,i,l in walk_tcp_options(raw):
+                if k == kind and (subtype is None or
+                        (l > 2 and ord(raw[i+2])>>4 == subtype)):
+                    return True
+            return False
+        for o in self.options:
+            if o.kind == kind and (subtype is None or
+                    (hasattr(o, "mptcp") and o.mptcp.subtype == subtype)):
+                return True
+        return False
     def post_build(self, p, pay):
         if len(p)%4: 
             p += "\0" # indicate End of option list
@@ -8,7 +8,11 @@ from scapy.fields import *
 #    from scapy.layers.inet6 import IPv6
 #    from scapy.layers.inet6 import IP6Field #to support IPv6 addresses
 from scapy.config import conf
+from scapy.utils import lru_memoize, checksum_update
+from scapy.error import Scapy_Exception
+from scapy.pton_ntop import inet_pton
 #from scapy.layers.inet import tcpoption, _tcpoption_hdr
+import hashlib, hmac, socket
 
 
 
@@ -27,6 +31,61 @@ MPTCP_subtypes = {
         0x6: 'MP_FAIL'}
 
 
+@lru_memoize(4096)
+def key2tokenAndDSN(key):
+    """Returns the token and dsn from a key
+    Generate a simple SHA1 hash of the key
+
+    key is a 64bits integer
+    Token is a 32bits integer, dsn is a 64bits integer
+    The results of the last calls are cached.
+    """
+    shastr = hashlib.sha1(struct.pack("!Q", key)).digest()
+    token, d1, d2 = struct.unpack("!I", shastr[0:4])+struct.unpack("!II", shastr[-8:])
+    return (token, (long(d2)<<32)+d1)
+
+def keys2tokensAndDSNs(keys):
+    """Returns the list of (token, dsn) for the list of keys"""
+    return [key2tokenAndDSN(k) for k in keys]
+
+_hmac_key = struct.Struct("!QQ")
+_hmac_msg = struct.Struct("!II")
+
+@lru_memoize(4096)
+def mptcp_hmac(k1, k2, r1, r2):
+    """Returns the HMAC-SHA1 with the concatenation of k1 and k2 as key and
+    the concatenation of r1 and r2 as message.
+
+    k1, k2 are 64bits integers
+    r1, r2 are 32bits integers
+    Return a 160bits integer. The results of the last calls are cached.
+    """
+    h = hmac.new(_hmac_key.pack(k1, k2), _hmac_msg.pack(r1, r2), hashlib.sha1)
+    return long(h.hexdigest(), 16)
+
+def mptcp_hmac_batch(items):
+    """Returns the list of HMACs (see mptcp_hmac) for a list of
+    ((k1, k2), (r1, r2)) items. The HMAC key schedule is computed once for
+    the items sharing the same keys. The results are cached as those of
+    mptcp_hmac"""
+    res = []
+    keyed = {}
+    cache = mptcp_hmac.cache
+    for keys, nonces in items:
+        keys = tuple(keys)
+        args = keys+tuple(nonces)
+        mac = cache.get(args)
+        if mac is None:
+            h = keyed.get(keys)
+            if h is None:
+                h = keyed[keys] = hmac.new(_hmac_key.pack(*keys), digestmod=hashlib.sha1)
+            h = h.copy()
+            h.update(_hmac_msg.pack(*nonces))
+            mac = long(h.hexdigest(), 16)
+        mptcp_hmac.cache_store(args, mac)
+        res.append(mac)
+    return res
+
 
 class Sha1Field(Field):
     def __init__(self, name, default):
@@ -47,6 +106,11 @@ class Sha1Field(Field):
     def i2repr(self, pkt, x):
         return lhex(self.i2h(pkt, x))
 
+
+# unpacked as a tuple of 5 32-bits integers by the struct plans
+tuple_struct_fields.append(Sha1Field)
+
+
 class _MP_HDR(Packet):
     fields_desc = [ByteField("length", 8),
                     BitEnumField("subtype", 0, 4, MPTCP_subtypes), ]
@@ -66,9 +130,13 @@ class MPOption(Packet):
         return "",p
 
     registered_mptcp_options = {}
+    registered_mptcp_subtypes = {} # variants whose length depends on content
     @classmethod
     def register_variant(cls):
-        cls.registered_mptcp_options[(cls.length.default<<4)+cls.subtype.default] = cls
+        if cls.length.default is None:
+            cls.registered_mptcp_subtypes[cls.subtype.default] = cls
+        else:
+            cls.registered_mptcp_options[(cls.length.default<<4)+cls.subtype.default] = cls
     @classmethod
     def dispatch_hook(cls, pkt=None, *args, **kargs):
         if pkt:
@@ -77,6 +145,8 @@ class MPOption(Packet):
             opt += ord(pkt[1])>>4
             if opt in cls.registered_mptcp_options:
                 return cls.registered_mptcp_options[opt]
+            if opt & 0xf in cls.registered_mptcp_subtypes:
+                return cls.registered_mptcp_subtypes[opt & 0xf]
         return cls
 
 
@@ -160,15 +230,6 @@ class _DSS_HDR(Packet):
 #            BitField("A", 0, 1), # data ack present
 
 
-#class MPTCP_DSS(Packet):
-#    name = "Multipath TCP Data Sequence Signal"
-#    subtype = 2
-#
-#    fields_desc = [ _DSS_HDR, ]
-#
-#    def post_build(self, p, pay):
-#        print "####### POST_BUILD"
-
 # XXX might be useful
 def contains_flag(l, flag):
     """With l being the flag field value, flag being the flag's position in the
@@ -187,159 +248,131 @@ def tcp_contains_flag(l, flag):
 flagIn = mptcp_dss_contains_flag
 
 
-class MPTCP_DSS_Ack(MPOption):
-    """Composed of a 32bits ack without checksum"""
+class _DSSLenField(ByteField):
+    """Length of a DSS option. If not set, it is computed from the layout
+    given by the flags (and by the presence of a checksum)"""
+    def i2m(self, pkt, x):
+        if x is None:
+            x = 4 + pkt.layout()[1].size
+        return x
+    def i2h(self, pkt, x):
+        return self.i2m(pkt, x)
+
+class _DSSSeqField(Field):
+    """A data sequence number (data_ack or dsn), which is 8 bytes-long if
+    the flag flag is set, 4 bytes-long otherwise"""
+    def __init__(self, name, default, flag):
+        Field.__init__(self, name, default, "Q")
+        self.flag = flag
+    def _fmt(self, pkt):
+        return "!Q" if flagIn(pkt.flags, self.flag) else "!I"
+    def addfield(self, pkt, s, val):
+        return s+struct.pack(self._fmt(pkt), self.i2m(pkt, val))
+    def getfield(self, pkt, s):
+        fmt = self._fmt(pkt)
+        sz = struct.calcsize(fmt)
+        return s[sz:], self.m2i(pkt, struct.unpack(fmt, s[:sz])[0])
+
+def _dss_layout(flags):
+    """Return the names and struct format of the fields that follow the DSS
+    header, without and with a checksum, for a given flags value"""
+    names, fmt = [], "!"
+    if flagIn(flags, "A"):
+        names.append("data_ack")
+        fmt += "Q" if flagIn(flags, "a") else "I"
+    if not flagIn(flags, "M"):
+        return (names, struct.Struct(fmt), None, None)
+    names.extend(["dsn", "subflow_seqnum", "datalevel_len"])
+    fmt += ("Q" if flagIn(flags, "m") else "I") + "IH"
+    return (names, struct.Struct(fmt), names+["checksum"], struct.Struct(fmt+"H"))
+
+# flags -> (names, struct, names with checksum, struct with checksum)
+_DSS_LAYOUTS = [_dss_layout(flags) for flags in xrange(32)]
+_dss_hdr = struct.Struct("!BH") # length, subtype+reserved+flags
+
+def _dss_has_checksum(pkt):
+    names, st, cnames, cst = _DSS_LAYOUTS[pkt.getfieldval("flags") & 0x1f]
+    if cst is None:
+        return False
+    l = pkt.getfieldval("length")
+    if l is None:
+        return pkt.getfieldval("checksum") is not None
+    return l >= 4 + cst.size
+
+
+class MPTCP_DSS(MPOption):
+    """Data Sequence Signal. The presence and the size of the data ack, the
+    mapping (dsn, subflow_seqnum, datalevel_len) and the checksum are driven
+    by the flags (and by the length for the checksum)."""
     name = "Multipath TCP Data Sequence Signal"
     subtype = 2
-    subsubtype = 8<<4+2
-    fields_desc = [ ByteField("length", 8),
+    fields_desc = [ _DSSLenField("length", None),
                     _DSS_HDR,
                     FlagsField("flags", "A", 5, "AaMmF"),
-                    IntField("data_ack", 0),]
-
-                    
-class MPTCP_DSS_Ack64(MPOption):
-    """Composed of a 64bits ack without checksum"""
-    name = "Multipath TCP Data Sequence Signal"
-    subtype = 2
-    subsubtype = 12<<4+2
-    fields_desc = [ ByteField("length", 12),
-                    _DSS_HDR,
-                    FlagsField("flags", "aA", 5, "AaMmF"),
-                    LongField("data_ack", 0),]
-
-class MPTCP_DSS_Map(MPOption):
-    """Composed of a short mapping"""
-    name = "Multipath TCP Data Sequence Signal"
-    subtype = 2
-    subsubtype = 14<<4+2
-    fields_desc = [ ByteField("length", 16),
-                    _DSS_HDR,
-                    FlagsField("flags", "M", 5, "AaMmF"),
-                    IntField("dsn", 0),
-                    IntField("subflow_seqnum", 0),
-                    ShortField("datalevel_len", 0),
-                    XShortField("checksum", 0),]
-
-class MPTCP_DSS_MapCsum(MPOption):
-    """Composed of a short mapping"""
-    name = "Multipath TCP Data Sequence Signal"
-    subtype = 2
-    subsubtype = 16<<4+2
-    fields_desc = [ ByteField("length", 16),
-                    _DSS_HDR,
-                    FlagsField("flags", "M", 5, "AaMmF"),
-                    IntField("dsn", 0),
-                    IntField("subflow_seqnum", 0),
-                    ShortField("datalevel_len", 0),
-                    XShortField("checksum", 0),]
-
-class MPTCP_DSS_Map64_AckMap(MPOption):
-    """Composed of a mapping with 64bits seq OR of the combination of an Ack
-    and a short mapping""" 
-    name = "Multipath TCP Data Sequence Signal"
-    subtype = 2
-    subsubtype = 18<<4+2
-    fields_desc = [ ByteField("length", 20),
-                    _DSS_HDR,
-                    FlagsField("flags", "AM", 5, "AaMmF"),
-                    ConditionalField(IntField("data_ack", 0),
-                        lambda p: not flagIn(p.flags,"a") and flagIn(p.flags,"A")),
-                    ConditionalField(LongField("dsn", 0),
-                        lambda p: flagIn(p.flags,"m") and flagIn(p.flags,"M")),
-                    ConditionalField(IntField("dsn", 0),
-                        lambda p: not flagIn(p.flags,"m") and flagIn(p.flags,"M")),
-                    IntField("subflow_seqnum", 0),
-                    ShortField("datalevel_len", 0),]
-
-class MPTCP_DSS_Map64_AckMapCsum(MPOption):
-    """Composed of a mapping with 64bits seq OR of the combination of an Ack
-    and a short mapping""" 
-    name = "Multipath TCP Data Sequence Signal"
-    subtype = 2
-    subsubtype = 20<<4+2
-    fields_desc = [ ByteField("length", 20),
-                    _DSS_HDR,
-                    FlagsField("flags", "AM", 5, "AaMmF"),
-                    ConditionalField(IntField("data_ack", 0),
-                        lambda p: not flagIn(p.flags,"a") and flagIn(p.flags,"A")),
-                    ConditionalField(LongField("dsn", 0),
-                        lambda p: flagIn(p.flags,"m") and flagIn(p.flags,"M")),
-                    ConditionalField(IntField("dsn", 0),
-                        lambda p: not flagIn(p.flags,"m") and flagIn(p.flags,"M")),
-                    IntField("subflow_seqnum", 0),
-                    ShortField("datalevel_len", 0),
-                    XShortField("checksum", 0),]
-
-MPTCP_DSS_AckMapCsum = MPTCP_DSS_Map64_AckMapCsum
-MPTCP_DSS_Map64Csum = MPTCP_DSS_Map64_AckMapCsum
-
-class MPTCP_DSS_Ack64Map(MPOption):
-    """Composed of a 64bits ack and a mapping"""
-    name = "Multipath TCP Data Sequence Signal"
-    subtype = 2
-    subsubtype = 22<<4+2
-    fields_desc = [ ByteField("length", 24),
-                    _DSS_HDR,
-                    FlagsField("flags", "aAM", 5, "AaMmF"),
-                    LongField("data_ack", 0),
-                    IntField("dsn", 0),
-                    IntField("subflow_seqnum", 0),
-                    ShortField("datalevel_len", 0),]
-
-class MPTCP_DSS_Ack64Map_AckMap64Csum(MPOption):
-    """Composed of a 64bits ack and a mapping"""
-    name = "Multipath TCP Data Sequence Signal"
-    subtype = 2
-    subsubtype = 24<<4+2
-    fields_desc = [ ByteField("length", 24),
-                    _DSS_HDR,
-                    FlagsField("flags", "aAM", 5, "AaMmF"),
-                    ConditionalField(IntField("data_ack", 0),
-                        lambda p: not flagIn(p.flags,"a") and flagIn(p.flags,"A")),
-                    ConditionalField(LongField("data_ack", 0),
-                        lambda p: flagIn(p.flags,"a") and flagIn(p.flags,"A")),
-                    ConditionalField(LongField("dsn", 0),
-                        lambda p: flagIn(p.flags,"m") and flagIn(p.flags,"M")),
-                    ConditionalField(IntField("dsn", 0),
-                        lambda p: not flagIn(p.flags,"m") and flagIn(p.flags,"M")),
-                    IntField("subflow_seqnum", 0),
-                    ShortField("datalevel_len", 0),
-                    XShortField("checksum", 0),]
-
-MPTCP_DSS_Ack64MapCsum = MPTCP_DSS_Ack64Map_AckMap64Csum
-MPTCP_DSS_AckMap64Csum = MPTCP_DSS_Ack64Map_AckMap64Csum
-
-class MPTCP_DSS_Ack64Map64(MPOption):
-    """The longer DSS variant. It contains a 64bits mapping and a 64bits 
-    ack seq"""
-    name = "Multipath TCP Data Sequence Signal"
-    subtype = 2
-    subsubtype = 26<<4+2
-    fields_desc = [ ByteField("length", 26),
-                    _DSS_HDR,
-                    FlagsField("flags", "mMaA", 5, "AaMmF"),
-                    LongField("data_ack", 0),
-                    LongField("dsn", 0),
-                    IntField("subflow_seqnum", 0),
-                    ShortField("datalevel_len", 0),]
-
-class MPTCP_DSS_Ack64Map64Csum(MPOption):
-    """The longer DSS variant. It contains a 64bits mapping and a 64bits 
-    ack seq"""
-    name = "Multipath TCP Data Sequence Signal"
-    subtype = 2
-    subsubtype = 28<<4+2
-    fields_desc = [ ByteField("length", 28),
-                    _DSS_HDR,
-                    FlagsField("flags", "mMaA", 5, "AaMmF"),#"AaMmF"),
-                    LongField("data_ack", 0),
-                    LongField("dsn", 0),
-                    IntField("subflow_seqnum", 0),
-                    ShortField("datalevel_len", 0),
-                    XShortField("checksum", 0),]
-
-MPTCP_DSS = MPTCP_DSS_Ack64Map64Csum # alias for most generic DSS
+                    ConditionalField(_DSSSeqField("data_ack", 0, "a"),
+                        lambda p: flagIn(p.flags,"A")),
+                    ConditionalField(_DSSSeqField("dsn", 0, "m"),
+                        lambda p: flagIn(p.flags,"M")),
+                    ConditionalField(IntField("subflow_seqnum", 0),
+                        lambda p: flagIn(p.flags,"M")),
+                    ConditionalField(ShortField("datalevel_len", 0),
+                        lambda p: flagIn(p.flags,"M")),
+                    ConditionalField(XShortField("checksum", None),
+                        _dss_has_checksum),]
+
+    def layout(self):
+        """Return the names and the struct of the fields following the
+        DSS header"""
+        names, st, cnames, cst = _DSS_LAYOUTS[self.getfieldval("flags") & 0x1f]
+        if _dss_has_checksum(self):
+            return (cnames, cst)
+        return (names, st)
+
+    def do_dissect(self, s):
+        if not conf.mptcp_fast_decode or len(s) < 3:
+            return Packet.do_dissect(self, s)
+        length, hdr = _dss_hdr.unpack(s[:3])
+        names, st, cnames, cst = _DSS_LAYOUTS[hdr & 0x1f]
+        if cst is not None and length >= 4 + cst.size:
+            names, st = cnames, cst
+        if len(s) < 3 + st.size:
+            return Packet.do_dissect(self, s)
+        fields = self.fields
+        fields["length"] = length
+        fields["subtype"] = long(hdr >> 12)
+        fields["reserved"] = long(hdr >> 5 & 0x7f)
+        fields["flags"] = long(hdr & 0x1f)
+        fields.update(zip(names, st.unpack(s[3:3+st.size])))
+        return s[3+st.size:]
+
+    def self_build(self, field_pos_list=None):
+        if not conf.mptcp_fast_decode or field_pos_list is not None:
+            return Packet.self_build(self, field_pos_list)
+        names, st = self.layout()
+        vals = []
+        for name in ["length", "subtype", "reserved", "flags"] + names:
+            v = self.getfieldval(name)
+            if isinstance(v, RawVal):
+                return Packet.self_build(self, field_pos_list)
+            vals.append(self.get_field(name).i2m(self, v))
+        hdr = (vals[1] & 0xf) << 12 | (vals[2] & 0x7f) << 5 | vals[3] & 0x1f
+        return _dss_hdr.pack(vals[0], hdr) + st.pack(*vals[4:])
+
+# Former per-layout DSS classes, all handled by MPTCP_DSS now
+MPTCP_DSS_Ack = MPTCP_DSS
+MPTCP_DSS_Ack64 = MPTCP_DSS
+MPTCP_DSS_Map = MPTCP_DSS
+MPTCP_DSS_MapCsum = MPTCP_DSS
+MPTCP_DSS_Map64_AckMap = MPTCP_DSS
+MPTCP_DSS_Map64_AckMapCsum = MPTCP_DSS
+MPTCP_DSS_AckMapCsum = MPTCP_DSS
+MPTCP_DSS_Map64Csum = MPTCP_DSS
+MPTCP_DSS_Ack64Map = MPTCP_DSS
+MPTCP_DSS_Ack64Map_AckMap64Csum = MPTCP_DSS
+MPTCP_DSS_Ack64MapCsum = MPTCP_DSS
+MPTCP_DSS_AckMap64Csum = MPTCP_DSS
+MPTCP_DSS_Ack64Map64 = MPTCP_DSS
+MPTCP_DSS_Ack64Map64Csum = MPTCP_DSS
 
 
 class MPTCP_AddAddr(MPOption):
@@ -423,4 +456,234 @@ class MPTCP_Fastclose(MPOption):
                     BitField("reserved", 0, 12),
                     LongField("rcv_key",0)]
 
+
+########################################
+# Raw scanning, without any dissection #
+########################################
+
+def mptcp_scan(s, offset=0):
+    """Scan the raw frame s for MPTCP options, without dissecting it.
+
+    The IP (v4 or v6 without extension headers) header starts at offset in s
+    (e.g. 14 for Ethernet, 16 for Linux cooked captures). Return a list of
+    (subtype, offset, length) tuples, one per kind-30 TCP option, offsets
+    being relative to the beginning of s. Frames that are not TCP, or that
+    are truncated, give an empty list."""
+    try:
+        v = ord(s[offset])>>4
+        if v == 4:
+            if ord(s[offset+9]) != 6 or \
+                    struct.unpack("!H", s[offset+6:offset+8])[0] & 0x1fff:
+                return [] # not TCP, or not the first fragment
+            t = offset + (ord(s[offset]) & 0xf)*4
+        elif v == 6:
+            if ord(s[offset+6]) != 6:
+                return []
+            t = offset+40
+        else:
+            return []
+        i, end = t+20, t+(ord(s[t+12])>>4)*4
+    except IndexError:
+        return []
+    end = min(end, len(s))
+    ret = []
+    while i < end:
+        kind = ord(s[i])
+        if kind == 0: # EOL
+            break
+        if kind == 1: # NOP
+            i += 1
+            continue
+        if i+1 >= end:
+            break
+        l = ord(s[i+1])
+        if l < 2 or i+l > end:
+            break
+        if kind == 30 and l > 2:
+            ret.append((ord(s[i+2])>>4, i, l))
+        i += l
+    return ret
+
+def mptcp_rawfilter(subtypes=None, offset=0):
+    """Return a filter function on raw frames that accepts those carrying
+    an MPTCP option (of one of subtypes, names or values, if given).
+    To be used before any dissection, e.g. PcapReader(f, rawfilter=...)"""
+    if subtypes is not None:
+        s2i = dict((v,k) for k,v in MPTCP_subtypes.iteritems())
+        subtypes = set(s2i.get(st, st) for st in subtypes)
+    def rawfilter(s):
+        for st, o, l in mptcp_scan(s, offset):
+            if subtypes is None or st in subtypes:
+                return True
+        return False
+    return rawfilter
+
+class TCPFramePatcher(object):
+    """Rewrite fields of built TCP frames in place, updating their checksums
+    incrementally (RFC 1624) rather than over the whole segment.
+
+    The layout of frame (IP header at offset, IPv4 or IPv6 without extension
+    headers) is analysed once. patch() can then be applied to any frame with
+    the same layout, e.g. to the successive segments of a replay. Patchable
+    fields are IP src, dst, ttl and id (IPv4 only), TCP sport, dport, seq,
+    ack, flags and window, and data_ack, dsn, subflow_seqnum and
+    datalevel_len of the first DSS option. The DSS checksum, if any, is
+    updated too, unless explicitly set (field checksum). For a 32 bits DSN,
+    the upper 32 bits of the DSN are assumed unchanged."""
+    def __init__(self, frame, offset=0):
+        frame = str(frame)
+        self.fields = {}
+        f = self.fields
+        try:
+            v = ord(frame[offset])>>4
+            if v == 4 and ord(frame[offset+9]) == 6:
+                t = offset+(ord(frame[offset]) & 0xf)*4
+                tcpck = (t+16, t, [])
+                ipck = (offset+10, offset, [])
+                self.iplen = (offset+2, 2, [ipck])
+                f["id"] = (offset+4, 2, [ipck])
+                f["ttl"] = (offset+8, 1, [ipck])
+                f["src"] = (offset+12, 4, [ipck, tcpck])
+                f["dst"] = (offset+16, 4, [ipck, tcpck])
+            elif v == 6 and ord(frame[offset+6]) == 6:
+                t = offset+40
+                tcpck = (t+16, t, [])
+                self.iplen = (offset+4, 2, [])
+                f["ttl"] = (offset+7, 1, [])
+                f["src"] = (offset+8, 16, [tcpck])
+                f["dst"] = (offset+24, 16, [tcpck])
+            else:
+                raise Scapy_Exception("Not a TCP over IP frame")
+            frame[t+19]
+        except IndexError:
+            raise Scapy_Exception("Truncated frame")
+        self.tcp = t
+        self.tcpck = tcpck
+        f["sport"] = (t, 2, [tcpck])
+        f["dport"] = (t+2, 2, [tcpck])
+        f["seq"] = (t+4, 4, [tcpck])
+        f["ack"] = (t+8, 4, [tcpck])
+        f["flags"] = (t+13, 1, [tcpck])
+        f["window"] = (t+14, 2, [tcpck])
+        for st, o, l in mptcp_scan(frame, offset):
+            if st != 2 or l < 4:
+                continue
+            flags = ord(frame[o+3])
+            i = o+4
+            if flags & 1:
+                size = 8 if flags & 2 else 4
+                f["data_ack"] = (i, size, [tcpck])
+                i += size
+            if flags & 4:
+                size = 8 if flags & 8 else 4
+                mfields = [("dsn", size), ("subflow_seqnum", 4),
+                           ("datalevel_len", 2)]
+                end = i+size+6
+                deps = [tcpck]
+                if o+l >= end+2:
+                    dssck = (end, None, [tcpck])
+                    deps = [tcpck, dssck]
+                    f["checksum"] = (end, 2, [tcpck])
+                for name, size in mfields:
+                    # each field is word aligned in the DSS checksum
+                    # pseudo-header
+                    f[name] = (i, size, [(d[0], i if d[1] is None else d[1],
+                                          d[2]) for d in deps])
+                    i += size
+            break
+
+    def patch(self, buf, **fields):
+        """Set the given fields in buf, a bytearray holding a frame with the
+        layout of the frame analysed. Addresses are given as strings, other
+        fields as integers. Return buf"""
+        fields = fields.items()
+        # an explicit DSS checksum overrides its incremental updates
+        fields.sort(key=lambda (name, val): name == "checksum")
+        for name, val in fields:
+            try:
+                off, size, deps = self.fields[name]
+            except KeyError:
+                raise Scapy_Exception("Field %s not patchable in this frame" % name)
+            if size == 4 and isinstance(val, str):
+                new = socket.inet_aton(val)
+            elif size == 16:
+                new = inet_pton(socket.AF_INET6, val)
+            else:
+                new = ("%%0%ix" % (size*2) % (val & ((1<<size*8)-1))).decode("hex")
+            self._write(buf, off, new, deps)
+        return buf
+
+    def _write(self, buf, off, new, deps):
+        end = off+len(new)
+        old = str(buf[off:end])
+        if old == new:
+            return
+        buf[off:end] = new
+        for ckoff, base, ckdeps in deps:
+            o, n = old, new
+            if (off-base) % 2:
+                o, n = chr(buf[off-1])+o, chr(buf[off-1])+n
+            if len(o) % 2:
+                pad = chr(buf[end]) if end < len(buf) else "\0"
+                o, n = o+pad, n+pad
+            ck = checksum_update((buf[ckoff]<<8)+buf[ckoff+1], o, n)
+            self._write(buf, ckoff, chr(ck>>8)+chr(ck & 0xff), ckdeps)
+
+class SegmentTemplate(object):
+    """Prebuilt TCP segment, from which new segments are stamped out by
+    patching the bytes of its fields and payload (see TCPFramePatcher)
+    instead of building a packet. Checksums are updated incrementally.
+
+    If the first DSS option of the template carries a checksum, its mapping
+    is taken as covering the payload: on a payload change, datalevel_len is
+    set to the payload length, and the DSS checksum updated for the new
+    length and payload (it stays valid if it was valid in the template)"""
+    def __init__(self, pkt, offset=0):
+        frame = str(pkt)
+        self.patcher = TCPFramePatcher(frame, offset)
+        self.frame = bytearray(frame)
+        t = self.patcher.tcp
+        self.hdrlen = t+(self.frame[t+12]>>4)*4
+
+    def stamp(self, payload=None, **fields):
+        """Return a frame with the given payload (or the one of the last frame
+        stamped) and fields values"""
+        if payload is not None:
+            self.set_payload(payload)
+        return str(self.patcher.patch(self.frame, **fields))
+
+    def set_payload(self, payload):
+        buf = self.frame
+        old = str(buf[self.hdrlen:])
+        if old == payload:
+            return
+        patcher = self.patcher
+        l = max(len(old), len(payload))
+        l += l % 2
+        o, n = old.ljust(l, "\0"), payload.ljust(l, "\0")
+        if "checksum" in patcher.fields:
+            # the payload follows the 16 bytes DSS pseudo-header
+            off, size, deps = patcher.fields["datalevel_len"]
+            patcher._write(buf, off, struct.pack("!H", len(payload)), deps)
+            off, size, deps = patcher.fields["checksum"]
+            ck = checksum_update((buf[off]<<8)+buf[off+1], o, n)
+            patcher._write(buf, off, struct.pack("!H", ck), deps)
+        ckoff = patcher.tcpck[0]
+        ck = checksum_update((buf[ckoff]<<8)+buf[ckoff+1], o, n)
+        if len(old) != len(payload):
+            # pseudo-header TCP length
+            tcplen = len(buf)-patcher.tcp
+            ck = checksum_update(ck, struct.pack("!I", tcplen),
+                        struct.pack("!I", tcplen+len(payload)-len(old)))
+            off, size, deps = patcher.iplen
+            iplen = (buf[off]<<8)+buf[off+1]+len(payload)-len(old)
+            patcher._write(buf, off, struct.pack("!H", iplen), deps)
+        buf[ckoff:ckoff+2] = struct.pack("!H", ck)
+        buf[self.hdrlen:] = payload
+
+def patch_frame(frame, offset=0, **fields):
+    """Return a copy of the built TCP frame with the given fields changed,
+    and its checksums updated incrementally. See TCPFramePatcher"""
+    return str(TCPFramePatcher(frame, offset).patch(bytearray(frame), **fields))
+
 # vim: set ts=4 sts=4 sw=4 et:
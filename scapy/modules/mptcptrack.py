@@ -0,0 +1,467 @@
+## This file is part of Scapy
+## See http://www.secdev.org/projects/scapy for more informations
+## This program is published under a GPLv2 license
+
+"""
+MPTCP capture analysis: connection and subflow tracking, data-level stream
+reassembly.
+"""
+
+import bisect
+from scapy.layers.inet import IP,TCP
+from scapy.layers.mptcp import *
+from collections import OrderedDict
+
+
+class MPTCPSubflow(object):
+    """A TCP subflow of an MPTCP connection, identified by its 4-tuple as seen
+    in its SYN (src, sport, dst, dport)"""
+    def __init__(self, tupleid, conn=None, time=0):
+        self.id = tupleid
+        self.conn = conn
+        self.first_seen = self.last_seen = time
+        self.pkts = 0
+        # True if the subflow was opened by the server of the connection
+        self.reverse = False
+        # per direction (0: from the subflow initiator) reassembly state
+        self.dirs = [None, None]
+
+    def __repr__(self):
+        return "<MPTCPSubflow %s:%i > %s:%i>" % (self.id[0], self.id[1],
+                self.id[2], self.id[3])
+
+
+class MPTCPConnection(object):
+    """An MPTCP connection. The client is the initiator of the first
+    subflow, the server is the other end"""
+    def __init__(self, client_key=None):
+        self.client_key = self.client_token = None
+        self.server_key = self.server_token = None
+        self.subflows = []
+        # per direction (0: client to server) data-level streams
+        self.streams = [None, None]
+        if client_key is not None:
+            self.set_key(client_key, client=True)
+
+    def set_key(self, key, client):
+        token = key2tokenAndDSN(key)[0]
+        if client:
+            self.client_key, self.client_token = key, token
+        else:
+            self.server_key, self.server_token = key, token
+        return token
+
+    def tokens(self):
+        return [t for t in (self.client_token, self.server_token) if t is not None]
+
+    def __repr__(self):
+        return "<MPTCPConnection client_token=%s server_token=%s subflows=%i>" % (
+                self.client_token, self.server_token, len(self.subflows))
+
+
+class MPTCPTracker(object):
+    """Streaming tracker attaching each packet of a capture to its MPTCP
+    connection and subflow.
+
+    Connections are indexed by token (both tokens of a connection), subflows
+    by 4-tuple (both directions), so that each packet is attached in O(1).
+    Subflows idle for more than timeout seconds (packet time), or the least
+    recently seen ones when there are more than max_subflows, are evicted,
+    together with connections that have no subflow left."""
+    def __init__(self, timeout=300, max_subflows=None):
+        self.timeout = timeout
+        self.max_subflows = max_subflows
+        self.conns = {}              # token -> MPTCPConnection
+        self.subflows = OrderedDict() # 4-tuple -> MPTCPSubflow, by last activity
+
+    def track(self, pkt):
+        """Attach pkt to its connection and subflow. Return a tuple
+        (connection, subflow), or None if pkt isn't part of an MPTCP
+        subflow. The connection is None for a MP_JOIN on an unknown token."""
+        ip = pkt.getlayer(IP)
+        if ip is None or not isinstance(ip.payload, TCP):
+            return None
+        tcp = ip.payload
+        fwd = (ip.src, tcp.sport, ip.dst, tcp.dport)
+        sub = self.subflows.pop(fwd, None)
+        if sub is None:
+            sub = self.subflows.pop((ip.dst, tcp.dport, ip.src, tcp.sport), None)
+        now = pkt.time
+        self.expire(now)
+        if sub is None:
+            sub = self._new_subflow(fwd, tcp, now)
+            if sub is None:
+                return None
+        elif tcp.flags & 0x02 or sub.conn is None or sub.conn.server_key is None:
+            # handshake in progress, keys may still be exchanged
+            self._handshake(sub, fwd, tcp)
+        self.subflows[sub.id] = sub
+        sub.last_seen = now
+        sub.pkts += 1
+        if self.max_subflows is not None and len(self.subflows) > self.max_subflows:
+            self.evict(self.subflows.iterkeys().next())
+        return (sub.conn, sub)
+
+    def feed(self, pkts):
+        """Generator tracking each packet of pkts (a PacketList, a PcapReader...)
+        and yielding (pkt, connection, subflow) for MPTCP packets"""
+        for pkt in pkts:
+            r = self.track(pkt)
+            if r is not None:
+                yield (pkt,)+r
+
+    def _new_subflow(self, fwd, tcp, now):
+        if not tcp.tcp_has_option(30):
+            return None
+        for o in tcp.options:
+            if o.kind != 30:
+                continue
+            opt = o.mptcp
+            if isinstance(opt, MPTCP_CapableACK):
+                # handshake not captured, the third ACK carries both keys
+                conn = MPTCPConnection(opt.snd_key)
+                conn.set_key(opt.rcv_key, client=False)
+                break
+            if isinstance(opt, MPTCP_CapableSYN) and tcp.flags & 0x12 == 0x02:
+                conn = MPTCPConnection(opt.snd_key)
+                break
+            if isinstance(opt, MPTCP_JoinSYN) and tcp.flags & 0x12 == 0x02:
+                conn = self.conns.get(opt.rcv_token)
+                break
+        else:
+            return None
+        sub = MPTCPSubflow(fwd, conn, now)
+        if conn is not None:
+            if isinstance(opt, MPTCP_JoinSYN):
+                sub.reverse = opt.rcv_token == conn.client_token
+            conn.subflows.append(sub)
+            for t in conn.tokens():
+                self.conns[t] = conn
+        return sub
+
+    def _handshake(self, sub, fwd, tcp):
+        conn = sub.conn
+        if conn is None:
+            return
+        for o in tcp.options:
+            if o.kind != 30:
+                continue
+            opt = o.mptcp
+            if isinstance(opt, MPTCP_CapableACK):
+                for key, client in ((opt.snd_key, fwd == sub.id),
+                                    (opt.rcv_key, fwd != sub.id)):
+                    self.conns[conn.set_key(key, client)] = conn
+            elif isinstance(opt, MPTCP_CapableSYN) and fwd != sub.id:
+                self.conns[conn.set_key(opt.snd_key, client=False)] = conn
+
+    def expire(self, now):
+        """Evict the subflows idle since more than timeout seconds"""
+        if self.timeout is None:
+            return
+        limit = now-self.timeout
+        while self.subflows:
+            tupleid, sub = self.subflows.iteritems().next()
+            if sub.last_seen >= limit:
+                break
+            self.evict(tupleid)
+
+    def evict(self, tupleid):
+        """Forget the subflow tupleid, and its connection if it was its last
+        subflow"""
+        sub = self.subflows.pop(tupleid)
+        conn = sub.conn
+        if conn is None:
+            return
+        conn.subflows.remove(sub)
+        if not conn.subflows:
+            for t in conn.tokens():
+                if self.conns.get(t) is conn:
+                    del(self.conns[t])
+
+    def connections(self):
+        """Return the list of connections currently tracked"""
+        return dict((id(c), c) for c in self.conns.itervalues()).values()
+
+
+def _unwrap(val, ref, bits):
+    """Return the value congruent to val modulo 2**bits closest to ref"""
+    mod = 1<<bits
+    val += ref-(ref % mod)
+    if val-ref > mod/2:
+        val -= mod
+    elif ref-val > mod/2:
+        val += mod
+    return val
+
+
+class _Intervals(object):
+    """Set of disjoint byte ranges, sorted by offset, with their content"""
+    def __init__(self):
+        self.starts = []
+        self.chunks = []
+
+    def __len__(self):
+        return sum(len(c) for c in self.chunks)
+
+    def add(self, start, data):
+        """Insert data at offset start. Bytes already present are kept for
+        overlapping parts, only the holes are filled"""
+        end = start+len(data)
+        starts, chunks = self.starts, self.chunks
+        i = bisect.bisect_right(starts, start)
+        if i and starts[i-1]+len(chunks[i-1]) > start:
+            i -= 1
+        pos = start
+        while pos < end:
+            if i == len(starts) or starts[i] >= end:
+                nxt = end
+            else:
+                nxt = starts[i]
+            if nxt > pos:
+                starts.insert(i, pos)
+                chunks.insert(i, data[pos-start:nxt-start])
+                i += 1
+            if nxt == end:
+                break
+            pos = max(pos, starts[i]+len(chunks[i]))
+            i += 1
+
+    def extract(self, start, end):
+        """Remove and return the list of (offset, data) within [start, end)"""
+        starts, chunks = self.starts, self.chunks
+        i = bisect.bisect_right(starts, start)
+        if i and starts[i-1]+len(chunks[i-1]) > start:
+            i -= 1
+        j = bisect.bisect_left(starts, end)
+        if i >= j:
+            return []
+        res = zip(starts[i:j], chunks[i:j])
+        keep_s, keep_c = [], []
+        s, c = res[0]
+        if s < start:
+            keep_s.append(s)
+            keep_c.append(c[:start-s])
+            res[0] = (start, c[start-s:])
+        s, c = res[-1]
+        if s+len(c) > end:
+            keep_s.append(end)
+            keep_c.append(c[end-s:])
+            res[-1] = (s, c[:end-s])
+        starts[i:j] = keep_s
+        chunks[i:j] = keep_c
+        return res
+
+    def pop(self, pos):
+        """Remove the bytes before pos, then remove and return the contiguous
+        data starting at pos"""
+        starts, chunks = self.starts, self.chunks
+        res = []
+        i = 0
+        while i < len(starts) and starts[i] <= pos:
+            s, c = starts[i], chunks[i]
+            if s+len(c) > pos:
+                res.append(c[pos-s:])
+                pos = s+len(c)
+            i += 1
+        del(starts[:i])
+        del(chunks[:i])
+        return "".join(res)
+
+
+class MPTCPStream(object):
+    """Data-level byte stream of one direction of an MPTCP connection.
+
+    The stream starts at start, or at the DSN of the first mapping seen if
+    unknown. Data is delivered
+    in order as soon as it is contiguous, out-of-order data being kept in an
+    interval set until the holes are filled."""
+    def __init__(self, start=None):
+        self.next = start    # DSN of the next byte to deliver
+        self.fin = None      # DSN of the DATA_FIN, when seen
+        self.pending = _Intervals()
+
+    def add(self, dsn, data):
+        """Add data at dsn. Return the newly contiguous data, if any"""
+        if self.next is None:
+            self.next = dsn
+        if dsn+len(data) <= self.next:
+            return ""
+        if dsn < self.next:
+            data = data[self.next-dsn:]
+            dsn = self.next
+        if dsn == self.next and not self.pending.starts:
+            self.next += len(data)
+            return data
+        self.pending.add(dsn, data)
+        data = self.pending.pop(self.next)
+        self.next += len(data)
+        return data
+
+    def finished(self):
+        return self.fin is not None and self.next is not None \
+            and self.next >= self.fin
+
+
+def _data_start(key, dsn, bits=64):
+    """Return the DSN of the first data byte sent by the owner of key, if
+    dsn (on bits bits) can belong to its stream, or None. Both the IDSN+1 of
+    the RFC and the DSN of key2tokenAndDSN() are tried"""
+    idsn = key2tokenAndDSN(key)[1]
+    rfc = ((idsn & 0xffffffffL)<<32 | idsn>>32)+1 & 0xffffffffffffffffL
+    for start in (idsn, rfc):
+        if (dsn-start) % (1<<bits) < 1<<31:
+            return start
+    return None
+
+
+class _SubflowDir(object):
+    """Reassembly state of one direction of a subflow: the DSS mappings seen,
+    sorted by relative subflow sequence number, and the data received but
+    not mapped yet"""
+    def __init__(self, isn):
+        self.isn = isn
+        self.high = 0         # highest relative subflow seq seen
+        self.map_starts = []  # relative subflow seq of the mappings
+        self.maps = []        # (end, dsn) of the mappings
+        self.unmapped = _Intervals()
+
+    def relseq(self, seq):
+        subseq = _unwrap((seq-self.isn) % (1<<32), self.high, 32)
+        self.high = max(self.high, subseq)
+        return subseq
+
+    def add_map(self, subseq, dsn, length):
+        """Record a mapping. Return the list of (dsn, data) previously received
+        and now mapped"""
+        i = bisect.bisect_left(self.map_starts, subseq)
+        if i < len(self.map_starts) and self.map_starts[i] == subseq:
+            self.maps[i] = (subseq+length, dsn)
+        else:
+            self.map_starts.insert(i, subseq)
+            self.maps.insert(i, (subseq+length, dsn))
+        return [(dsn+s-subseq, d) for s, d in
+                self.unmapped.extract(subseq, subseq+length)]
+
+    def map_data(self, subseq, data):
+        """Return the list of (dsn, data) for the mapped parts of data, received
+        at subseq. The parts not mapped yet are kept until their mapping
+        arrives"""
+        res = []
+        end = subseq+len(data)
+        i = bisect.bisect_right(self.map_starts, subseq)-1
+        pos = subseq
+        while pos < end:
+            if i >= 0 and self.maps[i][0] > pos:
+                mend, dsn = self.maps[i]
+                nxt = min(mend, end)
+                res.append((dsn+pos-self.map_starts[i],
+                            data[pos-subseq:nxt-subseq]))
+            else:
+                if i+1 < len(self.map_starts):
+                    nxt = min(self.map_starts[i+1], end)
+                else:
+                    nxt = end
+                if nxt > pos:
+                    self.unmapped.add(pos, data[pos-subseq:nxt-subseq])
+            pos = nxt
+            i += 1
+        return res
+
+    def prune(self, dsn):
+        """Forget the mappings entirely below dsn (already delivered)"""
+        i = 0
+        while i < len(self.maps):
+            mend, mdsn = self.maps[i]
+            if mdsn+mend-self.map_starts[i] > dsn:
+                break
+            i += 1
+        if i:
+            self.unmapped.pop(self.map_starts[i-1])
+            del(self.map_starts[:i])
+            del(self.maps[:i])
+
+
+class MPTCPReassembler(object):
+    """Rebuild the data-level byte streams of the MPTCP connections of a
+    capture from the DSS mappings seen on all their subflows.
+
+    Overlapping data (reinjections, retransmissions) is kept once, and
+    mappings may arrive after the data they cover. Only the data not yet
+    delivered in order is kept in memory, so that large captures can be
+    streamed through feed(). When the keys are known, each stream starts at
+    the first DSN derived from the key of its sender, otherwise at the first
+    mapping seen. Subflows whose SYN or third ACK was not
+    captured are ignored, their initial sequence number being unknown."""
+    def __init__(self, tracker=None):
+        if tracker is None:
+            tracker = MPTCPTracker()
+        self.tracker = tracker
+
+    def add(self, pkt):
+        """Process pkt. Return the list of (connection, direction, data) of
+        the data-level bytes delivered in order thanks to pkt, direction
+        being 0 from the client to the server, 1 the other way"""
+        r = self.tracker.track(pkt)
+        if r is None or r[0] is None:
+            return []
+        conn, sub = r
+        tcp = pkt[TCP]
+        ip = tcp.underlayer
+        fwd = (ip.src, tcp.sport, ip.dst, tcp.dport)
+        sdir = int(fwd != sub.id)
+        cdir = sdir ^ sub.reverse
+        if tcp.flags & 0x02:
+            sub.dirs[sdir] = _SubflowDir(tcp.seq)
+        elif sub.dirs[sdir] is None:
+            if not (tcp.flags & 0x10 and tcp.tcp_has_option(30) and
+                    any(o.kind == 30 and isinstance(o.mptcp, (MPTCP_CapableACK,
+                        MPTCP_JoinACK)) for o in tcp.options)):
+                return []
+            # third ACK of a handshake not captured
+            sub.dirs[sdir] = _SubflowDir(tcp.seq-1)
+            sub.dirs[1-sdir] = _SubflowDir(tcp.ack-1)
+        d = sub.dirs[sdir]
+        stream = conn.streams[cdir]
+        if stream is None:
+            stream = conn.streams[cdir] = MPTCPStream()
+        mapped = []
+        if tcp.tcp_has_option(30, "DSS"):
+            for o in tcp.options:
+                if o.kind != 30 or not isinstance(o.mptcp, MPTCP_DSS) \
+                        or not o.mptcp.flags & 4:
+                    continue
+                opt = o.mptcp
+                length = opt.datalevel_len
+                dsn = opt.dsn
+                bits = 64 if opt.flags & 8 else 32
+                if stream.next is None:
+                    key = (conn.client_key, conn.server_key)[cdir]
+                    if key is not None:
+                        stream.next = _data_start(key, dsn, bits)
+                if bits == 32 and stream.next is not None:
+                    dsn = _unwrap(dsn, stream.next, 32)
+                if opt.flags & 16:
+                    stream.fin = dsn+length-1
+                    length -= 1
+                if length > 0 and opt.subflow_seqnum:
+                    subseq = _unwrap(opt.subflow_seqnum, d.high, 32)
+                    mapped.extend(d.add_map(subseq, dsn, length))
+        data = str(tcp.payload)
+        if data:
+            mapped.extend(d.map_data(d.relseq(tcp.seq), data))
+        res = []
+        for dsn, data in mapped:
+            data = stream.add(dsn, data)
+            if data:
+                res.append((conn, cdir, data))
+        if res:
+            d.prune(stream.next)
+        return res
+
+    def feed(self, pkts):
+        """Generator processing each packet of pkts (a PacketList, a
+        PcapReader...) and yielding (connection, direction, data) for the
+        data-level bytes as soon as they are delivered in order"""
+        for pkt in pkts:
+            for r in self.add(pkt):
+                yield r
@@ -8,8 +8,8 @@ Packet class. Binding mechanism. fuzz() method.
 """
 
 import time,itertools,os
-import copy
-from fields import StrField,ConditionalField,Emph,PacketListField
+import copy,struct
+from fields import StrField,ConditionalField,Emph,PacketListField,Field,BitField
 from config import conf
 from base_classes import BasePacket,Gen,SetGen,Packet_metaclass,NewDefaultValues
 from volatile import VolatileValue
@@ -31,6 +31,156 @@ class RawVal:
         return "<RawVal [%r]>" % self.val
 
 
+##############################
+## Precompiled struct plans ##
+##############################
+
+# Field classes whose getfield/addfield (un)pack all the values of their
+# struct format, as a tuple given to m2i and returned by i2m (ex: Sha1Field)
+tuple_struct_fields = []
+
+def _is_struct_field(f):
+    """True if f is (un)packed with its own big-endian struct format only"""
+    if not isinstance(f, Field) or isinstance(f, BitField) or \
+            f.fmt[0] not in "!>":
+        return False
+    if isinstance(f, tuple(tuple_struct_fields)):
+        return True
+    return f.__class__.getfield.im_func is Field.getfield.im_func and \
+            f.__class__.addfield.im_func is Field.addfield.im_func
+
+def _is_bit_field(f):
+    return isinstance(f, BitField) and not f.rev and \
+            f.__class__.getfield.im_func is BitField.getfield.im_func and \
+            f.__class__.addfield.im_func is BitField.addfield.im_func
+
+def _is_plain_field(f):
+    """True if f is added to the string with its own struct format only"""
+    if isinstance(f, Emph):
+        f = f.fld
+    return isinstance(f, Field) and \
+            f.__class__.addfield.im_func is Field.addfield.im_func
+
+def _has_own(f, meth):
+    """True if f overrides the identity conversion meth of Field"""
+    return getattr(f.__class__, meth).im_func is not getattr(Field, meth).im_func
+
+class StructPlan(object):
+    """Struct-based dissection/build plan of a Packet class.
+
+    The longest run of leading fixed-size fields (struct fields and groups of
+    BitFields ending on a byte boundary) is compiled into one struct format,
+    so that they are filled in a single unpack, and built in a single pack.
+    Remaining fields (conditional or variable-length) are handled the
+    generic way, their built pieces being joined once."""
+    def __init__(self, fields_desc):
+        self.fields_desc = fields_desc
+        fmt = "!"
+        self.items = [] # (name, field, index, count, shift, mask, m2i)
+        nb = done = 0
+        pending, bits = [], 0 # BitFields waiting for a byte boundary
+        for f in fields_desc:
+            if isinstance(f, Emph):
+                f = f.fld
+            if _is_bit_field(f):
+                pending.append(f)
+                bits += f.size
+                if bits % 8:
+                    continue
+                if bits not in (8, 16, 32):
+                    break
+                fmt += {8:"B", 16:"H", 32:"I"}[bits]
+                for bf in pending:
+                    bits -= bf.size
+                    self.items.append((bf.name, bf, nb, 1, bits,
+                            (1L<<bf.size)-1, _has_own(bf, "m2i")))
+                nb += 1
+                done += len(pending)
+                pending = []
+            elif _is_struct_field(f) and not pending:
+                n = len(struct.unpack(f.fmt, "\0"*f.sz))
+                if n > 1 and not isinstance(f, tuple(tuple_struct_fields)):
+                    break
+                fmt += f.fmt.lstrip("!>")
+                self.items.append((f.name, f, nb, n, None, None,
+                        _has_own(f, "m2i")))
+                nb += n
+                done += 1
+            else:
+                break
+        self.tail = fields_desc[done:]
+        # (field, True if it is built with its own struct format only)
+        self.build_tail = [(f, _is_plain_field(f)) for f in self.tail]
+        self.struct = struct.Struct(fmt)
+        self.size = self.struct.size
+
+    def decode(self, pkt, s):
+        """Dissect s into pkt.fields. Return the remaining string"""
+        vals = self.struct.unpack(s[:self.size])
+        fields = pkt.fields
+        for name, f, i, n, shift, mask, m2i in self.items:
+            if n > 1:
+                v = vals[i:i+n]
+            elif mask is not None:
+                v = long(vals[i] >> shift & mask)
+            else:
+                v = vals[i]
+            if m2i:
+                v = f.m2i(pkt, v)
+            fields[name] = v
+        s = s[self.size:]
+        for f in self.tail:
+            if not s:
+                break
+            s, fields[f.name] = f.getfield(pkt, s)
+        return s
+
+    def encode(self, pkt):
+        """Build the fields of pkt. Return None if the generic path must be
+        taken (i.e. a RawVal is set on a compiled field)"""
+        vals = []
+        group = 0
+        for name, f, i, n, shift, mask, _ in self.items:
+            v = pkt.getfieldval(name)
+            if isinstance(v, RawVal):
+                return None
+            v = f.i2m(pkt, v)
+            if mask is not None:
+                group = group << f.size | v & mask
+                if shift == 0:
+                    vals.append(group)
+                    group = 0
+            elif n > 1:
+                vals.extend(v)
+            else:
+                vals.append(v)
+        # the pieces are joined once, or when a field must be added to the
+        # string built so far
+        pieces = [self.struct.pack(*vals)]
+        p = None # string or BitField state the next field is added to
+        for f, plain in self.build_tail:
+            v = pkt.getfieldval(f.name)
+            if p is None:
+                if isinstance(v, RawVal):
+                    pieces.append(str(v))
+                    continue
+                if plain:
+                    pieces.append(struct.pack(f.fmt, f.i2m(pkt, v)))
+                    continue
+                p = "".join(pieces)
+            if isinstance(v, RawVal):
+                p += str(v)
+            else:
+                p = f.addfield(pkt, p, v)
+            if type(p) is str:
+                pieces = [p]
+                p = None
+        if p is None:
+            return "".join(pieces)
+        return p
+
+
+
 class Packet(BasePacket):
     __metaclass__ = Packet_metaclass
     name=None
@@ -287,6 +437,12 @@ class Packet(BasePacket):
     def __len__(self):
         return len(self.__str__())
     def self_build(self, field_pos_list=None):
+        plan = self.struct_plan
+        if conf.struct_plans and field_pos_list is None and \
+                plan.fields_desc is self.fields_desc:
+            p = plan.encode(self)
+            if p is not None:
+                return p
         p=""
         for f in self.fields_desc:
             val = self.getfieldval(f.name)
@@ -541,7 +697,16 @@ Creates an EPS file describing a packet. If filename is not provided a temporary
         """DEV: is called right before the current layer is dissected"""
         return s
 
+    @classmethod
+    def compile_struct_plan(cls):
+        """DEV: called by the metaclass once the class is created"""
+        cls.struct_plan = StructPlan(cls.fields_desc)
+
     def do_dissect(self, s):
+        plan = self.struct_plan
+        if conf.struct_plans and plan.items and len(s) >= plan.size and \
+                plan.fields_desc is self.fields_desc:
+            return plan.decode(self, s)
         flist = self.fields_desc[:]
         flist.reverse()
         while s and flist:
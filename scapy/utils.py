@@ -237,6 +237,18 @@ else:
         s = ~s
         return (((s>>8)&0xff)|s<<8) & 0xffff
 
+def checksum_update(cksum, old, new):
+    """Return the Internet checksum cksum (as read in network byte order)
+    updated for the replacement of the bytes old by new in the checksummed
+    data (RFC 1624). old and new have the same even length and start at an
+    even offset of the checksummed data"""
+    fmt = "!%iH" % (len(old)/2)
+    s = (~cksum & 0xffff)+len(old)/2*0xffff-sum(struct.unpack(fmt, old))
+    s += sum(struct.unpack(fmt, new))
+    while s >> 16:
+        s = (s & 0xffff)+(s >> 16)
+    return ~s & 0xffff
+
 def warning(x):
     log_runtime.warning(x)
 
@@ -371,6 +383,35 @@ def incremental_label(label="tag%05i", start=0):
         yield label % start
         start += 1
 
+def lru_memoize(maxsize=1024):
+    """Decorator memoizing a function of hashable positional arguments. Only
+    the maxsize most recently used results are kept. The cache can be emptied
+    with the cache_clear() method of the decorated function, and filled with
+    results computed otherwise with its cache_store(args, result) method"""
+    from collections import OrderedDict
+    def decorator(f):
+        cache = OrderedDict()
+        def store(args, res):
+            if cache.pop(args, None) is None and len(cache) >= maxsize:
+                cache.popitem(last=False)
+            cache[args] = res
+        def wrapper(*args):
+            try:
+                res = cache.pop(args)
+            except KeyError:
+                res = f(*args)
+                if len(cache) >= maxsize:
+                    cache.popitem(last=False)
+            cache[args] = res
+            return res
+        wrapper.cache = cache
+        wrapper.cache_clear = cache.clear
+        wrapper.cache_store = store
+        wrapper.__name__ = f.__name__
+        wrapper.__doc__ = f.__doc__
+        return wrapper
+    return decorator
+
 #########################
 #### Enum management ####
 #########################
@@ -470,10 +511,11 @@ endianness: "<" or ">", force endianness"""
     PcapWriter(filename, *args, **kargs).write(pkt)
 
 @conf.commands.register
-def rdpcap(filename, count=-1):
+def rdpcap(filename, count=-1, rawfilter=None):
     """Read a pcap file and return a packet list
-count: read only <count> packets"""
-    return PcapReader(filename).read_all(count=count)
+count: read only <count> packets
+rawfilter: function applied to raw packets to skip them before dissection"""
+    return PcapReader(filename, rawfilter=rawfilter).read_all(count=count)
 
 
 
@@ -563,8 +605,11 @@ class RawPcapReader:
     
 
 class PcapReader(RawPcapReader):
-    def __init__(self, filename):
+    def __init__(self, filename, rawfilter=None):
+        """rawfilter: function applied to each raw packet (string) before its
+        dissection. Packets for which it returns False are skipped."""
         RawPcapReader.__init__(self, filename)
+        self.rawfilter = rawfilter
         try:
             self.LLcls = conf.l2types[self.linktype]
         except KeyError:
@@ -572,6 +617,8 @@ class PcapReader(RawPcapReader):
             self.LLcls = conf.raw_layer
     def read_packet(self, size=MTU):
         rp = RawPcapReader.read_packet(self,size)
+        while rp is not None and self.rawfilter and not self.rawfilter(rp[0]):
+            rp = RawPcapReader.read_packet(self,size)
         if rp is None:
             return None
         s,(sec,usec,wirelen) = rp
@@ -652,6 +699,14 @@ class RawPcapWriter:
             for p in pkt:
                 self._write_packet(p)
 
+    def write_frame(self, frame, sec=None, usec=None):
+        """writes the single raw frame (a string) captured at sec, usec
+        (now by default) to the dumpfile
+        """
+        if not self.header_present:
+            self._write_header(frame)
+        self._write_packet(frame, sec, usec)
+
     def _write_packet(self, packet, sec=None, usec=None, caplen=None, wirelen=None):
         """writes a single packet to the pcap file
         """
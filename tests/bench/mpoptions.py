@@ -0,0 +1,53 @@
+#!/usr/bin/env python2
+# Benchmark of the MPTCP options dissection and build, with and without the
+# precompiled struct plans (conf.struct_plans and conf.mptcp_fast_decode).
+# Usage: PYTHONPATH=. tests/bench/mpoptions.py [nb_rounds]
+import sys, time
+from scapy.all import *
+
+SAMPLES = [
+    MPTCP_CapableSYN(snd_key=0x1234567890abcdef),
+    MPTCP_CapableACK(snd_key=0x1234567890abcdef, rcv_key=0xfedcba0987654321),
+    MPTCP_JoinSYN(rcv_token=0xdeadbeef, snd_nonce=42),
+    MPTCP_JoinSYNACK(snd_mac64=0x0102030405060708, snd_nonce=43),
+    MPTCP_JoinACK(snd_mac=(1<<159)+1),
+    MPTCP_DSS_Ack(data_ack=1000),
+    MPTCP_DSS_Ack64Map64Csum(flags="mMaA", data_ack=1, dsn=2,
+        subflow_seqnum=3, datalevel_len=4, checksum=5),
+    MPTCP_AddAddrPort(address_id=1, adv_addr="10.0.0.1", port=8080),
+    MPTCP_Prio_AddrID(backup_flow=1, addr_id=2),
+    MPTCP_Fastclose(rcv_key=0xfedcba0987654321),
+    ]
+
+def bench(fast, raws, rounds):
+    conf.struct_plans = conf.mptcp_fast_decode = fast
+    start = time.time()
+    for i in xrange(rounds):
+        for r in raws:
+            MPOption(r)
+    dissect = len(raws)*rounds/(time.time()-start)
+    pkts = [MPOption(r) for r in raws]
+    start = time.time()
+    for i in xrange(rounds):
+        for p in pkts:
+            p.self_build()
+    build = len(raws)*rounds/(time.time()-start)
+    return dissect, build
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    raws = [str(o) for o in SAMPLES]
+    old = (conf.struct_plans, conf.mptcp_fast_decode)
+    try:
+        slow = bench(0, raws, rounds)
+        fast = bench(1, raws, rounds)
+    finally:
+        (conf.struct_plans, conf.mptcp_fast_decode) = old
+    print("%-10s %15s %15s" % ("", "dissect opt/s", "build opt/s"))
+    print("%-10s %15i %15i" % ("generic", slow[0], slow[1]))
+    print("%-10s %15i %15i" % ("plan", fast[0], fast[1]))
+    print("speedup    %14.2fx %14.2fx" % (fast[0]/slow[0], fast[1]/slow[1]))
+
+if __name__ == "__main__":
+    main()
+# vim: set ts=4 sts=4 sw=4 et:
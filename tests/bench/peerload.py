@@ -0,0 +1,48 @@
+#!/usr/bin/env python2
+# Load test of the client side of the library (MultiProtoTester) against the
+# reference peer, both in this process, on an in-memory network.
+# Usage: PYTHONPATH=. tests/bench/peerload.py [nb_connections]
+import sys, time
+from threading import Thread
+from tests.mptcptestlib import *
+from tests.vlink import VirtualNetwork
+from tests.mptcppeer import MPTCPPeer
+
+B = "10.2.1.2"
+
+def client_addr(i):
+    return "10.1.%i.%i" % (i//200, i%200+1)
+
+def scenario(t, src):
+    s = MPTCPState()
+    m = MPTCPTest(tester=t, initstate=s)
+    sub = s.registerNewSubflow(dst=B, src=src)
+    yield t.sendpkt(m.CapSYN, sub=sub)
+    yield t.sendpkt(m.Wait, sub=sub)
+    yield t.sendpkt(m.CapACK, sub=sub)
+    yield t.sendpkt(m.DSS, payload="hello", length=5, checksum=0, sub=sub,
+            waitAck=True)
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    net = VirtualNetwork()
+    peer = MPTCPPeer(sock=net.socket(B))
+    th = Thread(target=peer.run)
+    th.daemon = True
+    th.start()
+    addrs = [client_addr(i) for i in range(n)]
+    multi = MultiProtoTester({"socket": net.socket(*addrs)})
+    start = time.time()
+    for src in addrs:
+        t = multi.connection()
+        multi.spawn(t, scenario(t, src))
+    left = multi.run(timeout=60)
+    duration = time.time()-start
+    peer.stop()
+    print("%i connections in %.2fs (%.0f conn/s), %i unfinished, %i bytes "
+            "received by the peer" % (n, duration, n/duration, left,
+                peer.received))
+
+if __name__ == "__main__":
+    main()
+# vim: set ts=4 sts=4 sw=4 et:
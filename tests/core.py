@@ -1,17 +1,41 @@
 #!/usr/bin/env python2
-from scapy.all import sr1, send, sniff, UDP
-from threading import Thread
+from scapy.all import sr1, send, sniff, IP, TCP, UDP, Raw, MTU
+from scapy.config import conf as scapy_conf
+from threading import Thread, Condition, local
 import random
 import socket, select
 import inspect
+import os
+import time
+import heapq
+import atexit
+from collections import deque, OrderedDict
+from tests.metrics import Metrics
+from tests.replay import PacketRecorder, ReplayCapture
+from tests.statecodec import StateEncoder, StateDecoder, isStateMessage
 
 DEFAULT_CONF = {"check":False,  # if True, check received packets using check
                                 # function given as parameter in sendpkt call
                 "debug":0,      # Levels 0-5. Greater means more verbose
                 "printanswer":False,  
                 "iptables_bin": "iptables", # iptables executable path
-                "udp_port": 3456,
-                "udp_port_ack": 3457,
+                # control channel ports, distinct for each scenario run in
+                # parallel (see runall.py)
+                "udp_port": int(os.environ.get("MPTCP_TEST_UDP_PORT", 3456)),
+                "udp_port_ack": int(os.environ.get("MPTCP_TEST_UDP_PORT_ACK",
+                    3457)),
+                "capture": True, # capture the packets with a CaptureThread,
+                                 # started when the link is first used
+                "capture_queue": 10000, # max. number of packets it queues
+                "socket": None, # L3 socket to use instead of the raw sockets,
+                                # ex: a VirtualSocket (see vlink.py)
+                "metrics": False, # collect timing metrics (see metrics.py)
+                "metrics_file": None, # JSON file where the metrics are
+                                      # written at exit (implies metrics)
+                "seed": None, # seed of the random values of the tester
+                "record": None, # pcap file where the packets are recorded
+                "replay": None, # pcap file replayed instead of the network
+                                # (see replay.py)
                 }
 
 class PktWaitTimeOutException(Exception):
@@ -20,6 +44,86 @@ class PktWaitTimeOutException(Exception):
     def __str__(self):
         return repr(self.timeval)
 
+class CaptureThread(Thread):
+    """Background capture of the packets received matching the BPF filter,
+    on a single socket opened for the whole test. Outgoing packets are not
+    captured. The packets are dissected (from layer 3) and pushed to a
+    bounded queue, the oldest ones being dropped when it is full.
+    sock is an already opened L3 socket to capture from instead, that is
+    not closed when stopping (ex: a VirtualSocket)"""
+    def __init__(self, filter="tcp or udp", maxsize=10000, iface=None,
+            sock=None):
+        Thread.__init__(self)
+        self.daemon = True
+        self.queue = deque()
+        self.maxsize = maxsize
+        self.cond = Condition()
+        self.dropped = 0
+        self.running = True
+        self.recorder = None # PacketRecorder of the packets captured
+        self.ownsock = sock is None
+        if sock is None:
+            sock = scapy_conf.L3socket(iface=iface, filter=filter)
+        self.sock = sock
+
+    def run(self):
+        while self.running:
+            if not select.select([self.sock], [], [], 0.2)[0]:
+                continue
+            pkt = self.sock.recv(MTU)
+            if pkt is not None:
+                self.push(pkt)
+        if self.ownsock:
+            self.sock.close()
+
+    def push(self, pkt):
+        if self.recorder is not None:
+            self.recorder.write(str(pkt), False, getattr(pkt, "time", None))
+        with self.cond:
+            if len(self.queue) >= self.maxsize:
+                self.queue.popleft()
+                self.dropped += 1
+            self.queue.append(pkt)
+            self.cond.notify_all()
+
+    def take(self, filterfct=None, keep=None):
+        """Return the first queued packet matching filterfct, or None.
+        The packets before it are discarded, except those matching keep"""
+        kept = []
+        found = None
+        while self.queue:
+            pkt = self.queue.popleft()
+            if filterfct is None or filterfct(pkt):
+                found = pkt
+                break
+            if keep is not None and keep(pkt):
+                kept.append(pkt)
+        self.queue.extendleft(reversed(kept))
+        return found
+
+    def get(self, filterfct=None, timeout=None, keep=None):
+        """Return the next captured packet matching filterfct, discarding the
+        others except those matching keep, or None after timeout seconds"""
+        if timeout is not None:
+            end = time.time()+timeout
+        with self.cond:
+            while True:
+                pkt = self.take(filterfct, keep)
+                if pkt is not None:
+                    return pkt
+                if timeout is None:
+                    self.cond.wait()
+                else:
+                    remaining = end-time.time()
+                    if remaining <= 0:
+                        return None
+                    self.cond.wait(remaining)
+
+    def stop(self):
+        self.running = False
+        self.join()
+
+
 class ProtoTester(object):
     def __init__(self, conf=DEFAULT_CONF):
         self.conf = dict(DEFAULT_CONF.items() + conf.items())
@@ -29,6 +133,62 @@ class ProtoTester(object):
         # proto related
         self.state = None
         self.proto = None
+        # link to the network, if not the raw sockets and iptables
+        self.sock = self.conf["socket"]
+        self.rawsock = None # see sendFrames
+        self.capture = None
+        self.firewalls = {} # (address, port) -> FirewallChannel
+        self.stateEncoders = {} # destination -> StateEncoder (see sendState)
+        self.stateDecoder = StateDecoder()
+        if self.conf["seed"] is not None:
+            seedRandom(self.conf["seed"])
+        self.recorder = None
+        if self.conf["record"]:
+            self.recorder = PacketRecorder(self.conf["record"])
+        # recorded packets replayed instead of the network
+        self.replay = None
+        if self.conf["replay"]:
+            self.replay = self.capture = ReplayCapture(self.conf["replay"])
+        self.metrics = None
+        if self.conf["metrics"] or self.conf["metrics_file"]:
+            self.metrics = Metrics()
+            if self.conf["metrics_file"]:
+                atexit.register(self.reportMetrics)
+
+    def startCapture(self):
+        """Start capturing packets in background, so that none is missed
+        between two waits"""
+        if self.capture is None:
+            self.capture = CaptureThread(maxsize=self.conf["capture_queue"],
+                    sock=self.sock)
+            self.capture.recorder = self.recorder
+            self.capture.start()
+
+    def linkCapture(self):
+        """Return the capture of the packets received, or None if there is
+        none. The capture is started on the first use of the link (before
+        sending, not to miss the answers), so that the testers which don't
+        use it open no capture socket"""
+        if self.capture is None and self.conf["capture"]:
+            self.startCapture()
+        return self.capture
+
+    def stopCapture(self):
+        if self.capture is not None:
+            self.capture.stop()
+            self.capture = None
+
+    def initState(self, initstate=None):
+        """Set up the current state, overriden by initstate, and return it"""
+        if self.state is None:
+            if initstate is None:
+                # If no initial state is given at the first call, use a generic one
+                self.state = ProtoState()
+            else:
+                self.state = initstate
+        else:
+            self.state.update(initstate)
+        return self.state
 
     def sendSequence(self, pktList, initstate=None, **kargs):
         if "buffermode" in kargs:
@@ -50,15 +210,7 @@ class ProtoTester(object):
         testfct -- optional function used to check the validity of a reply
         kargs -- other optional arguments to be passed to the newpkt function
         """
-        if self.state is None:
-            if initstate is None:
-                # If no initial state is given at the first call, use a generic one
-                self.state = ProtoState()
-            else:
-                self.state = initstate
-        else:
-            self.state.update(initstate)
-        s = self.state # simple alias
+        s = self.initState(initstate) # simple alias
         
         if self.first:
             self.first = False
@@ -66,7 +218,7 @@ class ProtoTester(object):
 #            raise Exception("no previous packet, can't resume the protocol")
 
         try:
-            (pkt, wait) = newpkt().generate(s, **kargs)
+            (pkt, wait) = self.generate(newpkt, s, **kargs)
         
             if s.hasKey("stage") and pkt is not None:
                 self.debug("Generating %s packet..." % s["stage"], 1)
@@ -90,6 +242,14 @@ class ProtoTester(object):
         
         return (pkt, ret, reply, self.state)
 
+    def generate(self, newpkt, state, **kargs):
+        """Return the (packet, wait) generated by newpkt from state"""
+        if self.metrics is None:
+            return newpkt().generate(state, **kargs)
+        start = time.time()
+        r = newpkt().generate(state, **kargs)
+        self.metrics.timing("generate", time.time()-start)
+        return r
 
     def run(self, state, pkt, wait):
         """Send pkt, receive the answer if wait is True, and return a tuple 
@@ -111,14 +271,93 @@ class ProtoTester(object):
                 else:
                     raise Exception("error, no packet generated.")
             else:
-                ans=sr1(pkt)
+                ans=self.sr1(pkt)
         else:
-            send(pkt)
+            self.send(pkt)
             self.first = True # prev_pkt shouldnt be taken into account
             self.debug("Packet sent, no waiting, going on with next.",2)
             return (True, None) # no reply, no check
         return self.packetReceived(ans) # post-reply actions
 
+    def send(self, pkt):
+        if self.metrics is not None:
+            self.metrics.sent(pkt)
+        if self.replay is not None:
+            self.replay.sent(pkt)
+            return
+        self.linkCapture()
+        if self.recorder is not None:
+            self.recorder.write(str(pkt), True)
+        if self.sock is None:
+            send(pkt)
+        else:
+            self.sock.send(pkt)
+
+    def sendFrames(self, frames, dst):
+        """Send the already built IP frames to dst, on a socket opened once
+        for the whole test"""
+        if self.replay is not None:
+            for f in frames:
+                self.replay.sent(IP(f))
+            return
+        self.linkCapture()
+        if self.recorder is not None:
+            for f in frames:
+                self.recorder.write(f, True)
+        if hasattr(self.sock, "sendFrames"):
+            self.sock.sendFrames(frames)
+            return
+        if self.sock is not None:
+            for f in frames:
+                self.sock.send(Raw(f))
+            return
+        if self.rawsock is None:
+            self.rawsock = socket.socket(socket.AF_INET, socket.SOCK_RAW,
+                    socket.IPPROTO_RAW)
+            self.rawsock.setsockopt(socket.SOL_IP, socket.IP_HDRINCL, 1)
+        for f in frames:
+            self.rawsock.sendto(f, (dst, 0))
+
+    def sr1(self, pkt):
+        """Send pkt and return its answer. The answer is taken from the
+        capture if any, so that it is not received a second time by a later
+        wait"""
+        if self.linkCapture() is None and self.sock is None:
+            if self.metrics is not None:
+                self.metrics.sent(pkt)
+            if self.recorder is not None:
+                self.recorder.write(str(pkt), True)
+            return sr1(pkt)
+        self.send(pkt)
+        return self.recvLink(lambda r: r.answers(pkt),
+                keep=self.isControl if self.sock is not None else None)
+
+    def recvLink(self, filterfct, timeout=None, keep=None):
+        """Return the next packet received on the socket matching filterfct,
+        or None after timeout seconds. Packets matching keep are left for
+        later if captured, the others are discarded"""
+        if self.linkCapture() is not None:
+            return self.capture.get(filterfct, timeout, keep)
+        pkts = sniff(count=1, opened_socket=self.sock, lfilter=filterfct,
+                timeout=timeout)
+        if not pkts:
+            return None
+        return pkts[0]
+
+    def isControl(self, pkt):
+        """True if pkt is a message of the control channel (sendData)"""
+        return pkt.haslayer(UDP) and pkt[UDP].dport in \
+                (self.conf["udp_port"], self.conf["udp_port_ack"])
+
+    def keepFilter(self):
+        """Return the filter of the captured packets to keep while waiting
+        for another one, or None"""
+        if self.sock is None and self.replay is None:
+            return None
+        # the control messages are not received by UDP sockets, keep them
+        # for sendData and receiveData
+        return lambda pkt: self.isControl(pkt) and not isEOD(pkt)
+
     def waitForPacket(self, state=None, filterfct=None, timeout=5,
             buffermode=False, **kargs):
         """Wait for one packet matching a filter function
@@ -140,6 +379,10 @@ class ProtoTester(object):
             tOut = " (timeout after %i secs)" % timeout
         else: tOut = ""
         self.debug("Sniffing using custom function..."+tOut, level=2)
+        if self.linkCapture() is not None:
+            return self.waitForCapturedPacket(filterfct, timeout, buffermode)
+        if self.sock is not None:
+            kargs["opened_socket"] = self.sock
         if buffermode:
             # in buffermode, the packets are stored in buf and they are transmitted
             # to user only when a UDP signal is encountered
@@ -151,17 +394,56 @@ class ProtoTester(object):
             self.sendAck(buf[-1].getlayer("IP").src)
             return buf[:-1]
         
-        pkts = sniff(count=1, lfilter=filterfct, filter="tcp",
+        if self.sock is not None and filterfct is not None:
+            # no BPF filter on an opened socket
+            kargs["lfilter"] = lambda pkt: pkt.haslayer(TCP) and filterfct(pkt)
+        else:
+            kargs["lfilter"] = filterfct
+        pkts = sniff(count=1, filter="tcp",
                     timeout=timeout, **kargs)
         if pkts is None or len(pkts) == 0:
             raise PktWaitTimeOutException(timeout)
         return pkts[0].getlayer("IP")
 
+    def waitForCapturedPacket(self, filterfct=None, timeout=5,
+            buffermode=False):
+        """Same as waitForPacket, from the packets of the capture thread"""
+        if filterfct is None:
+            filterfct = lambda pkt: True
+        keep = self.keepFilter()
+        if buffermode:
+            if timeout:
+                end = time.time()+timeout
+            buf = []
+            while True:
+                remaining = end-time.time() if timeout else None
+                if remaining is not None and remaining <= 0:
+                    # like sniff, no end of data marker before the timeout
+                    return buf
+                pkt = self.capture.get(lambda pkt: pkt.haslayer(TCP) and
+                        filterfct(pkt) or pkt.haslayer(UDP) and
+                        not (keep and keep(pkt)), remaining, keep)
+                if pkt is None:
+                    return buf
+                if isEOD(pkt):
+                    self.sendAck(pkt.getlayer("IP").src)
+                    return buf
+                buf.append(pkt)
+        pkt = self.capture.get(lambda pkt: pkt.haslayer(TCP) and
+                filterfct(pkt), timeout, keep)
+        if pkt is None:
+            raise PktWaitTimeOutException(timeout)
+        return pkt.getlayer("IP")
+
 
     def packetReceived(self, pkt, buffermode=False):
         """Called when a packet pkt is received, returns the packet and its
         supposed validity expressed as a boolean"""
-        initstate = self.state.copy()
+        metrics = self.metrics
+        if metrics is not None:
+            dataAckOf = getattr(self.proto, "dataAckOf", None)
+            metrics.received(pkt, dataAckOf(pkt) if dataAckOf else None)
+        initstate = self.state.snapshot()
         self.printrcvd(pkt)
         self.state.logPacket(pkt)
         pktTest = None
@@ -175,10 +457,20 @@ class ProtoTester(object):
                 pktTest = p
             else:
                 pktTest = self.proto.getClassFromPkt(p, pkt)()
-            valid = self.checkRcvd(initstate, pkt, pktTest)
+            if metrics is None:
+                valid = self.checkRcvd(initstate, pkt, pktTest)
+            else:
+                start = time.time()
+                valid = self.checkRcvd(initstate, pkt, pktTest)
+                metrics.timing("check", time.time()-start)
             if not valid:
                 return (False, pkt)
-            needReply = pktTest.recv(self.state, pkt)
+            if metrics is None:
+                needReply = pktTest.recv(self.state, pkt)
+            else:
+                start = time.time()
+                needReply = pktTest.recv(self.state, pkt)
+                metrics.timing("recv", time.time()-start)
             if needReply and buffermode: # useful for acks
                 self.sendpkt(needReply)
         return (True, pkt)
@@ -194,6 +486,16 @@ class ProtoTester(object):
             return False
         return True
 
+    def reportMetrics(self, path=None):
+        """Print the summary of the metrics, and write them to the JSON file
+        path (by default, the metrics_file of the configuration)"""
+        if self.metrics is None:
+            return
+        print(self.metrics.summary())
+        path = path or self.conf["metrics_file"]
+        if path:
+            self.metrics.dump(path)
+
     # Optional Debug / Print
     def printrcvd(self, pkt):
         if self.conf["printanswer"] or self.conf["debug"] >= 4:
@@ -222,7 +524,10 @@ class ProtoTester(object):
         """Toggle the kernel handling of the packets received. If enabled,
         the kernel will see packets and manage the connections, which isn't
         desirable while sending forged packets"""
-        import os
+        if self.sock is not None or self.replay is not None:
+            # no kernel behind the socket
+            self.khandled = enable if enable is not None else not self.khandled
+            return
         if enable is True or self.khandled is False:
             os.system("%s -D INPUT -p tcp -j DROP" % self.conf["iptables_bin"])
             self.khandled = True
@@ -237,6 +542,12 @@ class ProtoTester(object):
             raise Exception("no destination found for sending control data")
         if dport is None:
             dport = self.conf["udp_port"]
+        if self.replay is not None:
+            # the other side is replayed, nothing to send it
+            self.debug("Replay: UDP packet to %s not sent: %s" % (dst,data), 5)
+            return
+        if self.sock is not None:
+            return self.sendLinkData(data, dst, dport, ackMsg)
         outsock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         sock.bind(('', self.conf["udp_port_ack"])) # wait for ack
@@ -258,7 +569,27 @@ class ProtoTester(object):
         sock.close()
         outsock.close()
     
+    def sendLinkData(self, data, dst, dport, ackMsg):
+        """sendData on the socket of the tester. The control messages are
+        not retransmitted, the socket is expected to be reliable"""
+        self.send(IP(src=self.sock.addrs[0], dst=dst)/
+                UDP(sport=self.conf["udp_port_ack"], dport=dport)/data)
+        self.debug("UDP packet sent to %s: %s" % (dst,data), 5)
+        if not ackMsg:
+            return
+        self.recvLink(lambda pkt: pkt.haslayer(UDP) and
+                pkt[UDP].dport == self.conf["udp_port_ack"] and
+                str(pkt[UDP].payload) == ackMsg, keep=lambda pkt: True)
+        self.debug("UDP: ACK received", 5)
+
     def sendAck(self,addr):
+        if self.replay is not None:
+            return
+        if self.sock is not None:
+            self.send(IP(src=self.sock.addrs[0], dst=addr)/
+                    UDP(sport=self.conf["udp_port"],
+                        dport=self.conf["udp_port_ack"])/"ack")
+            return
         outsock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         outsock.sendto("ack", (addr, self.conf["udp_port_ack"]))
         outsock.close()
@@ -266,29 +597,49 @@ class ProtoTester(object):
     def receiveData(self, src=None, bindTo=''):
         """Wait to receive state in its network representation from src, using UDP
         Return the state as a dictionary"""
+        if self.sock is not None or self.replay is not None:
+            pkt = self.recvLink(lambda pkt: pkt.haslayer(UDP) and
+                    pkt[UDP].dport == self.conf["udp_port"] and
+                    (src is None or pkt[IP].src == src),
+                    keep=lambda pkt: True)
+            if pkt is None: # end of the replayed recording
+                raise PktWaitTimeOutException(None)
+            data, addr = str(pkt[UDP].payload), pkt[IP].src
+            self.debug("Received data from %s: '%s'"%(addr,data))
+            self.sendAck(addr)
+            return data
         sock = socket.socket( socket.AF_INET, socket.SOCK_DGRAM)
         sock.bind((bindTo, self.conf["udp_port"]))
-        data, addr = sock.recvfrom( 2048 )
+        data, addr = sock.recvfrom( 65535 )
         self.debug("Received data from %s: '%s'"%(addr,data))
         while src is not None and addr[0] != src:
             self.debug("Not from expected source %s, waiting for another udp packet"%src)
-            data, addr = sock.recvfrom( 2048 )
+            data, addr = sock.recvfrom( 65535 )
             self.debug("Received data from %s: '%s'"%(addr,data))
         sock.close()
         self.sendAck(addr[0])
         return data
     
         
-    def sendState(self, state=None, dst=None):
-        """Send state in its network representation to dst, using UDP"""
+    def sendState(self, state=None, dst=None, delta=True):
+        """Send state in its network representation to dst, using UDP. If
+        delta is True, only the changes since the previous state sent to dst
+        are sent (see statecodec.py)"""
         if dst is None and state and state.hasKey("dst"):
             dst = state["dst"]
-        self.sendData(state.toNetwork(), dst)
-    
+        enc = self.stateEncoders.get(dst)
+        if enc is None:
+            enc = self.stateEncoders[dst] = StateEncoder()
+        self.sendData(enc.encode(state.netDict(), delta), dst)
+
     def receiveState(self, cls=None, src=None, bindTo=''):
+        """Receive a state sent by sendState, return it as a dictionary"""
         if cls is None:
             cls = ProtoState
-        return cls.fromNetwork(self.receiveData(src=src, bindTo=bindTo))
+        data = self.receiveData(src=src, bindTo=bindTo)
+        if isStateMessage(data):
+            return self.stateDecoder.decode(data)
+        return cls.fromNetwork(data)
     
     def syncWait(self, src=None):
         """Useful for synchronization between client and server. It is used
@@ -325,10 +676,335 @@ class ProtoTester(object):
         self.sendData(str(result), dst)
 
     def fwCmd(self, cmd, dst=None, dport=None):
-        self.sendData("FWCMD %s" % cmd, dst, dport=5005, ackMsg="fwack")
+        """Run the iptables command cmd on the firewall dst"""
+        return self.fwRules([cmd], dst, dport)
+
+    def fwRules(self, rules, dst=None, dport=None, wait=True):
+        """Apply the list of iptables commands rules at once on the firewall
+        dst (see fwudpserver.py). If wait is False, return without waiting
+        for the acknowledgment, so that the requests are pipelined (see
+        fwWait). Return True if the rules were applied"""
+        if self.replay is not None:
+            return True
+        if dst is None:
+            raise Exception("no destination found for sending firewall rules")
+        addr = (dst, dport or 5005)
+        fw = self.firewalls.get(addr)
+        if fw is None:
+            fw = self.firewalls[addr] = FirewallChannel(addr)
+        seq = fw.request(rules)
+        self.debug("Firewall request %i sent to %s: %s" % (seq, dst, rules), 5)
+        if not wait:
+            return None
+        return self.fwWait(dst)
+
+    def fwWait(self, dst=None):
+        """Wait for the acknowledgments of the firewall requests sent to dst
+        (all the firewalls if None). Return True if all were applied"""
+        ok = True
+        for (addr, fw) in self.firewalls.items():
+            if dst is not None and addr[0] != dst:
+                continue
+            for (seq, code, err) in fw.wait():
+                self.debug("Firewall request %i failed on %s (%i): %s" %
+                        (seq, addr[0], code, err), 1)
+                ok = False
+        return ok
 
     
 
+class FirewallChannel(object):
+    """Persistent channel to a firewall (fwudpserver.py). Each request is a
+    list of rules applied at once, with a sequence number. The requests are
+    sent without waiting for the previous ones to be acknowledged, and are
+    retransmitted until they are. The firewall applies them in sequence, and
+    only once"""
+    def __init__(self, addr, rto=0.2):
+        self.addr = addr
+        self.rto = rto
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # not drawn with getRandom, not to change the random values of the
+        # tester
+        self.session = "%08x" % random.SystemRandom().getrandbits(32)
+        self.seq = 0
+        self.pending = {} # seq -> [request, time of its last sending]
+        self.failed = [] # (seq, return code, error) not reported yet
+
+    def request(self, rules):
+        """Send the request to apply rules, return its sequence number"""
+        self.seq += 1
+        data = "FWRULES %s %i\n%s" % (self.session, self.seq, "\n".join(rules))
+        self.sock.sendto(data, self.addr)
+        self.pending[self.seq] = [data, time.time()]
+        return self.seq
+
+    def receive(self, timeout):
+        """Handle the acknowledgments received within timeout seconds"""
+        if not select.select([self.sock], [], [], timeout)[0]:
+            return
+        while True:
+            try:
+                data = self.sock.recv(2048)
+            except socket.error:
+                return
+            ack = data.split(None, 4)
+            if len(ack) < 4 or ack[0] != "FWACK" or ack[1] != self.session:
+                continue
+            seq, code = int(ack[2]), int(ack[3])
+            if self.pending.pop(seq, None) is not None and code != 0:
+                self.failed.append((seq, code, ack[4] if len(ack) > 4
+                    else ""))
+            if not select.select([self.sock], [], [], 0)[0]:
+                return
+
+    def wait(self):
+        """Wait until all the requests are acknowledged, return the list of
+        (seq, return code, error) of those failing"""
+        while self.pending:
+            now = time.time()
+            for req in self.pending.itervalues():
+                if now-req[1] >= self.rto:
+                    self.sock.sendto(req[0], self.addr)
+                    req[1] = now
+            self.receive(self.rto)
+        failed, self.failed = self.failed, []
+        return failed
+
+    def close(self):
+        self.sock.close()
+
+
+class WaitRequest(object):
+    """Wait for a packet matching filterfct, yielded by a scenario driven by a
+    MultiProtoTester. pkt is the packet sent before waiting, if any"""
+    def __init__(self, filterfct, timeout=None, buffermode=False, pkt=None):
+        self.filterfct = filterfct
+        self.timeout = timeout
+        self.buffermode = buffermode
+        self.pkt = pkt
+        self.buf = []
+
+
+class ConnTester(ProtoTester):
+    """ProtoTester of one connection driven by a MultiProtoTester.
+
+    sendpkt() sends the packet without blocking. If a reply must be waited
+    for, it returns a WaitRequest, that the scenario must yield: the value of
+    the yield expression is then what sendpkt() would have returned. Other
+    return values can be yielded as well and are sent back as is, so that
+    'ret = yield t.sendpkt(...)' always works"""
+    def __init__(self, multi, conf=DEFAULT_CONF):
+        # the MultiProtoTester owns the sockets, no recording nor replay of
+        # single connections
+        ProtoTester.__init__(self, dict(conf.items() + [("capture", False),
+            ("seed", None), ("record", None), ("replay", None)]))
+        self.multi = multi
+        self.queue = deque(maxlen=multi.maxqueue) # packets not waited for yet
+        self.gen = None
+        self.wait = None
+        self.waitseq = 0
+
+    def sendpkt(self, newpkt, initstate=None, **kargs):
+        s = self.initState(initstate)
+        (pkt, wait) = self.generate(newpkt, s, **kargs)
+        if s.hasKey("stage") and pkt is not None:
+            self.debug("Generating %s packet..." % s["stage"], 1)
+        self.dbgshow(pkt)
+        if pkt is not None:
+            if self.metrics is not None:
+                self.metrics.sent(pkt)
+            self.multi.send(pkt)
+        if not wait:
+            return (pkt, True, None, self.state)
+        if pkt is not None:
+            # like sr1(), wait for an answer to pkt
+            return WaitRequest(lambda r: r.answers(pkt), pkt=pkt)
+        timeout, buffermode = None, False
+        if type(wait) is tuple:
+            wait, timeout, buffermode = wait
+        if not hasattr(wait, '__call__'):
+            raise Exception("error, no packet generated.")
+        return WaitRequest(wait, timeout, buffermode)
+
+    def waitForPacket(self, state=None, filterfct=None, timeout=5,
+            buffermode=False, **kargs):
+        """Return a WaitRequest, to be yielded by the scenario"""
+        if state is not None:
+            self.state.update(state)
+        return WaitRequest(filterfct or (lambda pkt: True), timeout, buffermode)
+
+    def deliver(self, pkt):
+        """Handle pkt, received while waiting. Return the value to resume the
+        scenario with, or None if the wait isn't over"""
+        w = self.wait
+        if w.buffermode:
+            if isEOD(pkt):
+                self.sendAck(pkt.getlayer(IP).src)
+                return [self.packetReceived(p, buffermode=True) for p in w.buf]
+            w.buf.append(pkt)
+            return None
+        (ret, reply) = self.packetReceived(pkt)
+        return (w.pkt, ret, reply, self.state)
+
+    def accepts(self, pkt):
+        w = self.wait
+        if pkt.haslayer(UDP):
+            # only the end of data marker of its peer ends a buffer mode wait
+            return w.buffermode and isEOD(pkt) and self.isFromPeer(pkt)
+        return pkt.haslayer(TCP) and w.filterfct(pkt)
+
+    def isFromPeer(self, pkt):
+        """True if pkt is a control message sent by the peer of the
+        connection, to one of its addresses"""
+        if self.state is None or pkt[UDP].dport != self.conf["udp_port"]:
+            return False
+        l3 = pkt.getlayer(IP)
+        return any(tid[0] == l3.src and tid[1] == l3.dst
+                for tid in self.state.getTupleIds())
+
+
+class MultiProtoTester(object):
+    """Drive many connections concurrently from a single thread, with one
+    send socket and one capture socket shared by all of them.
+
+    Each connection has its own ConnTester and state, and is driven by a
+    scenario: a generator (Python 2 has no asyncio) using the usual protocol
+    library with its ConnTester, and yielding where it must wait for
+    packets. The packets received are dispatched to the connections by
+    4-tuple (see ProtoState.getTupleIds), then by the filters of the
+    connections waiting, the one waiting for the longest time first. The end
+    of data markers (buffer mode) go to the connections with the peer and
+    address they are sent from and to. Example:
+
+        def scenario(t):
+            m = MPTCPTest(tester=t, initstate=MPTCPState(...))
+            yield t.sendpkt(m.CapSYN, dst=dst)
+            ...
+        multi = MultiProtoTester()
+        for i in range(1000):
+            t = multi.connection()
+            multi.spawn(t, scenario(t))
+        multi.run()
+    """
+    def __init__(self, conf=DEFAULT_CONF, iface=None, maxqueue=1000):
+        self.conf = dict(DEFAULT_CONF.items() + conf.items())
+        self.maxqueue = maxqueue
+        self.sock = self.conf["socket"]
+        self.ownsock = self.sock is None
+        if self.sock is None:
+            self.sock = scapy_conf.L3socket(iface=iface, filter="tcp or udp")
+        self.testers = set()
+        self.owners = {}  # 4-tuple -> tester
+        # testers waiting, in the order they started to
+        self.waiting = OrderedDict()
+        self.timers = []  # heap of (deadline, waitseq, tester)
+
+    def connection(self, initstate=None):
+        """Return a new ConnTester, whose state is initstate"""
+        t = ConnTester(self, self.conf)
+        t.state = initstate
+        return t
+
+    def spawn(self, tester, scenario):
+        """Start driving the connection of tester with scenario"""
+        tester.gen = scenario
+        self.testers.add(tester)
+        self.resume(tester)
+
+    def send(self, pkt):
+        self.sock.send(pkt)
+
+    def resume(self, t, value=None, exc=None):
+        """Run the scenario of t until it waits for a packet not received
+        yet"""
+        while True:
+            try:
+                if exc is not None:
+                    req, exc = t.gen.throw(exc), None
+                else:
+                    req = t.gen.send(value)
+            except StopIteration:
+                self.testers.discard(t)
+                for tid in t.state.getTupleIds() if t.state else []:
+                    if self.owners.get(tid) is t:
+                        del(self.owners[tid])
+                return
+            if t.state is not None:
+                for tid in t.state.getTupleIds():
+                    self.owners[tid] = t
+            if not isinstance(req, WaitRequest):
+                value = req
+                continue
+            t.wait = req
+            value = None
+            while t.queue and value is None:
+                pkt = t.queue.popleft()
+                if t.accepts(pkt):
+                    value = t.deliver(pkt)
+            if value is not None:
+                continue
+            t.waitseq += 1
+            self.waiting[t] = True
+            if req.timeout:
+                heapq.heappush(self.timers, (time.time()+req.timeout, t.waitseq, t))
+            return
+
+    def dispatch(self, pkt):
+        """Give pkt to the connection it belongs to"""
+        t = None
+        l4 = pkt.getlayer(TCP)
+        if l4 is not None:
+            l3 = l4.underlayer
+            t = self.owners.get((l3.src, l3.dst, l4.sport, l4.dport))
+        if t is None:
+            for w in self.waiting:
+                if w.accepts(pkt):
+                    t = w
+                    break
+            else:
+                return
+        if t not in self.waiting or not t.accepts(pkt):
+            t.queue.append(pkt)
+            return
+        value = t.deliver(pkt)
+        if value is not None:
+            self.waiting.pop(t, None)
+            t.waitseq += 1
+            self.resume(t, value)
+
+    def run(self, timeout=None):
+        """Run the scenarios until they are all over, or for at most timeout
+        seconds"""
+        end = time.time()+timeout if timeout is not None else None
+        while self.testers:
+            now = time.time()
+            while self.timers and self.timers[0][0] <= now:
+                deadline, seq, t = heapq.heappop(self.timers)
+                if t.waitseq != seq or t not in self.waiting:
+                    continue # wait already over
+                self.waiting.pop(t, None)
+                t.waitseq += 1
+                if t.wait.buffermode:
+                    self.resume(t, [t.packetReceived(p, buffermode=True)
+                                    for p in t.wait.buf])
+                else:
+                    self.resume(t, exc=PktWaitTimeOutException(t.wait.timeout))
+            if end is not None and now >= end:
+                break
+            delay = 0.2
+            if self.timers:
+                delay = min(delay, max(0, self.timers[0][0]-now))
+            if select.select([self.sock], [], [], delay)[0]:
+                pkt = self.sock.recv(MTU)
+                if pkt is not None:
+                    self.dispatch(pkt)
+        return len(self.testers)
+
+    def close(self):
+        if self.ownsock:
+            self.sock.close()
+
+
 class ProtoLibPacket(object):
     def generate(self, state):
         """Describe the packet to send for the class's packet type""" 
@@ -344,10 +1020,10 @@ class ProtoLibPacket(object):
 
 class ProtoState(object):
     def __init__(self, initstate={},conf=DEFAULT_CONF):
+        self.conf = conf
         self.d = {}
         self.initAttr()
         self.update(initstate)
-        self.conf = conf
 
     def initAttr(self):
         """Populate the internal dictionary with default values."""
@@ -362,23 +1038,36 @@ class ProtoState(object):
         return self.d[attr]
 
     def __setitem__(self, attr, val):
-        if attr in ["ack", "seq"]:
-            self.debug("%s: %i --> %i"% (attr, self.d[attr],val), level=5)
-            self.debug(inspect.stack(), level=5)
-        if attr in ["map"]:
-            self.debug("%s: %s --> %s" % (attr, self.d[attr],val), level=4)
-        if attr in ["dsn", "data_ack"]:
-            self.debug("%s: %i --> %i" % (attr, self.d[attr],val), level=3)
-            self.debug(inspect.stack(), level=5)
+        # the traces are only formatted when they are printed, since
+        # inspect.stack() costs much more than the assignment itself
+        if self.conf["debug"] >= 3:
+            if attr in ["ack", "seq"]:
+                self.debug("%s: %i --> %i"% (attr, self.d[attr],val), level=5)
+                if self.conf["debug"] >= 5:
+                    self.debug(inspect.stack(), level=5)
+            if attr in ["map"]:
+                self.debug("%s: %s --> %s" % (attr, self.d[attr],val), level=4)
+            if attr in ["dsn", "data_ack"]:
+                self.debug("%s: %i --> %i" % (attr, self.d[attr],val), level=3)
+                if self.conf["debug"] >= 5:
+                    self.debug(inspect.stack(), level=5)
         self.d[attr] = val
 
+    def netDict(self):
+        """Return the dictionary of the state sent to the other side"""
+        return dict(self.d)
+
     def toNetwork(self):
-        return str(self.d)
+        return StateEncoder().encode(self.netDict())
 
     @classmethod
-    def fromNetwork(cls, dictstr):
+    def fromNetwork(cls, data):
+        """Return the dictionary of the state data, encoded by toNetwork
+        (or by str() of the dictionary, by former versions)"""
+        if isStateMessage(data):
+            return StateDecoder().decode(data)
         import ast
-        return ast.literal_eval(dictstr)
+        return ast.literal_eval(data)
 
     def update(self, extrastate):
         """Update the current state with the extrastate. Extrastate must be a
@@ -394,10 +1083,24 @@ class ProtoState(object):
     def hasKey(self, key):
         return key in self.d.keys()
 
+    def getTupleIds(self):
+        """Return the 4-tuples (dst, src, dport, sport) of the packets of the
+        connection, in both directions"""
+        return []
+
     def copy(self):
         import copy
         return copy.deepcopy(self)
 
+    def snapshot(self):
+        """Return a read-only copy of the current state, cheap to take: the
+        state dictionary is copied, but not the values it refers to (packets,
+        ...), which must not be modified in place"""
+        snap = object.__new__(self.__class__)
+        snap.__dict__ = self.__dict__.copy()
+        snap.d = self.d.copy()
+        return snap
+
     def logPacket(self, pkt):
         self.d["prev_pkt"] = pkt
 
@@ -409,17 +1112,48 @@ class ProtoState(object):
 
     
 
+def isEOD(pkt):
+    """True if pkt is the end of data marker of the buffer mode"""
+    return pkt.haslayer(UDP) and str(pkt[UDP].payload) == "EOD"
+
 def xlong(s):
     """Convert a string into a long integer"""
-    l = len(s)-1
-    return sum([ord(c) << (l-e)*8 for e,c in enumerate(s)])
+    return long(s.encode("hex"), 16) if s else 0
 
 def xstr(x):
     """Convert an integer into a string"""
-    return xstr(x >> 8) + chr(x&255) if x else ''
+    if not x:
+        return ''
+    h = "%x" % x
+    return (h if len(h) % 2 == 0 else "0"+h).decode("hex")
+
+def testAddress(name, default):
+    """Return the address name (A1, A2, B...) of the scenario: that of the
+    address set given by the scenario runner (see runall.py), else default"""
+    return os.environ.get("MPTCP_TEST_%s" % name, default)
+
+def slotAddresses():
+    """Return the set of the addresses (A1, A2 and B) of the address set given
+    by the scenario runner, or None if the scenario is not run in a slot. The
+    scenarios of the other slots run concurrently on the same hosts"""
+    addrs = set(os.environ.get("MPTCP_TEST_%s" % name)
+            for name in ("A1", "A2", "B"))
+    addrs.discard(None)
+    return addrs or None
+
+_random = local()
+
+def seedRandom(seed):
+    """Make the random values of the current thread reproducible: they are
+    drawn from a generator initialized with seed (see conf "seed")"""
+    _random.generator = random.Random(seed)
+
+def getRandom():
+    """Return the generator of the random values of the current thread"""
+    return getattr(_random, "generator", random)
 
 def randintb(n):
     """Picks a n-bits value at random"""
-    return random.randrange(0, 1L<<n)
+    return getRandom().randrange(0, 1L<<n)
 
 # vim: set ts=4 sts=4 sw=4 et:
@@ -0,0 +1,65 @@
+#!/usr/bin/env python2
+# Check of the lookups of DSSMapTable at the edges of the mappings, in both
+# directions: first and last byte of each mapping, adjacent mappings, holes,
+# mappings out of order at the data level, replaced mappings, and pruning.
+# Usage: PYTHONPATH=. tests/extra/dss-maps.py
+import sys
+from tests.mptcptestlib import *
+
+def main():
+    failures = []
+    def check(val, expected, msg):
+        if val != expected:
+            failures.append("%s: %r instead of %r" % (msg, val, expected))
+
+    t = DSSMapTable()
+    check(bool(t), False, "empty table")
+    check(t.toDSN(1), None, "toDSN on an empty table")
+    check(t.toSubseq(1), None, "toSubseq on an empty table")
+
+    # [1, 101) and [101, 151) adjacent, hole until 201, then [201, 211)
+    # and [211, 231) mapped below the former ones at the data level
+    t = DSSMapTable([(1, 1000, 100), (101, 1100, 50), (211, 500, 20),
+        (201, 2000, 10)])
+    check(len(t), 4, "number of mappings")
+    for subseq, dsn in ((0, None), (1, 1000), (100, 1099), (101, 1100),
+            (150, 1149), (151, None), (200, None), (201, 2000), (210, 2009),
+            (211, 500), (230, 519), (231, None)):
+        check(t.toDSN(subseq), dsn, "toDSN(%i)" % subseq)
+    for dsn, subseq in ((499, None), (500, 211), (519, 230), (520, None),
+            (999, None), (1000, 1), (1099, 100), (1100, 101), (1149, 150),
+            (1150, None), (2000, 201), (2009, 210), (2010, None)):
+        check(t.toSubseq(dsn), subseq, "toSubseq(%i)" % dsn)
+
+    # a mapping replaced by another one at the same subseq
+    c = t.copy()
+    c.add(201, 3000, 5)
+    check(len(c), 4, "number of mappings after a replacement")
+    check(c.toSubseq(2000), None, "toSubseq of a replaced mapping")
+    check(c.toSubseq(3004), 205, "toSubseq of the new mapping")
+    check(c.toDSN(206), None, "toDSN after the end of the new mapping")
+    check(t.toDSN(205), 2004, "toDSN on the copied table")
+
+    # pruning removes the mappings entirely acknowledged, whatever their
+    # subflow order
+    t.prune(1099)
+    check(len(t), 3, "mappings after prune(1099)")
+    check(t.toDSN(211), None, "toDSN of a pruned mapping")
+    check(t.toDSN(100), 1099, "toDSN of a partially acknowledged mapping")
+    t.prune(1100)
+    check(len(t), 2, "mappings after prune(1100)")
+    check(t.toDSN(1), None, "toDSN after prune(1100)")
+    check(t.toSubseq(1100), 101, "toSubseq after prune(1100)")
+    check(t.subseqs, [101, 201], "subseqs after pruning")
+    check(t.dsns, [1100, 2000], "dsns after pruning")
+
+    for msg in failures:
+        print("Failed: %s" % msg)
+    if failures:
+        return 1
+    print("Test passed")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
+# vim: set ts=4 sts=4 sw=4 et:
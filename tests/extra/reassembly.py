@@ -0,0 +1,104 @@
+#!/usr/bin/env python2
+# Check of MPTCPReassembler: the data-level stream of a connection is rebuilt
+# from two subflows with mappings received out of order, data overlapping
+# (reinjected) across subflows, a 32-bit DSN, data received before its
+# mapping, and a DATA_FIN.
+# Usage: PYTHONPATH=. tests/extra/reassembly.py
+import sys
+from tests.mptcptestlib import *
+from scapy.modules.mptcptrack import MPTCPReassembler
+
+A1 = "10.1.1.2"
+A2 = "10.1.2.2"
+B = "10.2.1.2"
+KEY_A = 0x0123456789abcdefL
+KEY_B = 0xfedcba9876543210L
+ISN1 = 1000
+ISN2 = 0xffffff00 # the subflow sequence numbers wrap
+
+DATA = "".join(chr(ord("a")+i%26) for i in range(300))
+
+def pkt(src, dst, sport, dport, flags="A", seq=0, opt=None, data=""):
+    tcp = TCP(sport=sport, dport=dport, flags=flags, seq=seq)
+    if opt is not None:
+        tcp.options = [TCPOption_MP(mptcp=opt)]
+    # dissected, as read from a capture
+    return IP(str(IP(src=src, dst=dst)/tcp/data))
+
+def sub1(start, end, opt=None):
+    """Segment of DATA[start:end] on the first subflow, whose relative
+    sequence numbers are the offsets+1"""
+    return pkt(A1, B, 1001, 80, seq=ISN1+1+start, opt=opt,
+            data=DATA[start:end])
+
+def sub2(start, end, relseq, opt=None):
+    return pkt(A2, B, 1002, 80, seq=(ISN2+relseq) & 0xffffffff, opt=opt,
+            data=DATA[start:end])
+
+def mapping(dsn, relseq, length, flags="AMm"):
+    if "m" not in flags:
+        dsn &= 0xffffffff
+    return MPTCP_DSS(flags=flags, dsn=dsn, subflow_seqnum=relseq,
+            datalevel_len=length)
+
+def main():
+    failures = []
+    def check(cond, msg):
+        if not cond:
+            failures.append(msg)
+    idsn = key2tokenAndDSN(KEY_A)[1]
+    token_b = key2tokenAndDSN(KEY_B)[0]
+    r = MPTCPReassembler()
+    def delivered(p):
+        return "".join(d for c, direction, d in r.add(p) if direction == 0)
+
+    r.add(pkt(A1, B, 1001, 80, "S", ISN1, MPTCP_CapableSYN(snd_key=KEY_A)))
+    r.add(pkt(B, A1, 80, 1001, "SA", 7000,
+        MPTCP_CapableSYNACK(snd_key=KEY_B)))
+    r.add(pkt(A1, B, 1001, 80, "A", ISN1+1,
+        MPTCP_CapableACK(snd_key=KEY_A, rcv_key=KEY_B)))
+    r.add(pkt(A2, B, 1002, 80, "S", ISN2, MPTCP_JoinSYN(rcv_token=token_b)))
+    conn = r.tracker.conns[token_b]
+
+    # [100, 200) on the second subflow, ahead of the stream
+    check(delivered(sub2(100, 200, 1, mapping(idsn+100, 1, 100))) == "",
+            "out of order data delivered")
+    # mapping of [0, 150), with only [0, 60) in its segment
+    check(delivered(sub1(0, 60, mapping(idsn, 1, 150))) == DATA[:60],
+            "data in sequence")
+    # [60, 150) mapped by the former segment, overlapping [100, 200)
+    check(delivered(sub1(60, 150)) == DATA[60:200],
+            "data filling the hole")
+    # [150, 250) reinjected on the second subflow, with a 32-bit DSN, after
+    # its wrap of the subflow sequence numbers
+    check(delivered(sub2(150, 250, 101, mapping(idsn+150, 101, 100, "AM")))
+            == DATA[200:250], "reinjected data")
+    # [250, 300) received before its mapping
+    check(delivered(sub1(250, 300)) == "", "unmapped data delivered")
+    check(delivered(sub1(300, 300, mapping(idsn+250, 251, 50)))
+            == DATA[250:300], "data mapped after its reception")
+    # DATA_FIN
+    delivered(sub1(300, 300, mapping(idsn+300, 0, 1, "AMmF")))
+
+    stream = conn.streams[0]
+    check(stream.next == idsn+300, "stream ends at %r instead of %r" % (
+            stream.next, idsn+300))
+    check(stream.finished(), "DATA_FIN not seen")
+    check(len(stream.pending) == 0, "%i bytes still pending" %
+            len(stream.pending))
+    for sub in conn.subflows:
+        d = sub.dirs[0]
+        check(len(d.unmapped) == 0, "%r keeps unmapped data" % sub)
+        check(len(d.maps) <= 1, "%r keeps %i delivered mappings" % (
+                sub, len(d.maps)))
+
+    for msg in failures:
+        print("Failed: %s" % msg)
+    if failures:
+        return 1
+    print("Test passed")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
+# vim: set ts=4 sts=4 sw=4 et:
@@ -0,0 +1,55 @@
+#!/usr/bin/env python2
+# Data sent with send_data_sub(fast=True), the segments being stamped out
+# from SegmentTemplates, through the send path of the real L3 sockets: the
+# packets are wrapped in an Ethernet header before being built, as
+# L3PacketSocket.send does. The IP packets on the wire must be the stamped
+# frames, carrying the data.
+# Usage: PYTHONPATH=. tests/extra/scenario-fast.py
+import sys
+from tests.mptcptestlib import *
+
+A1 = "10.1.1.2"
+B = "10.2.1.2"
+
+class WireSocket(object):
+    """Socket keeping what the L3 socket of an Ethernet interface would
+    send, as (IP packet on the wire, packet given to send)"""
+    def __init__(self):
+        self.addrs = [A1]
+        self.sent = []
+    def send(self, x):
+        wire = Ether(str(Ether()/x))
+        self.sent.append((str(wire.payload) if wire.type == 0x800 else "",
+            x))
+
+def main():
+    sock = WireSocket()
+    t = ProtoTester({"socket": sock, "capture": False})
+    s = MPTCPState()
+    m = MPTCPTest(tester=t, initstate=s)
+    sub = s.registerNewSubflow(dst=B, src=A1)
+    sub["mss"] = 100
+    data = "".join(chr(i % 256) for i in xrange(450))
+    m.send_data_sub(s, data, sub=sub, fast=True)
+    failed = 0
+    received = ""
+    for wire, pkt in sock.sent:
+        if not isinstance(pkt, PrebuiltIP) or wire != pkt.frame:
+            print("Segment on the wire is not the stamped one: %r"
+                    % wire[:40])
+            failed += 1
+        ip = IP(wire)
+        if ip.haslayer(TCP):
+            received += str(ip[TCP].payload)
+    if received != data:
+        print("Data on the wire differs from the data sent")
+        failed += 1
+    print("%i segments sent, %i failures" % (len(sock.sent), failed))
+    if failed:
+        return 1
+    print("Test passed")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
+# vim: set ts=4 sts=4 sw=4 et:
@@ -0,0 +1,71 @@
+#!/usr/bin/env python2
+# Record and replay of a client scenario (connection opening, join, data,
+# DATA_FIN and closing). The scenario is first run against the reference
+# peer on an in-memory network, recording its packets. The client is then
+# run again alone, the recording being replayed instead of the network: the
+# packets it sends and its final state (data_ack, DSN) must be identical.
+# Usage: PYTHONPATH=. tests/extra/scenario-replay.py [pcap]
+# If the pcap file exists, it is only replayed.
+import os, sys
+from threading import Thread
+from tests.mptcptestlib import *
+from tests.vlink import VirtualNetwork
+from tests.mptcppeer import MPTCPPeer
+
+# Client IPs
+A1 = "10.1.1.2"
+A2 = "10.1.2.2"
+# Server IP
+B = "10.2.1.2"
+
+SEED = 42
+
+def client(conf):
+    t = ProtoTester(dict(conf.items() + [("seed", SEED)]))
+    s = MPTCPState()
+    m = MPTCPTest(tester=t, initstate=s)
+    sub1 = s.registerNewSubflow(dst=B, src=A1)
+    t.sendSequence([m.CapSYN, m.Wait, m.CapACK], initstate=s, sub=sub1)
+    sub2 = s.registerNewSubflow(dst=B, src=A2)
+    t.sendSequence([m.JoinSYN, m.Wait, m.JoinACK, m.Wait], sub=sub2)
+    sent = m.send_data(s, "".join(chr(65+i%26) for i in range(3000)))
+    t.sendpkt(m.Wait, waitfct=m.Wait.waitAckForPkt(s, sent[-1][0]))
+    t.sendSequence([m.DSSFIN, m.Wait], sub=sub2)
+    for sub in (sub1, sub2):
+        t.sendSequence([m.FIN, m.Wait, m.ACK], sub=sub)
+    t.stopCapture()
+    return t, s
+
+def record(path):
+    net = VirtualNetwork()
+    peer = MPTCPPeer(sock=net.socket(B))
+    th = Thread(target=peer.run)
+    th.daemon = True
+    th.start()
+    t, s = client({"socket": net.socket(A1, A2), "record": path})
+    t.recorder.close()
+    peer.stop()
+    return s
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else "scenario-replay.pcap"
+    recorded = None
+    if not os.path.exists(path):
+        recorded = record(path)
+    t, s = client({"replay": path})
+    for (pkt, rec) in t.replay.mismatches:
+        print("Sent: %s\nRecorded: %s" % (pkt.summary(),
+            rec.summary() if rec is not None else None))
+    ok = not t.replay.mismatches
+    if recorded is not None:
+        ok = ok and all(recorded[k] == s[k] for k in ("data_ack", "dsn"))
+    print("data_ack %i, dsn %i, %i packets received not replayed" %
+            (s["data_ack"], s["dsn"], len(t.replay.remaining())))
+    if not ok:
+        print("Test failed")
+        sys.exit(1)
+    print("Test passed")
+
+if __name__ == "__main__":
+    main()
+# vim: set ts=4 sts=4 sw=4 et:
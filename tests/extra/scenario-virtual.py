@@ -0,0 +1,50 @@
+#!/usr/bin/env python2
+# Client and server of a connection opening, run in a single process on an
+# in-memory network: neither raw sockets, iptables nor root privileges are
+# needed. See scenario-server.py for the description of the scenarios.
+from threading import Thread
+from tests.mptcptestlib import *
+from tests.vlink import VirtualNetwork
+
+# Client IPs
+A1 = "10.1.1.2"
+A2 = "10.1.2.2"
+# Server IP
+B = "10.2.1.2"
+
+def server(sock, results):
+    t = ProtoTester({"debug": 1, "socket": sock})
+    s = MPTCPState()
+    m = MPTCPTest(tester=t, initstate=s)
+    t.sendpkt(m.Wait, timeout=10)
+    t.sendSequence([m.CapSYNACK, m.Wait], initstate=s)
+    results["server"] = t.getTestResult(src=A1)
+    t.stopCapture()
+
+def client(sock, results):
+    t = ProtoTester({"debug": 1, "socket": sock})
+    s = MPTCPState()
+    m = MPTCPTest(tester=t, initstate=s)
+    sub1 = s.registerNewSubflow(dst=B, src=A1)
+    t.sendSequence([m.CapSYN, m.Wait, m.CapACK], initstate=s, sub=sub1)
+    t.sendTestResult(("unit", s.hasKey("rcv_key")), dst=B)
+    results["client"] = True
+    t.stopCapture()
+
+def main():
+    net = VirtualNetwork()
+    results = {}
+    threads = [Thread(target=server, args=(net.socket(B), results)),
+            Thread(target=client, args=(net.socket(A1, A2), results))]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    if results != {"server": True, "client": True}:
+        print("Test failed: %s" % results)
+        sys.exit(1)
+    print("Test passed")
+
+if __name__ == "__main__":
+    main()
+# vim: set ts=4 sts=4 sw=4 et:
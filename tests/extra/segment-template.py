@@ -0,0 +1,44 @@
+#!/usr/bin/env python2
+# Check of the segments stamped out from SegmentTemplates against the same
+# segments fully built: payloads of random lengths, with patched fields, on
+# templates with and without a DSS checksum. With a checksum, the mapping
+# follows the payload; without, datalevel_len is the one of the template.
+# Usage: PYTHONPATH=. tests/extra/segment-template.py [nb_segments]
+import sys, random
+from tests.mptcptestlib import *
+
+def build(payload, dsn, ssn, csum, length=None, **fields):
+    if csum:
+        dss = MPTCP_DSS_MapCsum(flags="M", dsn=dsn, subflow_seqnum=ssn,
+            datalevel_len=len(payload), checksum=genDSSChecksum(dsn, ssn,
+                len(payload), payload))
+    else:
+        dss = MPTCP_DSS_Map(flags="M", dsn=dsn, subflow_seqnum=ssn,
+            datalevel_len=length)
+    tcp = dict(sport=1234, dport=80, seq=1000, ack=2000, flags="PA",
+            options=[TCPOption_MP(mptcp=dss)])
+    tcp.update(fields)
+    return str(IP(src="10.1.1.2", dst="10.2.1.2")/TCP(**tcp)/payload)
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    rnd = random.Random(7)
+    failed = 0
+    for csum in (True, False):
+        tmpl = SegmentTemplate(build("init", 5, 1, csum, len("init")))
+        for i in xrange(count):
+            payload = "".join(chr(rnd.randrange(256))
+                    for _ in xrange(rnd.randrange(0, 1400)))
+            # the patched fields stay in the template
+            fields = {"seq": rnd.randrange(1<<32),
+                    "window": rnd.randrange(1<<16)}
+            # the DSS fields are unchanged since the template
+            if tmpl.stamp(payload, **fields) != build(payload, 5, 1, csum,
+                    len("init"), **fields):
+                failed += 1
+    print("%i segments, %i differ from the full build" % (2*count, failed))
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
+# vim: set ts=4 sts=4 sw=4 et:
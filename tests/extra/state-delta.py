@@ -0,0 +1,117 @@
+#!/usr/bin/env python2
+# Check of the delta encoding of the states (statecodec.py): the successive
+# states of an MPTCP connection, full or as deltas, decode to the states
+# encoded. A message received again (its ack was lost) gives the current
+# state and doesn't break the following deltas, while a delta with a gap
+# or truncated is rejected without altering the stream.
+# Usage: PYTHONPATH=. tests/extra/state-delta.py
+import sys
+from tests.mptcptestlib import *
+from tests.statecodec import StateEncoder, StateDecoder
+
+A1 = "10.1.1.2"
+A2 = "10.1.2.2"
+B = "10.2.1.2"
+
+def plain(v):
+    """Return v with its packets and mapping tables as plain values, to be
+    compared"""
+    if type(v) is dict:
+        return dict((k, plain(x)) for k, x in v.iteritems())
+    if type(v) in (list, tuple):
+        return [plain(x) for x in v]
+    if isinstance(v, Packet):
+        return (v.__class__.__name__, str(v))
+    if isinstance(v, DSSMapTable):
+        return plain(v.bysub)
+    return v
+
+def main():
+    failures = []
+    def check(cond, msg):
+        if not cond:
+            failures.append(msg)
+    def decode(dec, data):
+        """Return the plain state of data, or the error raised"""
+        try:
+            return plain(dec.decode(data))
+        except ValueError as e:
+            return e
+    def rejected(dec, data):
+        return isinstance(decode(dec, data), ValueError)
+
+    s = MPTCPState()
+    s.update({"dst": B, "src": A1, "dport": 80, "sport": 1001})
+    sub1 = s.registerNewSubflow(dst=B, src=A1, sport=1001)
+    s["snd_key"] = 0x0123456789abcdefL
+    s.logPacket(IP(src=A1, dst=B)/TCP(sport=1001, dport=80, flags="S"))
+    enc = StateEncoder()
+    dec = StateDecoder()
+
+    # successive versions: values changed, added, removed, nested changes,
+    # new subflow, negative and long values
+    states = []
+    def version():
+        states.append((enc.encode(s.netDict()), plain(s.netDict())))
+    version()
+    s["dsn"] = 1000
+    sub1["seq"] = 5000
+    sub1["map"].add(1, 1000, 100)
+    version()
+    s["data_ack"] = -1
+    s["note"] = u"\xe9t\xe9"
+    sub2 = s.registerNewSubflow(dst=B, src=A2, sport=1002)
+    sub2["map"].add(1, 1100, 50)
+    version()
+    del(s.d["note"])
+    s["dsn"] = 1 << 63
+    s.logPacket(IP(src=B, dst=A2)/TCP(sport=80, dport=1002)/"data")
+    version()
+
+    for gen, (msg, expected) in enumerate(states):
+        check(decode(dec, msg) == expected,
+                "version %i decoded differently" % gen)
+        if gen == 2:
+            # received again, then the next delta
+            check(decode(dec, msg) == expected,
+                    "version %i received again" % gen)
+    check(decode(dec, states[1][0]) == states[-1][1],
+            "old version received again")
+    check(decode(dec, states[0][0]) == states[-1][1],
+            "first (full) version received again")
+
+    # a state rebuilt from the decoded dictionary
+    r = MPTCPState().update(StateDecoder().decode(
+        StateEncoder().encode(s.netDict())))
+    check(len(r.sub) == 2 and r.sub[1]["map"].toDSN(1) == 1100,
+            "subflows of the rebuilt state")
+    check(r.lookupSubflow(IP(src=B, dst=A2)/TCP(sport=80, dport=1002))
+            is r.sub[1], "subflow index of the rebuilt state")
+
+    # gaps and invalid deltas
+    s["dsn"] = 2000
+    skipped = enc.encode(s.netDict())
+    expected = plain(s.netDict())
+    s["dsn"] = 3000
+    msg = enc.encode(s.netDict())
+    check(rejected(dec, msg), "delta after a gap accepted")
+    check(rejected(dec, skipped[:-1]), "truncated delta accepted")
+    check(decode(dec, skipped) == expected, "delta after an error")
+    check(decode(dec, msg) == plain(s.netDict()),
+            "delta after the gap filled")
+    check(rejected(StateDecoder(), msg), "delta of an unknown stream accepted")
+    s["dsn"] = 4000
+    msg = enc.encode(s.netDict(), delta=False)
+    check(decode(StateDecoder(), msg) == plain(s.netDict()),
+            "full version")
+
+    for msg in failures:
+        print("Failed: %s" % msg)
+    if failures:
+        return 1
+    print("Test passed")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
+# vim: set ts=4 sts=4 sw=4 et:
@@ -0,0 +1,87 @@
+#!/usr/bin/env python2
+# Check of the isolation of the snapshots of MPTCPState: the changes of the
+# state after a snapshot (values, DSS mappings, new subflows, 4-tuples,
+# logged packets, default subflow) are not seen by the snapshot, whose
+# subflows refer to the snapshot and are found through its own index, and
+# the changes of the snapshot are not seen by the state.
+# Usage: PYTHONPATH=. tests/extra/state-snapshot.py
+import sys
+from tests.mptcptestlib import *
+
+A1 = "10.1.1.2"
+A2 = "10.1.2.2"
+B = "10.2.1.2"
+
+def pkt(src, dst, sport, dport):
+    return IP(src=src, dst=dst)/TCP(sport=sport, dport=dport)
+
+def main():
+    failures = []
+    def check(cond, msg):
+        if not cond:
+            failures.append(msg)
+    s = MPTCPState()
+    sub1 = s.registerNewSubflow(dst=B, src=A1, sport=1001)
+    sub2 = s.registerNewSubflow(dst=B, src=A2, sport=1002)
+    s["dsn"] = 1000
+    sub1["seq"] = 5000
+    sub1["map"].add(1, 1000, 100)
+    first = pkt(A1, B, 1001, 80)
+    s.logPacket(first)
+
+    snap = s.snapshot()
+    snap1, snap2 = snap.sub
+    check(snap1 is not sub1 and snap2 is not sub2, "subflows shared")
+    check(snap1.mpconn is snap and snap2.mpconn is snap,
+            "subflows of the snapshot refer to the state")
+
+    # changes of the state
+    s["dsn"] = 2000
+    sub1["seq"] = 6000
+    sub1["map"].add(101, 1100, 50)
+    sub2["sport"] = 2002
+    s.registerNewSubflow(dst=B, src=A2, sport=1003)
+    s.setDefaultSubflow(sub2)
+    s.logPacket(pkt(A2, B, 2002, 80))
+
+    check(snap["dsn"] == 1000, "dsn of the snapshot changed")
+    check(snap1["seq"] == 5000, "seq of the snapshot changed")
+    check(len(snap1["map"]) == 1 and snap1["map"].toDSN(101) is None,
+            "mapping added to the snapshot")
+    check(snap2["sport"] == 1002, "sport of the snapshot changed")
+    check(len(snap.sub) == 2, "subflow added to the snapshot")
+    check(snap.getDefaultSubflow() is snap1,
+            "default subflow of the snapshot changed")
+    check(snap.getLastPacket() is first,
+            "last packet of the snapshot changed")
+    check(snap.lookupSubflow(pkt(B, A2, 80, 1002)) is snap2,
+            "former 4-tuple not found in the snapshot")
+    check(snap.lookupSubflow(pkt(B, A2, 80, 2002)) is None,
+            "new 4-tuple found in the snapshot")
+    check(snap.lookupSubflow(pkt(B, A2, 80, 1003)) is None,
+            "new subflow found in the snapshot")
+    check(s.lookupSubflow(pkt(B, A2, 80, 2002)) is sub2,
+            "new 4-tuple not found in the state")
+
+    # changes of the snapshot
+    snap["data_ack"] = 1234
+    snap1["ack"] = 42
+    snap1["map"].add(201, 3000, 10)
+    snap.registerNewSubflow(dst=B, src=A1, sport=1004)
+    check(s["data_ack"] == 0, "data_ack of the state changed")
+    check(sub1["ack"] == 0, "ack of the state changed")
+    check(sub1["map"].toDSN(201) is None, "mapping added to the state")
+    check(len(s.sub) == 3, "subflow added to the state")
+    check(s.lookupSubflow(pkt(B, A1, 80, 1004)) is None,
+            "subflow of the snapshot found in the state")
+
+    for msg in failures:
+        print("Failed: %s" % msg)
+    if failures:
+        return 1
+    print("Test passed")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
+# vim: set ts=4 sts=4 sw=4 et:
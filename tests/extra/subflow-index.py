@@ -0,0 +1,63 @@
+#!/usr/bin/env python2
+# Check of the subflow index of MPTCPState (lookupSubflow): the subflows
+# are found from the packets of both directions, and still are after a
+# change of their 4-tuple, under their new 4-tuple only. Unregistered
+# subflow states don't alter the index.
+# Usage: PYTHONPATH=. tests/extra/subflow-index.py
+import sys
+from tests.mptcptestlib import *
+
+A1 = "10.1.1.2"
+A2 = "10.1.2.2"
+B = "10.2.1.2"
+
+def pkt(src, dst, sport, dport):
+    return IP(src=src, dst=dst)/TCP(sport=sport, dport=dport)
+
+def main():
+    failures = []
+    def check(cond, msg):
+        if not cond:
+            failures.append(msg)
+    s = MPTCPState()
+    sub1 = s.registerNewSubflow(dst=B, src=A1, sport=1001)
+    sub2 = s.registerNewSubflow(dst=B, src=A2, sport=1002)
+    check(s.lookupSubflow(pkt(B, A1, 80, 1001)) is sub1, "received on sub1")
+    check(s.lookupSubflow(pkt(A1, B, 1001, 80)) is sub1, "sent on sub1")
+    check(s.lookupSubflow(pkt(B, A2, 80, 1002)) is sub2, "received on sub2")
+    check(s.lookupSubflow(pkt(B, A1, 80, 1002)) is None, "unknown 4-tuple")
+
+    # change of 4-tuple of a registered subflow
+    sub2["sport"] = 2002
+    sub2["src"] = A1
+    check(s.lookupSubflow(pkt(B, A1, 80, 2002)) is sub2, "sub2 moved")
+    check(s.lookupSubflow(pkt(A1, B, 2002, 80)) is sub2, "sub2 moved, sent")
+    check(s.lookupSubflow(pkt(B, A2, 80, 1002)) is None, "sub2 former id")
+    check(s.lookupSubflow(pkt(B, A2, 80, 2002)) is None,
+            "sub2 intermediate id")
+    check(s.lookupSubflow(pkt(B, A1, 80, 1001)) is sub1, "sub1 unchanged")
+    check(len(s.index) == 4, "stale index entries: %r" % s.index.keys())
+
+    # an unregistered subflow state with the same 4-tuple as sub1
+    other = s.createSubflow(dst=B, src=A1, sport=1001)
+    other["sport"] = 3003
+    check(s.lookupSubflow(pkt(B, A1, 80, 1001)) is sub1,
+            "sub1 after a change of an unregistered state")
+    check(s.lookupSubflow(pkt(B, A1, 80, 3003)) is None,
+            "unregistered state indexed")
+
+    # packets of a new subflow
+    sub3 = s.getSubflowFromPkt(pkt(B, A2, 80, 4004))
+    check(s.lookupSubflow(pkt(A2, B, 4004, 80)) is sub3, "new subflow")
+    check(len(s.sub) == 3, "%i subflows instead of 3" % len(s.sub))
+
+    for msg in failures:
+        print("Failed: %s" % msg)
+    if failures:
+        return 1
+    print("Test passed")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
+# vim: set ts=4 sts=4 sw=4 et:
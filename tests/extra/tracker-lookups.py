@@ -0,0 +1,111 @@
+#!/usr/bin/env python2
+# Check of the lookups of MPTCPTracker: the packets of both directions of a
+# subflow are attached to it by 4-tuple, the MP_JOIN subflows to their
+# connection by the token of either end, and the subflows and connections
+# are forgotten once idle or beyond max_subflows.
+# Usage: PYTHONPATH=. tests/extra/tracker-lookups.py
+import sys
+from tests.mptcptestlib import *
+from scapy.modules.mptcptrack import MPTCPTracker
+
+A1 = "10.1.1.2"
+A2 = "10.1.2.2"
+B = "10.2.1.2"
+KEY_A = 0x0123456789abcdefL
+KEY_B = 0xfedcba9876543210L
+
+def pkt(t, src, dst, sport, dport, flags="A", opt=None):
+    tcp = TCP(sport=sport, dport=dport, flags=flags)
+    if opt is not None:
+        tcp.options = [TCPOption_MP(mptcp=opt)]
+    # dissected, as read from a capture
+    p = IP(str(IP(src=src, dst=dst)/tcp))
+    p.time = t
+    return p
+
+def handshake(tracker, t, src, sport):
+    """Track the handshake of the first subflow, return its result"""
+    tracker.track(pkt(t, src, B, sport, 80, "S",
+        MPTCP_CapableSYN(snd_key=KEY_A)))
+    tracker.track(pkt(t, B, src, 80, sport, "SA",
+        MPTCP_CapableSYNACK(snd_key=KEY_B)))
+    return tracker.track(pkt(t, src, B, sport, 80, "A",
+        MPTCP_CapableACK(snd_key=KEY_A, rcv_key=KEY_B)))
+
+def main():
+    failures = []
+    def check(cond, msg):
+        if not cond:
+            failures.append(msg)
+    token_a = key2tokenAndDSN(KEY_A)[0]
+    token_b = key2tokenAndDSN(KEY_B)[0]
+
+    tracker = MPTCPTracker(timeout=10)
+    conn, sub1 = handshake(tracker, 0, A1, 1001)
+    check(conn is not None and conn.client_token == token_a and
+            conn.server_token == token_b, "tokens of the connection")
+    check(tracker.conns.get(token_a) is conn, "lookup by client token")
+    check(tracker.conns.get(token_b) is conn, "lookup by server token")
+    check(tracker.track(pkt(1, B, A1, 80, 1001)) == (conn, sub1),
+            "received on the first subflow")
+    check(tracker.track(pkt(1, A1, B, 1001, 80)) == (conn, sub1),
+            "sent on the first subflow")
+
+    # MP_JOIN from the client, then from the server
+    r = tracker.track(pkt(2, A2, B, 1002, 80, "S",
+        MPTCP_JoinSYN(rcv_token=token_b)))
+    check(r is not None and r[0] is conn, "join by server token")
+    sub2 = r[1] if r else None
+    check(sub2 is not None and not sub2.reverse, "join from the client")
+    check(tracker.track(pkt(2, B, A2, 80, 1002, "SA",
+        MPTCP_JoinSYNACK())) == (conn, sub2), "SYN/ACK of the join")
+    r = tracker.track(pkt(3, B, A2, 80, 1003, "S",
+        MPTCP_JoinSYN(rcv_token=token_a)))
+    check(r is not None and r[0] is conn and r[1].reverse,
+            "join from the server by client token")
+    check(len(conn.subflows) == 3, "%i subflows instead of 3" %
+            len(conn.subflows))
+
+    # unknown token, not MPTCP
+    r = tracker.track(pkt(3, A2, B, 1004, 80, "S",
+        MPTCP_JoinSYN(rcv_token=token_a^1)))
+    check(r is not None and r[0] is None, "join on an unknown token")
+    check(tracker.track(pkt(3, A2, B, 1005, 80, "S")) is None,
+            "plain TCP SYN tracked")
+    check(tracker.track(pkt(3, A1, B, 1006, 80)) is None,
+            "unknown 4-tuple tracked")
+
+    # idle subflows, then the connection, are forgotten
+    check(tracker.track(pkt(12, A2, B, 1002, 80)) == (conn, sub2),
+            "second subflow before the timeout")
+    check(tracker.track(pkt(12, A1, B, 1001, 80)) is None,
+            "first subflow after the timeout")
+    check(sub1 not in conn.subflows, "first subflow kept by the connection")
+    check(tracker.conns.get(token_a) is conn, "connection forgotten early")
+    tracker.expire(30)
+    check(not tracker.subflows, "subflows after the timeout")
+    check(not tracker.conns, "connection after the timeout")
+
+    # subflows beyond max_subflows
+    tracker = MPTCPTracker(timeout=None, max_subflows=2)
+    conn, sub1 = handshake(tracker, 0, A1, 1001)
+    tracker.track(pkt(1, A2, B, 1002, 80, "S",
+        MPTCP_JoinSYN(rcv_token=token_b)))
+    tracker.track(pkt(2, A1, B, 1001, 80))
+    tracker.track(pkt(3, A2, B, 1003, 80, "S",
+        MPTCP_JoinSYN(rcv_token=token_b)))
+    check((A2, 1002, B, 80) not in tracker.subflows,
+            "least recently seen subflow kept")
+    check(tracker.track(pkt(4, B, A1, 80, 1001)) == (conn, sub1),
+            "recently seen subflow evicted")
+
+    for msg in failures:
+        print("Failed: %s" % msg)
+    if failures:
+        return 1
+    print("Test passed")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
+# vim: set ts=4 sts=4 sw=4 et:
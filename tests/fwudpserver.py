@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 import socket
 import sys
+import shlex
 import subprocess
 
 print("Test server started.")
@@ -8,25 +9,131 @@ print("Test server started.")
 UDP_IP = "10.2.1.1"
 UDP_PORT = 5005
 
-sock = socket.socket(socket.AF_INET, # Internet
-                     socket.SOCK_DGRAM) # UDP
-sock.bind((UDP_IP, UDP_PORT))
-#sock.bind(('', UDP_PORT))
+# Batched requests (see ProtoTester.fwRules):
+#   FWRULES <session> <seq>\n<rule>\n<rule>...
+# where the rules are iptables (or ip6tables) command lines. The rules of a
+# request are applied at once by iptables-restore, the requests of a session
+# in the order of their sequence numbers, each one once: a retransmitted
+# request is only acknowledged again. The acknowledgment is sent back to the
+# sender of the request:
+#   FWACK <session> <seq> <return code of iptables-restore> [<error>]
+# The acknowledgments of the failed requests are all kept, those of the
+# others only for the last ACKS_KEPT requests: a request retransmitted after
+# that was applied successfully, and is acknowledged with
+#   FWACK <session> <seq> 0 stale
+# A rule with an argument containing a double quote, that iptables-restore
+# cannot parse, fails the request with the return code 2 (parameter problem).
+# The former single commands "FWCMD <cmd>" are still run by a shell, and
+# acknowledged with "fwack" on port 3457.
+ACKS_KEPT = 256 # acknowledgments kept per session, for the retransmissions
 
-outsock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+class Session(object):
+    def __init__(self):
+        self.expected = 1 # sequence number of the next request to apply
+        self.waiting = {} # seq -> rules received out of order
+        self.acks = {} # seq -> acknowledgment sent
+        self.failures = {} # seq -> acknowledgment sent, of a failed request
 
-while True:
-    data, addr = sock.recvfrom(1024) # buffer size is 1024 bytes
-    print("received message: %s"% data)
+sessions = {} # (address, port, session) -> Session
+
+def restoreArg(arg):
+    """Return arg as written in an iptables-restore input"""
+    if '"' in arg:
+        raise ValueError("double quote in argument %s" % arg)
+    if not arg or any(c.isspace() for c in arg):
+        return '"%s"' % arg
+    return arg
+
+def restoreInput(rules):
+    """Return the list of (restore command, input) applying rules, in the
+    order of the first rule of each restore command"""
+    tables = {} # (restore command, table) -> (policies, rules)
+    order = [] # (restore command, table), in the order of the rules
+    for rule in rules:
+        args = shlex.split(rule)
+        cmd = "iptables-restore"
+        if args and not args[0].startswith("-"):
+            if args[0].endswith("ip6tables"):
+                cmd = "ip6tables-restore"
+            args = args[1:]
+        table = "filter"
+        for opt in ("-t", "--table"):
+            if opt in args:
+                i = args.index(opt)
+                table = args[i+1]
+                del(args[i:i+2])
+        if (cmd, table) not in tables:
+            tables[(cmd, table)] = ([], [])
+            order.append((cmd, table))
+        (policies, lines) = tables[(cmd, table)]
+        if args and args[0] in ("-P", "--policy"):
+            # chain lines come first in the restore format
+            policies.append(":%s %s [0:0]" % (args[1], args[2]))
+        else:
+            lines.append(" ".join(restoreArg(a) for a in args))
+    inputs = {} # restore command -> lines
+    cmds = [] # restore commands, in the order of the rules
+    for (cmd, table) in order:
+        (policies, lines) = tables[(cmd, table)]
+        if cmd not in inputs:
+            inputs[cmd] = []
+            cmds.append(cmd)
+        inputs[cmd].extend(["*%s" % table] + policies + lines +
+                ["COMMIT", ""])
+    return [(cmd, "\n".join(inputs[cmd])) for cmd in cmds]
+
+def applyRules(rules):
+    """Apply rules, return (return code, error message)"""
     try:
-        req = data.split()
-        request, fwCmd = req[0], " ".join(req[1:])
+        inputs = restoreInput(rules)
+    except (ValueError, IndexError) as e:
+        print >>sys.stderr, "Invalid rules:", e
+        return (2, str(e))
+    for cmd, data in inputs:
+        print("Applying with %s:\n%s" % (cmd, data))
+        try:
+            p = subprocess.Popen([cmd, "--noflush"], stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            out = p.communicate(data)[0]
+        except OSError as e:
+            print >>sys.stderr, "Execution failed:", e
+            return (127, str(e))
+        if p.returncode != 0:
+            print >>sys.stderr, "%s returned" % cmd, p.returncode
+            return (p.returncode, " ".join(out.split()))
+    return (0, "")
+
+def handleRules(data, addr):
+    try:
+        header, rules = data.split("\n", 1) if "\n" in data else (data, "")
+        request, sid, seq = header.split()
+        seq = int(seq)
     except ValueError:
         print("value error")
-        continue
-    if request != "FWCMD":
-        print("Not a firewall command from unit test request")
-        continue
+        return
+    key = (addr[0], addr[1], sid)
+    session = sessions.get(key)
+    if session is None:
+        session = sessions[key] = Session()
+    if seq < session.expected: # retransmission
+        ack = session.acks.get(seq) or session.failures.get(seq) or \
+                "FWACK %s %i 0 stale" % (sid, seq)
+        sock.sendto(ack, addr)
+        return
+    session.waiting[seq] = [r for r in rules.split("\n") if r.strip()]
+    # apply the requests received in sequence
+    while session.expected in session.waiting:
+        seq = session.expected
+        (code, err) = applyRules(session.waiting.pop(seq))
+        ack = ("FWACK %s %i %i %s" % (sid, seq, code, err)).strip()
+        session.acks[seq] = ack
+        session.acks.pop(seq-ACKS_KEPT, None)
+        if code != 0:
+            session.failures[seq] = ack
+        session.expected += 1
+        sock.sendto(ack, addr)
+
+def handleCommand(fwCmd, addr):
     print("Executing command: %s" % fwCmd)
     try:
         retcode = subprocess.call("%s" % fwCmd, shell=True)
@@ -38,9 +145,24 @@ while True:
         print >>sys.stderr, "Execution failed:", e
     finally:
         print("send an ack back to %s, port %i" % (addr[0], 3457) )
-        outsock.sendto("fwack", (addr[0], 3457))
+        sock.sendto("fwack", (addr[0], 3457))
 
-outsock.close()
-sock.close()
+sock = socket.socket(socket.AF_INET, # Internet
+                     socket.SOCK_DGRAM) # UDP
+sock.bind((UDP_IP, UDP_PORT))
+#sock.bind(('', UDP_PORT))
 
+while True:
+    data, addr = sock.recvfrom(65535)
+    print("received message: %s"% data)
+    request = data.split(None, 1)
+    if not request:
+        continue
+    if request[0] == "FWRULES":
+        handleRules(data, addr)
+    elif request[0] == "FWCMD" and len(request) > 1:
+        handleCommand(request[1], addr)
+    else:
+        print("Not a firewall command from unit test request")
 
+sock.close()
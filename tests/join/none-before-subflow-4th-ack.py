@@ -9,10 +9,10 @@ def main():
     m = MPTCPTest(tester=t, initstate=s)
 
     # Client IPs
-    A1 = "10.1.1.2"
-    A2 = "10.1.2.2"
+    A1 = testAddress("A1", "10.1.1.2")
+    A2 = testAddress("A2", "10.1.2.2")
     # Server IP
-    B = "10.2.1.2"
+    B = testAddress("B", "10.2.1.2")
 
     t.toggleKernelHandling(enable=False)
     try:
@@ -19,10 +19,10 @@ def main():
     m = MPTCPTest(tester=t, initstate=s)
 
     # Client IPs
-    A1 = "10.1.1.2"
-    A2 = "10.1.2.2"
+    A1 = testAddress("A1", "10.1.1.2")
+    A2 = testAddress("A2", "10.1.2.2")
     # Server IP
-    B = "10.2.1.2"
+    B = testAddress("B", "10.2.1.2")
 
     result = False
     t.toggleKernelHandling(enable=False)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python2
 # Client part of the reference scenario
 # See comments in scenario-server.py
+# runall: exclusive (the server side changes the firewall rules)
 from tests.mptcptestlib import *
 
 def main():
@@ -10,10 +11,10 @@ def main():
     m = MPTCPTest(tester=t, initstate=s)
 
     # Client IPs
-    A1 = "10.1.1.2"
-    A2 = "10.1.2.2"
+    A1 = testAddress("A1", "10.1.1.2")
+    A2 = testAddress("A2", "10.1.2.2")
     # Server IP
-    B = "10.2.1.2"
+    B = testAddress("B", "10.2.1.2")
 
     dataisDropped = False
     data2isDropped = False
@@ -0,0 +1,220 @@
+#!/usr/bin/env python2
+# Timing metrics of the test scenarios: RTT, goodput, retransmissions and
+# time spent in the test library, exported as a summary and as JSON.
+from scapy.all import TCP
+from collections import deque
+import json
+import math
+import time
+
+class Histogram(object):
+    """Durations (in seconds), summarized by percentiles and by buckets of
+    powers of two of microseconds"""
+    def __init__(self):
+        self.samples = []
+
+    def add(self, value):
+        self.samples.append(value)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def stats(self):
+        """Return a dictionary of the count, total, min, mean, percentiles
+        and max of the samples"""
+        s = sorted(self.samples)
+        if not s:
+            return {"count": 0}
+        def pct(p):
+            return s[min(len(s)-1, int(p*len(s)))]
+        return {"count": len(s), "total": sum(s), "min": s[0],
+                "mean": sum(s)/len(s), "p50": pct(0.5), "p90": pct(0.9),
+                "p99": pct(0.99), "max": s[-1]}
+
+    def buckets(self):
+        """Return the list of (upper bound, count) of the non-empty buckets"""
+        counts = {}
+        for v in self.samples:
+            k = max(0, int(math.ceil(math.log(max(v, 1e-6)*1e6, 2))))
+            counts[k] = counts.get(k, 0)+1
+        return [((1<<k)*1e-6, counts[k]) for k in sorted(counts)]
+
+    def render(self, width=40):
+        """Return the histogram as lines of text"""
+        b = self.buckets()
+        if not b:
+            return []
+        top = max(c for (u, c) in b)
+        return ["  <= %9.3fms |%-*s %i" % (u*1e3, width, "#"*(c*width//top), c)
+                for (u, c) in b]
+
+
+class FlowMetrics(object):
+    """Metrics of one direction of a subflow (TCP connection) we send on"""
+    def __init__(self, flow):
+        self.flow = flow # (src, dst, sport, dport)
+        self.pkts_sent = 0
+        self.bytes_sent = 0
+        self.pkts_rcvd = 0
+        self.bytes_rcvd = 0
+        self.retransmissions = 0
+        self.snd_max = None # end of the highest sequence sent
+        self.pending = deque() # (end seq, send time) not acked yet
+        self.rtt = Histogram()
+
+    def sent(self, l4, plen, now):
+        self.pkts_sent += 1
+        self.bytes_sent += plen
+        seglen = plen + (l4.flags & 0x03 and 1) # SYN and FIN count for one
+        if not seglen:
+            return
+        end = (l4.seq+seglen) % (1<<32)
+        if self.snd_max is not None and (end-self.snd_max) % (1<<32) >= 1<<31 \
+                or end == self.snd_max:
+            # retransmission: the RTT of the segments it covers is ambiguous
+            self.retransmissions += 1
+            while self.pending and (end-self.pending[0][0]) % (1<<32) < 1<<31:
+                self.pending.popleft()
+            return
+        self.snd_max = end
+        self.pending.append((end, now))
+
+    def acked(self, ack, now):
+        sendtime = None
+        while self.pending and (ack-self.pending[0][0]) % (1<<32) < 1<<31:
+            sendtime = self.pending.popleft()[1]
+        if sendtime is not None:
+            self.rtt.add(now-sendtime)
+
+    def report(self):
+        (src, dst, sport, dport) = self.flow
+        return {"src": src, "dst": dst, "sport": sport, "dport": dport,
+                "packets_sent": self.pkts_sent, "bytes_sent": self.bytes_sent,
+                "packets_received": self.pkts_rcvd,
+                "bytes_received": self.bytes_rcvd,
+                "retransmissions": self.retransmissions,
+                "rtt": dict(self.rtt.stats(), histogram=self.rtt.buckets())}
+
+
+class Metrics(object):
+    """Metrics of the connection of a ProtoTester, per subflow and for the
+    whole connection: packets and bytes, RTT samples (matching the ACKs with
+    the segments sent, except the retransmitted ones), retransmissions,
+    data-level goodput (from the data_ack values received, if the protocol
+    library provides them) and time spent in the library functions"""
+    def __init__(self):
+        self.flows = {} # (src, dst, sport, dport) -> FlowMetrics
+        self.timings = {} # name -> Histogram
+        self.start = time.time()
+        self.first_data = None # time of the first data sent
+        self.data_ack = None # (first value, last value, time of the last)
+        self.data_acked = 0
+
+    def getFlow(self, flow):
+        f = self.flows.get(flow)
+        if f is None:
+            f = self.flows[flow] = FlowMetrics(flow)
+        return f
+
+    def sent(self, pkt, now=None):
+        """Account the packet pkt, sent at now"""
+        l4 = pkt.getlayer(TCP)
+        if l4 is None:
+            return
+        now = now or time.time()
+        l3 = l4.underlayer
+        plen = len(l4.payload)
+        if plen and self.first_data is None:
+            self.first_data = now
+        self.getFlow((l3.src, l3.dst, l4.sport, l4.dport)).sent(l4, plen, now)
+
+    def received(self, pkt, data_ack=None, now=None):
+        """Account the packet pkt, received at now (by default its capture
+        time), whose data-level ACK is data_ack"""
+        l4 = pkt.getlayer(TCP)
+        if l4 is None:
+            return
+        now = now or getattr(pkt, "time", None) or time.time()
+        l3 = l4.underlayer
+        f = self.getFlow((l3.dst, l3.src, l4.dport, l4.sport))
+        f.pkts_rcvd += 1
+        f.bytes_rcvd += len(l4.payload)
+        if l4.flags & 0x10:
+            f.acked(l4.ack, now)
+        if data_ack is not None:
+            self.dataAck(data_ack, now)
+
+    def segmentsSent(self, flow, pkts, nbytes, now=None):
+        """Account segments sent without going through sent() (bulk
+        transfers, which measure their RTT themselves)"""
+        f = self.getFlow(flow)
+        f.pkts_sent += pkts
+        f.bytes_sent += nbytes
+        if nbytes and self.first_data is None:
+            self.first_data = now or time.time()
+
+    def rttSample(self, flow, rtt):
+        self.getFlow(flow).rtt.add(rtt)
+
+    def dataAck(self, data_ack, now):
+        if self.data_ack is None:
+            self.data_ack = (data_ack, data_ack, now)
+            return
+        (first, last, t) = self.data_ack
+        if 0 < (data_ack-last) % (1<<32) < 1<<31:
+            self.data_acked += (data_ack-last) % (1<<32)
+            self.data_ack = (first, data_ack, now)
+
+    def timing(self, name, duration):
+        h = self.timings.get(name)
+        if h is None:
+            h = self.timings[name] = Histogram()
+        h.add(duration)
+
+    def goodput(self):
+        """Data-level bytes acknowledged per second, since the first data
+        sent"""
+        if not self.data_acked or self.first_data is None:
+            return 0.
+        duration = self.data_ack[2]-self.first_data
+        return self.data_acked/duration if duration > 0 else 0.
+
+    def report(self):
+        """Return the metrics as a dictionary"""
+        return {"duration": time.time()-self.start,
+                "data_acked": self.data_acked, "goodput": self.goodput(),
+                "timings": dict((n, h.stats())
+                                for n, h in self.timings.iteritems()),
+                "subflows": [self.flows[k].report()
+                             for k in sorted(self.flows)]}
+
+    def summary(self):
+        """Return a human-readable summary, with the RTT histograms"""
+        lines = ["Data acked: %i bytes, goodput %.1f kB/s" %
+                (self.data_acked, self.goodput()/1e3)]
+        for n in sorted(self.timings):
+            st = self.timings[n].stats()
+            lines.append("Time in %s: %i calls, %.3fms total, %.1fus mean, "
+                    "%.1fus p99" % (n, st["count"], st["total"]*1e3,
+                        st["mean"]*1e6, st["p99"]*1e6))
+        for k in sorted(self.flows):
+            f = self.flows[k]
+            lines.append("Subflow %s:%i -> %s:%i: %i pkts/%i bytes sent, "
+                    "%i pkts/%i bytes received, %i retransmissions" % (k[0],
+                        k[2], k[1], k[3], f.pkts_sent, f.bytes_sent,
+                        f.pkts_rcvd, f.bytes_rcvd, f.retransmissions))
+            if len(f.rtt):
+                st = f.rtt.stats()
+                lines.append(" RTT: %i samples, min %.3fms, p50 %.3fms, "
+                        "p90 %.3fms, p99 %.3fms, max %.3fms" % (st["count"],
+                            st["min"]*1e3, st["p50"]*1e3, st["p90"]*1e3,
+                            st["p99"]*1e3, st["max"]*1e3))
+                lines.extend(f.rtt.render())
+        return "\n".join(lines)
+
+    def dump(self, path):
+        """Write the metrics to the JSON file path"""
+        with open(path, "w") as fd:
+            json.dump(self.report(), fd, indent=1, sort_keys=True)
+
+# vim: set ts=4 sts=4 sw=4 et:
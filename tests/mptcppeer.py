@@ -0,0 +1,227 @@
+#!/usr/bin/env python2
+# Reference MPTCP peer: a passive endpoint answering the connections opened
+# by the tests, to exercise the client side without a patched kernel.
+from tests.mptcptestlib import *
+from scapy.modules.mptcptrack import MPTCPStream
+
+class MPTCPPeer(object):
+    """Passive MPTCP endpoint, accepting any number of connections.
+
+    It answers the MP_CAPABLE and MP_JOIN handshakes, acknowledges the data
+    at the subflow and data levels, answers a DATA_FIN with its own DATA_FIN
+    and a subflow FIN with a FIN. It never sends data. The packets are
+    generated with the MPTCPTest classes, from an MPTCPState per connection.
+
+    The subflows are indexed by 4-tuple and the connections by token, so
+    that the cost of a packet doesn't depend on the number of connections.
+    The data-level stream of each connection (MPTCPStream) keeps the data
+    received out of order, the subflows only accept in-sequence segments.
+    The DSN are those of key2tokenAndDSN, as in the rest of the library.
+
+    sock is the L3 socket to use (ex: a VirtualSocket), by default a raw
+    socket on iface. With a raw socket, the kernel must be kept from
+    answering (see ProtoTester.toggleKernelHandling). ports are the ports
+    accepting connections, any if None. ondata(s, data) is called with the
+    data received in sequence on connection s"""
+    def __init__(self, sock=None, iface=None, ports=None, ondata=None,
+            conf=None):
+        self.conf = conf
+        self.ownsock = sock is None
+        if sock is None:
+            sock = scapy_conf.L3socket(iface=iface, filter="tcp")
+        self.sock = sock
+        self.ports = ports
+        self.ondata = ondata
+        self.subflows = {} # 4-tuple of the packets received -> (conn, sub)
+        self.tokens = {} # local token -> conn
+        self.running = False
+        self.accepted = 0
+        self.received = 0 # data bytes delivered in sequence
+
+    def newState(self):
+        if self.conf:
+            return MPTCPState(conf=self.conf)
+        return MPTCPState()
+
+    def send(self, pkt):
+        self.sock.send(pkt)
+
+    def reset(self, l3, l4):
+        """Reset the connection attempt of segment l3/l4"""
+        self.send(IP(src=l3.dst, dst=l3.src)/TCP(sport=l4.dport, dport=l4.sport,
+            flags="RA", seq=l4.ack, ack=l4.seq+1))
+
+    def handle(self, pkt):
+        """Process pkt, an IP packet received, and send the replies"""
+        l4 = pkt.getlayer(TCP)
+        if l4 is None:
+            return
+        l3 = l4.underlayer
+        tid = (l3.src, l3.dst, l4.sport, l4.dport)
+        flags = l4.flags
+        found = self.subflows.get(tid)
+        if found is None:
+            if flags & 0x17 == 0x02 and (self.ports is None or
+                    l4.dport in self.ports): # SYN
+                self.accept(tid, pkt, l3, l4)
+            return
+        (s, sub) = found
+        if flags & 0x04: # RST
+            self.forget(tid, s, sub)
+            return
+        if flags & 0x02:
+            if not flags & 0x10:
+                self.send(sub["synack"]) # SYN retransmitted
+            return
+        if "synack" in sub.d:
+            self.establish(tid, s, sub, pkt, l4)
+            if tid not in self.subflows:
+                return
+        self.receive(tid, s, sub, pkt, l4)
+
+    def accept(self, tid, pkt, l3, l4):
+        """Answer the SYN pkt with a SYN/ACK, if it opens a connection or
+        joins a known one"""
+        opts = list(getMpOption(l4))
+        for opt in opts:
+            if isinstance(opt, MPTCP_CapableSYN):
+                s = self.newState()
+                MPTCPTest.CapSYN().recv(s, pkt)
+                sub = s.getSubflowFromPkt(pkt)
+                (reply, wait) = MPTCPTest.CapSYNACK().generate(s, sub=sub)
+                s.stream = MPTCPStream(s["data_ack"])
+                self.tokens[s["snd_token"]] = s
+                self.accepted += 1
+                break
+            if isinstance(opt, MPTCP_JoinSYN):
+                s = self.tokens.get(opt.rcv_token)
+                if s is None:
+                    break
+                MPTCPTest.JoinSYN().recv(s, pkt)
+                sub = s.getSubflowFromPkt(pkt)
+                (reply, wait) = MPTCPTest.JoinSYNACK().generate(s, sub=sub)
+                break
+        else:
+            s = None
+        if s is None: # no MPTCP, or unknown token
+            self.reset(l3, l4)
+            return
+        sub["synack"] = reply
+        self.subflows[tid] = (s, sub)
+        self.send(reply)
+
+    def establish(self, tid, s, sub, pkt, l4):
+        """Handle the third ACK of the handshake of sub"""
+        del(sub.d["synack"])
+        for opt in getMpOption(l4):
+            if isinstance(opt, MPTCP_CapableACK):
+                MPTCPTest.CapACK().recv(s, pkt)
+            elif isinstance(opt, MPTCP_JoinACK):
+                mac = genhmac(s["rcv_key"], s["snd_key"], sub["rcv_nonce"],
+                        sub["snd_nonce"])
+                if mac != opt.snd_mac:
+                    self.send(IP(src=sub["src"], dst=sub["dst"])/
+                            TCP(sport=sub["sport"], dport=sub["dport"],
+                                flags="R", seq=sub["seq"]))
+                    self.forget(tid, s, sub)
+                    return
+                MPTCPTest.JoinACK().recv(s, pkt)
+                # the JoinACK must be acknowledged
+                self.send(MPTCPTest.DSSACK().generate(s, sub=sub)[0])
+
+    def receive(self, tid, s, sub, pkt, l4):
+        """Handle a segment on an established subflow"""
+        payload = str(l4.payload)
+        plen = len(payload)
+        fin = l4.flags & 0x01
+        for opt in getMpOption(l4):
+            if isinstance(opt, MPTCP_DSS) and flagIn(opt.flags, "M"):
+                self.addMapping(s, sub, opt)
+        if l4.seq != sub["ack"]:
+            if plen or fin: # out of sequence, ask for the missing segment
+                self.send(MPTCPTest.DSSACK().generate(s, sub=sub)[0])
+            return
+        if plen:
+            subseq = (l4.seq-sub["rem_startseq"]) % (1<<32)
+            dsn = sub["map"].toDSN(subseq)
+            if dsn is None:
+                return # not mapped yet, let it be retransmitted
+            sub["ack"] = (l4.seq+plen) % (1<<32)
+            data = s.stream.add(dsn, payload)
+            if data:
+                self.received += len(data)
+                if self.ondata:
+                    self.ondata(s, data)
+        datafin = s.stream.finished()
+        s["data_ack"] = s.stream.next + (1 if datafin else 0)
+        sub["map"].prune(s.stream.next)
+        if fin:
+            sub["ack"] = (sub["ack"]+1) % (1<<32)
+        replied = False
+        if datafin and "data_fin_sent" not in s.d:
+            s["data_fin_sent"] = replied = True
+            self.send(MPTCPTest.DSSFIN().generate(s, sub=sub)[0])
+        if fin:
+            # the subflow FIN is not data, keep the DSN unchanged
+            dsn = s["dsn"]
+            self.send(MPTCPTest.FINACK().generate(s, sub=sub)[0])
+            s["dsn"] = dsn
+            sub["fin_sent"] = replied = True
+        elif replied:
+            pass
+        elif plen:
+            self.send(MPTCPTest.DSSACK().generate(s, sub=sub)[0])
+        elif "fin_sent" in sub.d and l4.ack == sub["seq"]:
+            self.forget(tid, s, sub) # last ACK of the subflow
+
+    def addMapping(self, s, sub, opt):
+        if flagIn(opt.flags, "m"):
+            dsn = opt.dsn
+        else:
+            dsn = long(s.stream.next & 0xFFFFFFFF00000000) | opt.dsn
+            if dsn < s.stream.next - (1<<31):
+                dsn += 1<<32
+        length = opt.datalevel_len
+        if flagIn(opt.flags, "F"):
+            length -= 1
+            s.stream.fin = dsn+length
+        if length > 0 and opt.subflow_seqnum:
+            sub["map"].add(opt.subflow_seqnum, dsn, length)
+
+    def forget(self, tid, s, sub):
+        """Forget subflow sub, and its connection if it was the last one"""
+        del(self.subflows[tid])
+        s.sub.remove(sub)
+        (dst, src, dport, sport) = tid
+        for t in (tid, (src, dst, sport, dport)):
+            s.index.pop(t, None)
+        if not s.sub and self.tokens.get(s["snd_token"]) is s:
+            del(self.tokens[s["snd_token"]])
+
+    def connections(self):
+        return self.tokens.values()
+
+    def run(self, timeout=None):
+        """Answer the packets received until stop() is called, or for at
+        most timeout seconds"""
+        end = time.time()+timeout if timeout is not None else None
+        self.running = True
+        while self.running:
+            delay = 0.2
+            if end is not None:
+                delay = min(delay, end-time.time())
+                if delay <= 0:
+                    break
+            if select.select([self.sock], [], [], delay)[0]:
+                pkt = self.sock.recv(MTU)
+                if pkt is not None:
+                    self.handle(pkt)
+
+    def stop(self):
+        self.running = False
+
+    def close(self):
+        if self.ownsock:
+            self.sock.close()
+
+# vim: set ts=4 sts=4 sw=4 et:
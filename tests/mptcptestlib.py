@@ -2,10 +2,13 @@
 import traceback, sys
 from scapy.all import *
 from tests.core import *
+from tests.statecodec import registerType
 import hashlib
 import hmac
 import math
 import socket
+import bisect
+from collections import deque
 
 # Helper functions ###########################################################
     
@@ -17,9 +20,7 @@ def genhmac2(k1, k2, r1, r2):
     r1, r2 are 32bits integers
     Return a 160bits integer
     """
-    key = xstr(k1).rjust(8,'\00') + xstr(k2).rjust(8,'\00')
-    msg = xstr(r1).rjust(4,'\00') + xstr(r2).rjust(4,'\00') 
-    return xlong(hmac.new(key, msg=msg, digestmod=hashlib.sha1).digest())
+    return mptcp_hmac(k1, k2, r1, r2)
 def genhmac(k1, k2, r1, r2):
     """Generate and return a HMAC-SHA1 with the concatenation of k1 and k2
     as key and the concatenation of r1 and r2 as message.
@@ -28,30 +29,7 @@ def genhmac(k1, k2, r1, r2):
     r1, r2 are 32bits integers
     Return a 160bits integer
     """
-    key = xstr(k1).rjust(8,'\00') + xstr(k2).rjust(8,'\00')
-    msg = xstr(r1).rjust(4,'\00') + xstr(r2).rjust(4,'\00') 
-    return xlong(hmac.new(key, msg=msg, digestmod=hashlib.sha1).digest())
-
-def key2tokenAndDSN(key):
-    """Returns the token and dsn from a key
-    Generate a simple SHA1 hash of the key
-
-    key is a 64bits integer
-    Token is a 32bits integer, dsn is a 64bits integer
-    """
-    import binascii
-    keystr = struct.pack("!Q", key)
-    h = hashlib.sha1(keystr.rjust(8,'\00'))
-    shastr=h.digest() # binary
-    #shastr = struct.pack("!IIIII", *struct.unpack("@IIIII",shastr)) #to net
-    token, dsn = shastr[0:4], shastr[-8:]
-    #print "raw: %s (len=%i)"%(shastr,len(shastr)) 
-    #print "hex: %s"% binascii.hexlify(token), "%s"%binascii.hexlify(dsn)
-    d1, d2 = struct.unpack("!II",dsn)
-    token, dsn = (struct.unpack("!I",token)[0], (long(d2)<<32)+d1)
-    #print "token: %x"% token
-    #print "dsn: %x" % dsn
-    return (token, dsn)
+    return mptcp_hmac(k1, k2, r1, r2)
 
     
 def getMpOption(tcp):
@@ -80,24 +58,149 @@ def genDSSChecksum(dsn, ssn, datalen, payload):
     header = struct.pack("!QIHH", dsn, ssn, datalen, 0)
     return checksum(header+payload)
 
-def getDataAckForPkt(s, sub, l4, plen, f=False):
-    # should update the data_ack only if the map is relative to this
-    # data segment.
-    if sub["map"] and (l4.seq > sub["map"]["subseq"]+sub["startseq"]\
-            and l4.seq < sub["map"]["subseq"]+sub["startseq"] + plen or f):
-        if f and sub["map"]["subseq"] == 0: subseq = 1
-        else: subseq = sub["map"]["subseq"]
-        ret = sub["map"]["dsn"] \
-                + (l4.seq -(subseq+sub["rem_startseq"])) \
-                + plen
-    else:
-        ret = s["data_ack"]
+class DSSMapTable(object):
+    """DSS mappings received on a subflow, as a sorted interval index. Each
+    mapping (subseq, dsn, length) maps the relative subflow sequence numbers
+    [subseq, subseq+length) onto the data sequence numbers [dsn, dsn+length).
+    Lookups in both directions are done by bisection, in O(log n)"""
+    def __init__(self, maps=()):
+        self.subseqs = [] # mapping start subseqs, sorted
+        self.bysub = []   # mappings, sorted by subseq
+        self.dsns = []    # mapping start dsns, sorted
+        self.bydsn = []   # mappings, sorted by dsn
+        for m in maps:
+            self.add(*m)
+
+    def __len__(self):
+        return len(self.bysub)
+
+    def __nonzero__(self):
+        return bool(self.bysub)
+
+    def __repr__(self):
+        return repr(self.bysub)
+
+    def copy(self):
+        t = DSSMapTable()
+        t.subseqs, t.bysub = self.subseqs[:], self.bysub[:]
+        t.dsns, t.bydsn = self.dsns[:], self.bydsn[:]
+        return t
+
+    def add(self, subseq, dsn, length):
+        """Register a mapping. A mapping already registered at subseq is
+        replaced"""
+        m = (subseq, dsn, length)
+        i = bisect.bisect_left(self.subseqs, subseq)
+        if i < len(self.subseqs) and self.subseqs[i] == subseq:
+            self._remove_dsn(self.bysub[i])
+            self.bysub[i] = m
+        else:
+            self.subseqs.insert(i, subseq)
+            self.bysub.insert(i, m)
+        i = bisect.bisect_right(self.dsns, dsn)
+        self.dsns.insert(i, dsn)
+        self.bydsn.insert(i, m)
+
+    def _remove_dsn(self, m):
+        i = bisect.bisect_left(self.dsns, m[1])
+        while self.bydsn[i] != m:
+            i += 1
+        del(self.dsns[i])
+        del(self.bydsn[i])
+
+    def _lookup(self, keys, maps, val, pos):
+        i = bisect.bisect_right(keys, val)-1
+        if i >= 0:
+            m = maps[i]
+            if val < m[pos]+m[2]:
+                return m
+        return None
+
+    def toDSN(self, subseq):
+        """Return the dsn mapped to the relative subflow sequence number
+        subseq, or None if unmapped"""
+        m = self._lookup(self.subseqs, self.bysub, subseq, 0)
+        if m is None:
+            return None
+        return m[1]+subseq-m[0]
+
+    def toSubseq(self, dsn):
+        """Return the relative subflow sequence number mapped to dsn, or None
+        if unmapped"""
+        m = self._lookup(self.dsns, self.bydsn, dsn, 1)
+        if m is None:
+            return None
+        return m[0]+dsn-m[1]
+
+    def prune(self, data_ack):
+        """Forget the mappings entirely acknowledged by data_ack"""
+        i = 0
+        while i < len(self.bydsn) and self.bydsn[i][1]+self.bydsn[i][2] <= data_ack:
+            i += 1
+        if not i:
+            return
+        if self.bysub[:i] == self.bydsn[:i]:
+            # usual case, mappings acknowledged in subflow order
+            del(self.subseqs[:i])
+            del(self.bysub[:i])
+        else:
+            acked = set(self.bydsn[:i])
+            self.bysub = [m for m in self.bysub if m not in acked]
+            self.subseqs = [m[0] for m in self.bysub]
+        del(self.dsns[:i])
+        del(self.bydsn[:i])
+
+# sent with the subflow states, as the list of the mappings
+registerType(DSSMapTable, lambda t: t.bysub, DSSMapTable)
+
+
+def getDataAckForPkt(s, sub, l4, plen, fin=None):
+    """Return the data_ack of connection s after the reception of plen bytes
+    of payload in l4 on subflow sub. The data_ack only moves forward when the
+    data is mapped and in sequence at the data level. fin is the dsn of a
+    DATA_FIN carried by the segment, if any"""
+    ret = s["data_ack"]
+    if plen:
+        maps = sub["map"]
+        subseq = (l4.seq-sub["rem_startseq"]) % (1 << 32)
+        first = maps.toDSN(subseq)
+        if first is not None and first <= ret:
+            last = maps.toDSN(subseq+plen-1)
+            if last is not None:
+                ret = max(ret, last+1)
+    if fin is not None and fin == ret:
+        ret += 1
+    sub["map"].prune(ret)
     return ret
 
 def get32bitSeq(seq64):
     seq32 = seq64 % (1 << 32) 
     return seq32
 
+def iterBlocks(source, size):
+    """Return a generator of the data of source by blocks of size bytes (the
+    last one may be shorter). source is a string, a file-like object or an
+    iterator of strings"""
+    if isinstance(source, str):
+        return (source[i:i+size] for i in xrange(0, len(source), size))
+    if hasattr(source, "read"):
+        return iter(lambda: source.read(size), "")
+    return _rechunk(source, size)
+
+def _rechunk(chunks, size):
+    buf, n = [], 0
+    for chunk in chunks:
+        buf.append(chunk)
+        n += len(chunk)
+        if n >= size:
+            data = "".join(buf)
+            for i in xrange(0, n-size+1, size):
+                yield data[i:i+size]
+            buf = [data[n-n%size:]]
+            n %= size
+    if n:
+        yield "".join(buf)
+
 def kernelEstablishConn(t, mptcp, s, dst=None, dport=80):
     """Make the kernel establish a TCP connection (MPTCP if available in 
     the kernel) to dst"""
@@ -105,6 +208,159 @@ def kernelEstablishConn(t, mptcp, s, dst=None, dport=80):
     exchange = [mptcp.cap_syn, mptcp.cap_synack, mptcp.ack]
     self.sock.connect((dst, dport))
 
+class PrebuiltIP(IP):
+    """IP packet sent as an already built frame (e.g. stamped out from a
+    SegmentTemplate). Its fields are only used for routing. The frame is
+    also the layer built in an enclosing packet (as Ether()/pkt, built by
+    the L3 sockets)"""
+    def __init__(self, frame="", *args, **kargs):
+        IP.__init__(self, *args, **kargs)
+        self.frame = frame
+    def do_build(self):
+        return self.frame
+    def build(self):
+        return self.frame
+    def copy(self):
+        clone = IP.copy(self)
+        clone.frame = self.frame
+        return clone
+    def __iter__(self):
+        yield self
+
+class SubflowFlight(object):
+    """Sending side of a subflow in bulk transfers (see MPTCPTest.send_bulk):
+    the data in flight, the smoothed RTT (RFC 6298) measured from the ACKs
+    and a Reno-like congestion window (starting at 10 segments, without
+    losses as nothing is retransmitted)"""
+    def __init__(self, m, s, sub, mss):
+        self.sub = sub
+        self.flow = (sub["src"], sub["dst"], sub["sport"], sub["dport"])
+        self.metrics = m.tester.metrics
+        self.dsstmpl = m.getTemplate(s, sub, "DSS")
+        self.pushtmpl = m.getTemplate(s, sub, "Push")
+        self.peer = (sub["dst"], sub["src"], sub["dport"], sub["sport"])
+        self.mss = mss
+        self.cwnd = 10*mss
+        self.ssthresh = None
+        self.srtt = None
+        self.rttvar = None
+
+    def start(self, window):
+        """Start a new transfer, with at most window bytes in flight"""
+        self.window = window
+        self.base = self.seq = self.sub["seq"]
+        self.sent = self.acked = 0
+        self.flight = deque() # (end offset, send time) of the segments
+
+    def room(self):
+        """Bytes that can be sent before waiting for an ACK"""
+        return min(self.window, self.cwnd)-(self.sent-self.acked)
+
+    def mapping(self, s, block):
+        """Return the DSS fields mapping block, sent next on the subflow"""
+        subseq = (self.seq-self.sub["startseq"]) % (1<<32)
+        return {"data_ack": get32bitSeq(s["data_ack"]),
+                "dsn": get32bitSeq(s["dsn"]), "subflow_seqnum": subseq,
+                "datalevel_len": len(block),
+                "checksum": genDSSChecksum(s["dsn"], subseq, len(block), block)}
+
+    def stamp(self, payload, dssmap=None):
+        """Return the frame of the next segment, carrying payload and the
+        mapping dssmap if any"""
+        if dssmap is None:
+            frame = self.pushtmpl.stamp(payload, seq=self.seq,
+                    ack=self.sub["ack"], flags=0x18)
+        else:
+            frame = self.dsstmpl.stamp(payload, seq=self.seq,
+                    ack=self.sub["ack"], flags=0x18, **dssmap)
+        self.seq = (self.seq+len(payload)) % (1<<32)
+        self.sent += len(payload)
+        self.flight.append((self.sent, time.time()))
+        return frame
+
+    def onAck(self, ack, now):
+        """Update the estimates after an ACK of ack received at now"""
+        n = (ack-self.base) % (1<<32)
+        if not self.acked < n <= self.sent:
+            return
+        acked, self.acked = n-self.acked, n
+        sendtime = None
+        while self.flight and self.flight[0][0] <= n:
+            sendtime = self.flight.popleft()[1]
+        if sendtime is not None:
+            self.rttSample(now-sendtime)
+        if self.ssthresh is None or self.cwnd < self.ssthresh:
+            self.cwnd += acked # slow start
+        else:
+            self.cwnd += max(1, self.mss*acked/self.cwnd)
+
+    def rttSample(self, rtt):
+        if self.metrics is not None:
+            self.metrics.rttSample(self.flow, rtt)
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt/2
+        else:
+            self.rttvar = 0.75*self.rttvar+0.25*abs(self.srtt-rtt)
+            self.srtt = 0.875*self.srtt+0.125*rtt
+
+
+class Scheduler(object):
+    """Choice of the subflows on which MPTCPTest.send_bulk sends the next
+    block of data. By default, each subflow in turn, skipping those whose
+    window is full (round robin). The other policies override pick"""
+    def __init__(self):
+        self.next = 0
+
+    def pick(self, flights, length):
+        """Return the list of the SubflowFlight to send the next block on,
+        whose first segment is length bytes long. An empty list means that
+        ACKs must be waited for"""
+        for i in xrange(len(flights)):
+            f = flights[(self.next+i) % len(flights)]
+            if f.room() >= length:
+                self.next = (self.next+i+1) % len(flights)
+                return [f]
+        return []
+
+class LowestRTTScheduler(Scheduler):
+    """The subflow with room in its window having the lowest smoothed RTT,
+    the subflows without RTT measurement yet being tried first (as the
+    default scheduler of Linux MPTCP)"""
+    def pick(self, flights, length):
+        ready = [f for f in flights if f.room() >= length]
+        if not ready:
+            return []
+        return [min(ready, key=lambda f: f.srtt or 0)]
+
+class RoundRobinScheduler(Scheduler):
+    """Each subflow in turn, skipping those whose window is full (the
+    default policy of Scheduler)"""
+
+class WeightedScheduler(Scheduler):
+    """Smooth weighted round robin: the subflows with room in their window
+    get blocks in proportion to weights (in the order of MPTCPState.sub)"""
+    def __init__(self, weights):
+        self.weights = weights
+        self.current = [0]*len(weights)
+
+    def pick(self, flights, length):
+        ready = [i for i, f in enumerate(flights) if f.room() >= length]
+        if not ready:
+            return []
+        for i in ready:
+            self.current[i] += self.weights[i]
+        best = max(ready, key=lambda i: self.current[i])
+        self.current[best] -= sum(self.weights[i] for i in ready)
+        return [flights[best]]
+
+class RedundantScheduler(Scheduler):
+    """Every block on all the subflows, as soon as they all have room in
+    their window. The receiver keeps the first copy"""
+    def pick(self, flights, length):
+        if [f for f in flights if f.room() < length]:
+            return []
+        return list(flights)
+
 #############################################################################
 
 class MPTCPTest(object):
@@ -127,6 +383,8 @@ class MPTCPTest(object):
         self.DefaultPacket = self.TCPPacket
         self.Ack = self.TCPPacket
         self.Push = self.TCPPacket
+        self.templates = {} # (subflow id, kind) -> SegmentTemplate
+        self.flights = {} # subflow id -> SubflowFlight
 
     def findProtoLayer(self, pkt):
         """Return an iterator on representations of proto components to
@@ -140,8 +398,18 @@ class MPTCPTest(object):
             yield pkt.getlayer("TCP")
         
 
+    def dataAckOf(self, pkt):
+        """Return the data_ack of the DSS option of pkt, or None"""
+        l4 = pkt.getlayer(TCP)
+        if l4 is None:
+            return None
+        for opt in getMpOption(l4):
+            if isinstance(opt, MPTCP_DSS) and flagIn(opt.flags, "A"):
+                return opt.data_ack
+        return None
+
     def getClassFromPkt(self, p, pkt):
-        if isinstance(p, MPTCP_DSS_Map64_AckMapCsum):
+        if isinstance(p, MPTCP_DSS):
             return MPTCPTest.DSS
         if isinstance(p, TCP):
             return MPTCPTest.TCPPacket
@@ -385,7 +653,7 @@ class MPTCPTest(object):
 
     
 
-    class DSSACK(ProtoLibPacket, MPTCP_DSS_Ack, MPTCP_DSS_Ack64):
+    class DSSACK(ProtoLibPacket, MPTCP_DSS):
         def generate(self, s, payload="", sub=None, a=False, f=False,
                 waitAck=False):
             """Data Sequence Signal segment. Data are pushed in this type of
@@ -425,10 +693,12 @@ class MPTCPTest(object):
 
         def recv(self, s, pkt):
             (l4, opt) = checkAndGetMPOption(pkt, "DSS") 
+            if flagIn(opt.flags, "M"):
+                return MPTCPTest.DSSMAP().recv(s, pkt)
             return MPTCPTest.TCPPacket().recv(s, pkt)
 
 
-    class DSSMAP(ProtoLibPacket, MPTCP_DSS_MapCsum, MPTCP_DSS_Map64Csum): 
+    class DSSMAP(ProtoLibPacket, MPTCP_DSS): 
         def generate(self, s, payload, length, checksum, sub, m=False,
                 f=False, waitAck=False):
             """Data Sequence Signal segment. Data are pushed in this type of
@@ -464,22 +734,27 @@ class MPTCPTest(object):
 
         def recv(self, s, pkt):
             (l4, opt) = checkAndGetMPOption(pkt, "DSS") 
+            if not flagIn(opt.flags, "M"):
+                return MPTCPTest.TCPPacket().recv(s, pkt)
             sub = s.getSubflowFromPkt(pkt)
             plen = len(l4.payload)
             # TCP-level FIN accounting
             if "F" in l4.sprintf("%TCP.flags%"):
-                plen += 1
-            sub["ack"] = l4.seq+plen
+                sub["ack"] = l4.seq+plen+1
+            else:
+                sub["ack"] = l4.seq+plen
             # Data-level FIN accounting (what about combination FIN+DataFIN?)
-            if flagIn(opt.flags, "F"):
-                plen += 1
-            if not plen>0: return
-            sub["map"] = {
-                    "dsn":long(long(s["data_ack"]&0xFFFFFFFF00000000)|get32bitSeq(opt.dsn)), 
-                    "subseq":opt.subflow_seqnum,
-                    "datalen": opt.datalevel_len}
-            s["data_ack"] = getDataAckForPkt(s, sub, l4, plen,f=True if
-                    flagIn(opt.flags, "F") else False)
+            f = flagIn(opt.flags, "F")
+            if not plen and not f: return
+            if flagIn(opt.flags, "m"):
+                dsn = opt.dsn
+            else:
+                dsn = long(long(s["data_ack"]&0xFFFFFFFF00000000)|get32bitSeq(opt.dsn))
+            length = opt.datalevel_len-1 if f else opt.datalevel_len
+            if opt.subflow_seqnum and length > 0:
+                sub["map"].add(opt.subflow_seqnum, dsn, length)
+            s["data_ack"] = getDataAckForPkt(s, sub, l4, plen,
+                    fin=dsn+opt.datalevel_len-1 if f else None)
             return MPTCPTest.DSSACK
 
     class DSSFIN(ProtoLibPacket):
@@ -498,8 +773,7 @@ class MPTCPTest(object):
     DSSFINACK = DSSFIN
 
     
-    class DSS(ProtoLibPacket, MPTCP_DSS, #MPTCP_DSS_AckMapCsum,
-            MPTCP_DSS_Map64_AckMapCsum, MPTCP_DSS_Ack64MapCsum): #MPTCP_DSS_AckMap64Csum):
+    class DSS(ProtoLibPacket, MPTCP_DSS):
         def generate(self, s, payload, length, checksum, sub, subseq=-1,a=False,
                 m=False, f=False, waitAck=False):
             """Data Sequence Signal segment. Data are pushed in this type of
@@ -550,9 +824,49 @@ class MPTCPTest(object):
             # same as MAP since there is no handling of DATA_ACK received
             return MPTCPTest.DSSMAP().recv(s, pkt)
     
-    def send_data_sub(self, s, data, sub=None, imap=[0], waitAck=False):
+    def getTemplate(self, s, sub, kind):
+        """Return the SegmentTemplate of subflow sub for the data segments of
+        kind "DSS" (carrying a mapping) or "Push" """
+        key = (sub.getId(), kind)
+        tmpl = self.templates.get(key)
+        if tmpl is None:
+            # generating an empty segment doesn't alter the state
+            if kind == "DSS":
+                (pkt, wait) = self.DSS().generate(s, payload="", length=0,
+                        checksum=0, sub=sub)
+            else:
+                (pkt, wait) = self.Push().generate(s, payload="", sub=sub)
+            tmpl = self.templates[key] = SegmentTemplate(pkt)
+        return tmpl
+
+    class Stamp(ProtoLibPacket):
+        def generate(self, s, payload, tmpl, sub, dssmap=None, waitAck=False):
+            """Data segment stamped out from the template tmpl (see
+            MPTCPTest.getTemplate). dssmap is the (length, checksum) of the
+            mapping, for the segments carrying it"""
+            fields = {"seq": sub["seq"], "ack": sub["ack"], "flags": 0x18}
+            if dssmap is not None:
+                length, checksum = dssmap
+                fields.update(data_ack=get32bitSeq(s["data_ack"]),
+                        dsn=get32bitSeq(s["dsn"]),
+                        subflow_seqnum=sub["seq"]-sub["startseq"],
+                        datalevel_len=length, checksum=checksum)
+                s["stage"] = "DSS MAP+ACK"
+            else:
+                s["stage"] = "TCP"
+            frame = tmpl.stamp(payload, **fields)
+            sub["seq"] += len(payload)
+            s["dsn"] += len(payload)
+            if waitAck:
+                # the reply is matched against the dissected packet
+                return (IP(frame), waitAck)
+            return (PrebuiltIP(frame, src=sub["src"], dst=sub["dst"]), False)
+
+    def send_data_sub(self, s, data, sub=None, imap=[0], waitAck=False,
+            fast=False):
         """Send data using subflow sub. Split in several TCP segments if datalength is
-        greater than mss"""
+        greater than mss. If fast is True, the segments are stamped out from
+        prebuilt templates instead of being built one by one"""
         if sub is None: sub = s.getDefaultSubflow()
         length = len(data)
         checksum = genDSSChecksum(s["dsn"], sub["seq"]-sub["startseq"], 
@@ -562,7 +876,13 @@ class MPTCPTest(object):
         while data:
             payload, data = data[0:sub["mss"]], data[sub["mss"]:]
             # The map is sent along only for the (i+1)th segments from imap
-            if i in imap: mem.append(self.tester.sendpkt(self.DSS, s, payload=payload,
+            if fast:
+                kind = "DSS" if i in imap else "Push"
+                mem.append(self.tester.sendpkt(self.Stamp, s, payload=payload,
+                    tmpl=self.getTemplate(s, sub, kind), sub=sub,
+                    dssmap=(length, checksum) if i in imap else None,
+                    waitAck=waitAck))
+            elif i in imap: mem.append(self.tester.sendpkt(self.DSS, s, payload=payload,
                     length=length, checksum=checksum, sub=sub, waitAck=waitAck))
             else: mem.append(self.tester.sendpkt(self.Push, s,
                 payload=payload, sub=sub, waitAck=waitAck))
@@ -583,6 +903,105 @@ class MPTCPTest(object):
         return mem
 
     
+    def send_bulk(self, s, source, sub=None, mss=1400, window=1<<16,
+            mapsize=None, timeout=5, scheduler=None):
+        """Send the data of source as fast as possible, and return the number
+        of bytes sent.
+
+        source is a string, a file-like object or an iterator of strings. The
+        data is mapped by blocks of mapsize bytes (at most 65535), whose DSS
+        mapping and checksum are computed once. The segments of mss bytes
+        are stamped out from templates (see getTemplate) and sent in batches
+        by the tester. The ACKs are read from the packets captured by the
+        tester, without going through the state machinery, and update the
+        RTT and congestion window estimates of the subflows (see
+        SubflowFlight). At most min(window, cwnd) bytes are not acknowledged
+        on a subflow, the window advertised by the receiver is ignored.
+        PktWaitTimeOutException is raised if nothing is acknowledged for
+        timeout seconds while waiting.
+
+        Without scheduler, everything is sent on subflow sub. Otherwise, the
+        scheduler (see Scheduler) chooses the subflows of s of each block,
+        a segment by default."""
+        if scheduler is None:
+            if sub is None: sub = s.getDefaultSubflow()
+            subs = [sub]
+            scheduler = RoundRobinScheduler()
+            if mapsize is None:
+                mapsize = 65535 - 65535 % mss
+        else:
+            subs = s.sub
+            if mapsize is None:
+                mapsize = mss
+        t = self.tester
+        flights = [self.getFlight(s, sb, mss, window) for sb in subs]
+        peers = dict((f.peer, f) for f in flights)
+        keep = t.keepFilter()
+        def isAck(pkt):
+            l4 = pkt.getlayer(TCP)
+            if l4 is None or not l4.flags & 0x10:
+                return False
+            l3 = l4.underlayer
+            return (l3.src, l3.dst, l4.sport, l4.dport) in peers
+        def readAcks(wait):
+            """Handle the ACKs received, waiting for one if wait"""
+            pkt = t.recvLink(isAck, timeout if wait else 0, keep)
+            if pkt is None and wait:
+                raise PktWaitTimeOutException(timeout)
+            while pkt is not None:
+                l4 = pkt[TCP]
+                l3 = l4.underlayer
+                peers[(l3.src, l3.dst, l4.sport, l4.dport)].onAck(l4.ack,
+                        pkt.time)
+                if t.metrics is not None:
+                    t.metrics.received(pkt, self.dataAckOf(pkt))
+                pkt = t.recvLink(isAck, 0, keep)
+        batch = dict((f, []) for f in flights)
+        def flush():
+            for f in flights:
+                if batch[f]:
+                    if t.metrics is not None:
+                        t.metrics.segmentsSent(f.flow, len(batch[f]),
+                                (f.seq-f.sub["seq"]) % (1<<32))
+                    t.sendFrames(batch[f], f.sub["dst"])
+                    batch[f] = []
+                    f.sub["seq"] = f.seq
+        sent = 0
+        for block in iterBlocks(source, mapsize):
+            first = min(mss, len(block))
+            picks = scheduler.pick(flights, first)
+            while not picks:
+                flush()
+                readAcks(True)
+                picks = scheduler.pick(flights, first)
+            maps = dict((f, f.mapping(s, block)) for f in picks)
+            for off in xrange(0, len(block), mss):
+                payload = block[off:off+mss]
+                for f in picks:
+                    while f.room() < len(payload):
+                        flush()
+                        readAcks(True)
+                    batch[f].append(f.stamp(payload, maps.pop(f, None)))
+            s["dsn"] += len(block)
+            sent += len(block)
+            flush()
+            readAcks(False)
+        while [f for f in flights if f.acked < f.sent]:
+            readAcks(True)
+        s["stage"] = "DSS MAP+ACK"
+        return sent
+
+    def getFlight(self, s, sub, mss, window):
+        """Return the SubflowFlight of subflow sub, ready for a new bulk
+        transfer. The RTT and congestion estimates are kept from the
+        previous ones"""
+        key = sub.getId()
+        f = self.flights.get(key)
+        if f is None:
+            f = self.flights[key] = SubflowFlight(self, s, sub, mss)
+        f.start(window)
+        return f
+
     class TCPPacket(ProtoLibPacket, TCP):
         def generate(self, s, payload="", sub=None, f=False, waitAck=False):
             """Generate a regular TCP segment"""
@@ -620,9 +1039,10 @@ class MPTCPTest(object):
             sub = s.getSubflowFromPkt(pkt)
             plen = len(l4.payload)
             if "F" in l4.sprintf("%TCP.flags%"):
-                plen += 1
-            sub["ack"] = l4.seq+plen
-            if not plen>0: return
+                sub["ack"] = l4.seq+plen+1
+            else:
+                sub["ack"] = l4.seq+plen
+            if sub["ack"] == l4.seq: return
             s["data_ack"] = getDataAckForPkt(s, sub, l4, plen)
             return MPTCPTest.DSSACK
 
@@ -653,9 +1073,13 @@ class MPTCPTest(object):
                 return (None, (lambda pkt: s.isPacketFromSubflow(pkt) and
                         waitfct(pkt), timeout, buffermode))
             if sub is None:
-                # accept packets from existing connection or new (SYN)
-                return (None, (lambda pkt: pkt.haslayer(TCP) and 
-                        (pkt.sprintf("%TCP.flags%") == "S" or
+                # accept packets from existing connection or new (SYN), sent
+                # to the addresses of the slot of the scenario if any (the
+                # SYNs of the other slots are seen as well)
+                addrs = slotAddresses()
+                return (None, (lambda pkt: pkt.haslayer(TCP) and
+                        (pkt.sprintf("%TCP.flags%") == "S" and
+                            (addrs is None or pkt[IP].dst in addrs) or
                         s.isPacketFromConnection(pkt)), timeout, buffermode))
             else:
                 return (None, lambda pkt: sub.isPacketFromSubflow(pkt))
@@ -706,9 +1130,24 @@ class SubflowState(ProtoState):
         self.d["startseq"] = 0
         self.d["ack"] = 0
         self.d["mss"] = 25 # adjust to make more or less packets
-        self.d["map"] = {}
+        self.d["map"] = DSSMapTable()
         
 
+    def update(self, extrastate):
+        ProtoState.update(self, extrastate)
+        if not isinstance(self.d["map"], DSSMapTable):
+            # received from the network as a list of mappings
+            self.d["map"] = DSSMapTable(self.d["map"])
+        return self
+
+    def snapshot(self, mpconn=None):
+        snap = ProtoState.snapshot(self)
+        # the mapping table is modified in place
+        snap.d["map"] = self.d["map"].copy()
+        if mpconn is not None:
+            snap.mpconn = mpconn
+        return snap
+
     def getId(self):
         return (self.d["dst"], self.d["src"], self.d["dport"],
                 self.d["sport"])
@@ -738,7 +1177,14 @@ class SubflowState(ProtoState):
                 })
 
     def __setitem__(self, attr, val):
-        ProtoState.__setitem__(self, attr, val)
+        if attr in ("dst", "src", "dport", "sport") and \
+                self.mpconn.index.get(self.getId()) is self:
+            # registered: its index entries follow its 4-tuple
+            oldid = self.getId()
+            ProtoState.__setitem__(self, attr, val)
+            self.mpconn.reindexSubflow(self, oldid)
+        else:
+            ProtoState.__setitem__(self, attr, val)
         if self.d["dst"] == self.d["src"]:
             raise Exception("HEY")
 
@@ -751,10 +1197,13 @@ class SubflowState(ProtoState):
 
 class MPTCPState(ProtoState):
     def __init__(self, initstate={}, conf=None):
-        if conf: ProtoState.__init__(self, initstate=initstate, conf=conf)
-        else: ProtoState.__init__(self, initstate=initstate)
+        # set first, for the subflows of initstate (see update)
         self.sub = []
+        # 4-tuple (dst, src, dport, sport), in both directions -> subflow
+        self.index = {}
         self.default = 0
+        if conf: ProtoState.__init__(self, initstate=initstate, conf=conf)
+        else: ProtoState.__init__(self, initstate=initstate)
         self.name = "MPTCP Connection"
     
     def initAttr(self):
@@ -771,20 +1220,34 @@ class MPTCPState(ProtoState):
         self.d["data_ack"] = 0
 
     def createSubflow(self, dst, src, dport=80, sport=0):
-        if sport == 0: sport = random.randrange(1025,2<<15)
+        if sport == 0: sport = getRandom().randrange(1025,2<<15)
         return SubflowState(mpconn=self, 
                 initstate={"dst":dst, "src":src, "dport":dport,"sport":sport})
 
     def registerSubflow(self, ss):
-        for sub in self.sub:
-            if ss.getId() == sub.getId():
-                self.debug("subflow %s already exists" % ss.getId())
-                return sub
-        else:
-            self.sub.append(ss)
-            ss.name = "Subflow #%i" % ss.getIndex()
+        sub = self.index.get(ss.getId())
+        if sub is not None:
+            self.debug("subflow %s already exists" % (ss.getId(),))
+            return sub
+        self.sub.append(ss)
+        self._indexSubflow(ss, ss.getId())
+        ss.name = "Subflow #%i" % ss.getIndex()
         return ss
 
+    def _indexSubflow(self, ss, tupleid):
+        (dst, src, dport, sport) = tupleid
+        self.index[tupleid] = ss
+        self.index[(src, dst, sport, dport)] = ss
+
+    def reindexSubflow(self, ss, oldid):
+        """Update the index after a change of the 4-tuple of ss, formerly
+        oldid"""
+        (dst, src, dport, sport) = oldid
+        for t in (oldid, (src, dst, sport, dport)):
+            if self.index.get(t) is ss:
+                del(self.index[t])
+        self._indexSubflow(ss, ss.getId())
+
     def registerNewSubflow(self, **kargs):
         return self.registerSubflow(self.createSubflow(**kargs))
 
@@ -806,19 +1269,33 @@ class MPTCPState(ProtoState):
         return self.registerNewSubflow(dst=pkt.src, src=pkt.dst, dport=pkt.sport,
                 sport=pkt.dport)
 
+    def getTupleIds(self):
+        return self.index.keys()
+
+    def lookupSubflow(self, pkt):
+        """return the subflow of the packet, or None"""
+        l4 = pkt.getlayer(TCP)
+        if l4 is None:
+            return None
+        l3 = l4.underlayer
+        return self.index.get((l3.dst, l3.src, l4.dport, l4.sport))
+
     def getSubflowFromPkt(self, pkt):
         """return the subflow on which the packet has been received"""
-        if self.sub:
-            for sub in self.sub:
-                if sub.isPacketFromSubflow(pkt):
-                    return sub
+        sub = self.lookupSubflow(pkt)
+        if sub is not None:
+            return sub
         return self.newSubflowFromRcvdPkt(pkt)
     
     def isPacketFromConnection(self, pkt):
-        for sub in self.sub:
-            if sub.isPacketFromSubflow(pkt):
-                return True
-        return False
+        return self.lookupSubflow(pkt) is not None
+
+    def snapshot(self):
+        snap = ProtoState.snapshot(self)
+        subs = dict((id(sub), sub.snapshot(snap)) for sub in self.sub)
+        snap.sub = [subs[id(sub)] for sub in self.sub]
+        snap.index = dict((t, subs[id(sub)]) for t, sub in self.index.iteritems())
+        return snap
 
     def invertState(self):
         """Generate a new state inverted from the current. Might be useful to
@@ -828,13 +1305,43 @@ class MPTCPState(ProtoState):
                 "dst": self["src"], "src":self["dst"], "dport":self["dport"],
                 })
     
+    def netDict(self):
+        """The subflow states are sent as the dictionary "subflows", indexed
+        by their position"""
+        d = ProtoState.netDict(self)
+        d["subflows"] = dict((i, sub.netDict())
+                for i, sub in enumerate(self.sub))
+        return d
+
     def update(self, extrastate):
         """Update the current state with the extrastate. Extrastate must be a
-        ProtoState derivative"""
+        ProtoState derivative, or a dictionary, as received from the network,
+        whose subflow states are in "subflows" (see netDict)"""
+        subflows = None
+        if type(extrastate) is dict and "subflows" in extrastate:
+            extrastate = dict(extrastate)
+            subflows = extrastate.pop("subflows")
         ProtoState.update(self, extrastate)
         if type(extrastate) is type(self):
             self.sub = extrastate.sub
+            self.index = extrastate.index
+        elif subflows is not None:
+            self.updateSubflows(subflows)
         return self
+
+    def updateSubflows(self, subflows):
+        """Update the subflow states with the dictionaries subflows, indexed
+        by position. The missing subflows are created"""
+        for i in sorted(subflows):
+            sub = self.getSubflow(i)
+            if sub is None:
+                self.registerSubflow(SubflowState(mpconn=self,
+                    initstate=subflows[i]))
+            else:
+                oldid = sub.getId()
+                sub.update(subflows[i])
+                if sub.getId() != oldid:
+                    self.reindexSubflow(sub, oldid)
     
     def logPacket(self, pkt):
         self.d["prev_pkt"] = pkt
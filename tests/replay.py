@@ -0,0 +1,165 @@
+#!/usr/bin/env python2
+# Recording of the packets of a test, and offline replay of the recording in
+# place of the network, to rerun the scenarios as fast regression tests.
+from scapy.all import IP, TCP, UDP, PcapReader
+from scapy.layers.l2 import CookedLinux
+from scapy.utils import RawPcapWriter
+from threading import Lock
+from collections import deque
+import struct
+import time
+
+# packet types of the Linux cooked captures (as "tcpdump -i any")
+INCOMING = 0
+OUTGOING = 4
+
+class PacketRecorder(object):
+    """pcap file where a ProtoTester writes the IP packets it sends and
+    receives (conf "record"). It is a Linux cooked capture, which tells the
+    direction of each packet"""
+    def __init__(self, path):
+        self.writer = RawPcapWriter(path, linktype=113)
+        self.lock = Lock()
+
+    def write(self, frame, outgoing, t=None):
+        """Write frame, an IP packet as a string, sent (if outgoing) or
+        received at t"""
+        t = t or time.time()
+        sec = int(t)
+        proto = 0x86dd if ord(frame[0]) >> 4 == 6 else 0x800
+        hdr = struct.pack("!HHH8sH", OUTGOING if outgoing else INCOMING,
+                0xFFFE, 0, "", proto) # no link-layer address
+        with self.lock:
+            self.writer.write_frame(hdr+frame, sec,
+                    int(round((t-sec)*1000000)))
+            self.writer.flush()
+
+    def close(self):
+        with self.lock:
+            self.writer.close()
+
+
+def flowOf(pkt):
+    """Return the 4-tuple (src, dst, sport, dport) of pkt"""
+    l4 = pkt.getlayer(TCP) or pkt.getlayer(UDP)
+    if l4 is None:
+        return (pkt.src, pkt.dst, None, None)
+    return (pkt.src, pkt.dst, l4.sport, l4.dport)
+
+
+class ReplayCapture(object):
+    """Packets of a recorded capture, replayed to a ProtoTester in place of
+    the network (conf "replay"), with the interface of CaptureThread.
+
+    The packets are indexed by direction and 4-tuple. Each packet sent by
+    the tester is compared with the next one sent on its flow in the
+    recording, the differences being kept in mismatches. The packets
+    received are queued apart, and given to the tester when it waits for
+    them (see get), without any delay. The direction is that of the Linux
+    cooked captures (see PacketRecorder, or "tcpdump -i any"). In other
+    captures, the packets of the flows the tester sends on are taken as its
+    own.
+
+    For the tester to send the same packets as in the recording, its random
+    values must be drawn the same way: both runs must use the same "seed",
+    and the random values must only be drawn by the thread of the tester"""
+    def __init__(self, path):
+        self.pkts = []
+        self.outgoing = [] # direction of each packet, None if unknown
+        self.flows = {} # (outgoing, 4-tuple) -> deque of packet indexes
+        for p in PcapReader(path):
+            ip = p.getlayer(IP)
+            if ip is None:
+                continue
+            ip.time = p.time
+            out = p.pkttype == OUTGOING if isinstance(p, CookedLinux) \
+                    else None
+            self.flows.setdefault((bool(out), flowOf(ip)),
+                    deque()).append(len(self.pkts))
+            self.pkts.append(ip)
+            self.outgoing.append(out)
+        self.consumed = [False]*len(self.pkts)
+        # indexes of the packets received, or of unknown direction
+        self.received = [i for i, out in enumerate(self.outgoing)
+                if not out]
+        self.rhead = 0 # first of them not consumed
+        self.outflows = set() # flows the tester sent packets on
+        self.mismatches = [] # (packet sent, packet recorded or None)
+
+    def consume(self, i):
+        self.consumed[i] = True
+        received = self.received
+        while self.rhead < len(received) and \
+                self.consumed[received[self.rhead]]:
+            self.rhead += 1
+
+    def isOutgoing(self, i, flow):
+        out = self.outgoing[i]
+        if out is None:
+            return flow in self.outflows
+        return out
+
+    def nextOnFlow(self, key):
+        """Consume and return the next packet indexed by key, or None"""
+        q = self.flows.get(key)
+        while q:
+            i = q.popleft()
+            if not self.consumed[i]:
+                self.consume(i)
+                return self.pkts[i]
+        return None
+
+    def sent(self, pkt):
+        """Check pkt, sent by the tester, against the recording"""
+        flow = flowOf(pkt)
+        self.outflows.add(flow)
+        rec = self.nextOnFlow((True, flow)) or self.nextOnFlow((False, flow))
+        if rec is None or str(rec) != str(pkt):
+            self.mismatches.append((pkt, rec))
+
+    def get(self, filterfct=None, timeout=None, keep=None):
+        """Consume and return the next packet received in the recording
+        matching filterfct, or None if there is none (as a timeout). As with
+        CaptureThread.get, the packets received before it are discarded,
+        except those matching keep"""
+        skipped = []
+        for k in xrange(self.rhead, len(self.received)):
+            i = self.received[k]
+            if self.consumed[i]:
+                continue
+            pkt = self.pkts[i]
+            flow = flowOf(pkt)
+            if self.isOutgoing(i, flow):
+                continue
+            if filterfct is None or filterfct(pkt):
+                for j in skipped:
+                    self.consume(j)
+                self.consume(i)
+                if pkt.haslayer(UDP):
+                    self.dropRetransmissions((False, flow),
+                            str(pkt[UDP].payload))
+                return pkt
+            if keep is None or not keep(pkt):
+                skipped.append(i)
+        return None
+
+    def dropRetransmissions(self, key, data):
+        """Consume the next copies of the control message data, sent again
+        until it was acknowledged (see ProtoTester.sendData)"""
+        q = self.flows[key]
+        while q and (self.consumed[q[0]] or
+                str(self.pkts[q[0]][UDP].payload) == data):
+            i = q.popleft()
+            if not self.consumed[i]:
+                self.consume(i)
+
+    def remaining(self):
+        """Return the packets received in the recording not consumed yet"""
+        return [self.pkts[i] for i in self.received[self.rhead:]
+                if not self.consumed[i]
+                and not self.isOutgoing(i, flowOf(self.pkts[i]))]
+
+    def stop(self):
+        pass
+
+# vim: set ts=4 sts=4 sw=4 et:
@@ -0,0 +1,284 @@
+#!/usr/bin/env python2
+# Parallel runner of the test scenarios of join/ and global/, on the client.
+# testserver.py must be launched on the server, and fwudpserver.py on the
+# firewall.
+# Usage: tests/testall.sh [options] [scenario...], or from tests/ with the
+# root of the repository in PYTHONPATH: PYTHONPATH=.. ./runall.py
+import os, sys, re, time, getopt
+import socket, select
+import signal
+import subprocess
+import tempfile
+import multiprocessing
+import Queue
+from collections import deque
+
+CATEGORIES = ["join", "global"]
+SERVER = ("10.2.1.2", 5005) # address of testserver.py
+TIMEOUT = 60 # default timeout of a scenario, in seconds
+SERVER_GRACE = 2 # time to wait for the server results after the last test
+
+def slotEnv(slot):
+    """Return the environment of the scenarios run in slot: their address
+    set (see core.testAddress) and control channel ports. Slot 0 is the
+    usual set. The addresses of the other slots must be configured on the
+    hosts (ex: 10.1.1.3 and 10.1.2.3 on the client, 10.2.1.3 on the server,
+    for slot 1)"""
+    return {"MPTCP_TEST_A1": "10.1.1.%i" % (2+slot),
+            "MPTCP_TEST_A2": "10.1.2.%i" % (2+slot),
+            "MPTCP_TEST_B": "10.2.1.%i" % (2+slot),
+            "MPTCP_TEST_UDP_PORT": str(3456+2*slot),
+            "MPTCP_TEST_UDP_PORT_ACK": str(3457+2*slot)}
+
+def testEnv(slot, testid):
+    """Return the environment of the process of scenario testid"""
+    env = dict(os.environ)
+    env.update(slotEnv(slot))
+    env["MPTCP_TEST_ID"] = testid
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    paths = env.get("PYTHONPATH", "").split(os.pathsep)
+    if root not in paths:
+        env["PYTHONPATH"] = os.pathsep.join([root] + filter(None, paths))
+    return env
+
+def execute(cmd, env, timeout, cwd=None, shell=False):
+    """Run cmd, killing it and its children after timeout seconds. Return
+    (return code, duration, timed out, output)"""
+    out = tempfile.TemporaryFile()
+    start = time.time()
+    p = subprocess.Popen(cmd, cwd=cwd, env=env, shell=shell, stdout=out,
+            stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+    timedout = False
+    while p.poll() is None:
+        if time.time()-start > timeout:
+            os.killpg(p.pid, signal.SIGKILL)
+            p.wait()
+            timedout = True
+            break
+        time.sleep(0.05)
+    duration = time.time()-start
+    out.seek(0)
+    return (p.returncode, duration, timedout, out.read())
+
+def runScenario(job):
+    """Run a scenario in a worker of the pool"""
+    (testid, slot, timeout) = job
+    tests = os.path.dirname(os.path.abspath(__file__))
+    try:
+        return (testid,) + execute([os.path.join(tests, testid)],
+                testEnv(slot, testid), timeout, cwd=tests)
+    except OSError as e:
+        return (testid, -1, 0., False, "Test execution failed: %s\n" % e)
+
+
+class Scenario(object):
+    """Test script, identified by its path relative to the tests directory.
+    Options can be given in a '# runall:' comment of the script:
+    timeout=<seconds>, and exclusive if it can't run with other scenarios
+    (ex: if it changes the firewall rules)"""
+    def __init__(self, testid, timeout=TIMEOUT):
+        self.id = testid
+        self.timeout = timeout
+        self.exclusive = False
+        self.slot = None
+        # (return code, duration, timed out, output) of the client side
+        self.result = None
+        self.server = None # (return code, duration) of the server side
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                testid)) as fd:
+            for line in fd:
+                m = re.match(r"#\s*runall:\s*(.*)", line)
+                if m:
+                    self.parseOptions(m.group(1))
+
+    def parseOptions(self, opts):
+        for opt in opts.split():
+            if opt == "exclusive":
+                self.exclusive = True
+            elif opt.startswith("timeout="):
+                self.timeout = float(opt[len("timeout="):])
+
+    def passed(self):
+        return self.result is not None and self.result[0] == 0 and \
+                not self.result[2]
+
+
+def discover(categories=CATEGORIES, timeout=TIMEOUT):
+    """Return the scenarios of the categories"""
+    tests = os.path.dirname(os.path.abspath(__file__))
+    scenarios = []
+    for c in categories:
+        for name in sorted(os.listdir(os.path.join(tests, c))):
+            path = os.path.join(tests, c, name)
+            if os.path.isfile(path) and os.access(path, os.X_OK):
+                scenarios.append(Scenario("%s/%s" % (c, name), timeout))
+    return scenarios
+
+
+class Runner(object):
+    """Run scenarios in parallel in a pool of jobs processes, each one in its
+    own slot (address set and ports, see slotEnv). Before a scenario is
+    started, testserver.py is asked to start its server side, in the same
+    slot. The results of both sides are matched with the scenarios by ID.
+    The exclusive scenarios are run last, one at a time in slot 0"""
+    def __init__(self, scenarios, jobs, server=SERVER, verbose=False):
+        self.scenarios = dict((sc.id, sc) for sc in scenarios)
+        self.pending = deque(sorted(scenarios, key=lambda sc: sc.exclusive))
+        self.jobs = jobs
+        self.server = server
+        self.verbose = verbose
+        self.slots = range(jobs)
+        self.running = {} # id -> scenario
+        self.done = Queue.Queue()
+        self.sock = None
+        if server is not None:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def startable(self):
+        if not self.pending or not self.slots:
+            return False
+        if self.pending[0].exclusive:
+            return not self.running
+        return not any(sc.exclusive for sc in self.running.itervalues())
+
+    def start(self, pool):
+        sc = self.pending.popleft()
+        sc.slot = 0 if sc.exclusive else self.slots[0]
+        self.slots.remove(sc.slot)
+        self.running[sc.id] = sc
+        if self.sock is not None:
+            self.sock.sendto("EXECTEST %s %i %i" % (sc.id, sc.slot,
+                sc.timeout), self.server)
+        pool.apply_async(runScenario, ((sc.id, sc.slot, sc.timeout),),
+                callback=self.done.put)
+
+    def finished(self, result):
+        sc = self.running.pop(result[0])
+        sc.result = result[1:]
+        self.slots.append(sc.slot)
+        self.slots.sort()
+        (code, duration, timedout, output) = sc.result
+        if timedout:
+            status = "timeout"
+        else:
+            status = "success" if code == 0 else "fail"
+        print("Test %s: %s (%.2fs, slot %i)" % (sc.id, status, duration,
+            sc.slot))
+        if self.verbose or not sc.passed():
+            sys.stdout.write(output)
+        sys.stdout.flush()
+
+    def serverResults(self, timeout):
+        """Read the results sent by testserver.py for timeout seconds"""
+        if self.sock is None:
+            time.sleep(timeout)
+            return
+        end = time.time()+timeout
+        while True:
+            remaining = end-time.time()
+            if remaining <= 0 or not select.select([self.sock], [], [],
+                    remaining)[0]:
+                return
+            data = self.sock.recvfrom(1024)[0].split()
+            if len(data) == 4 and data[0] == "TESTDONE" and \
+                    data[1] in self.scenarios:
+                self.scenarios[data[1]].server = (int(data[2]),
+                        float(data[3]))
+
+    def run(self):
+        """Run all the scenarios, and return them with their results"""
+        pool = multiprocessing.Pool(self.jobs)
+        try:
+            while self.pending or self.running:
+                while self.startable():
+                    self.start(pool)
+                while True:
+                    try:
+                        self.finished(self.done.get_nowait())
+                    except Queue.Empty:
+                        break
+                self.serverResults(0.05)
+        finally:
+            pool.terminate()
+        if self.sock is not None:
+            end = time.time()+SERVER_GRACE
+            while time.time() < end and any(sc.server is None
+                    for sc in self.scenarios.itervalues()):
+                self.serverResults(0.1)
+        return [self.scenarios[k] for k in sorted(self.scenarios)]
+
+
+def report(scenarios, duration):
+    fail = [sc for sc in scenarios if not sc.passed()]
+    print("Finished unit testing")
+    print("%-45s %-8s %9s %9s" % ("Test", "Result", "Client", "Server"))
+    for sc in sorted(scenarios, key=lambda sc: -sc.result[1]):
+        (code, t, timedout, output) = sc.result
+        status = "timeout" if timedout else ("success" if sc.passed()
+                else "fail")
+        server = "%8.2fs" % sc.server[1] if sc.server else "        -"
+        if sc.server and sc.server[0] != 0:
+            server += " (exit %i)" % sc.server[0]
+        print("%-45s %-8s %8.2fs %s" % (sc.id, status, t, server))
+    total = sum(sc.result[1] for sc in scenarios)
+    print("[Results] On %i tests, %i failed and %i succeeded, in %.2fs "
+            "(%.2fs sequentially)" % (len(scenarios), len(fail),
+                len(scenarios)-len(fail), duration, total))
+    return not fail
+
+def usage():
+    print >>sys.stderr, """Usage: runall.py [-j jobs] [-t timeout] [-s host:port | -n] [-v] [scenario...]
+    -j   number of scenarios run in parallel (default: all of them)
+    -t   default timeout of a scenario, in seconds (default: %i)
+    -s   address of testserver.py (default: %s:%i)
+    -n   no server side (testserver.py not notified)
+    -v   print the output of all the scenarios, not only those failing
+    scenarios are given by ID (ex: join/related.py), all by default""" % (
+        TIMEOUT, SERVER[0], SERVER[1])
+
+def main(argv):
+    jobs = None
+    timeout = TIMEOUT
+    server = SERVER
+    verbose = False
+    try:
+        opts, args = getopt.getopt(argv, "hj:t:s:nv")
+        for opt, parm in opts:
+            if opt == "-h":
+                usage()
+                return 0
+            elif opt == "-j":
+                jobs = int(parm)
+            elif opt == "-t":
+                timeout = float(parm)
+            elif opt == "-s":
+                host, port = parm.split(":")
+                server = (host, int(port))
+            elif opt == "-n":
+                server = None
+            elif opt == "-v":
+                verbose = True
+    except (getopt.GetoptError, ValueError) as msg:
+        print >>sys.stderr, "ERROR:", msg
+        usage()
+        return 2
+    scenarios = discover(timeout=timeout)
+    if args:
+        scenarios = [sc for sc in scenarios if sc.id in args]
+        unknown = set(args)-set(sc.id for sc in scenarios)
+        if unknown:
+            print >>sys.stderr, "ERROR: unknown scenarios %s" % \
+                    ", ".join(sorted(unknown))
+            return 2
+    if not scenarios:
+        return 0
+    jobs = jobs or len(scenarios)
+    print("Starting unit testing: %i scenarios, %i in parallel" %
+            (len(scenarios), jobs))
+    start = time.time()
+    scenarios = Runner(scenarios, jobs, server, verbose).run()
+    return 0 if report(scenarios, time.time()-start) else 1
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
+# vim: set ts=4 sts=4 sw=4 et:
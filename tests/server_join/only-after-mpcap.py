@@ -10,10 +10,10 @@ def main():
     m = MPTCPTest(tester=t, initstate=s) # MPTCP packets library
     
     # Client IPs
-    A1 = "10.1.1.2"
-    A2 = "10.1.2.2"
+    A1 = testAddress("A1", "10.1.1.2")
+    A2 = testAddress("A2", "10.1.2.2")
     # Server IP
-    B = "10.2.1.2"
+    B = testAddress("B", "10.2.1.2")
 
     droppedTimeout = 1
     
@@ -9,10 +9,10 @@ def main():
     m = MPTCPTest(tester=t, initstate=s) # MPTCP packets library
     
     # Client IPs
-    A1 = "10.1.1.2"
-    A2 = "10.1.2.2"
+    A1 = testAddress("A1", "10.1.1.2")
+    A2 = testAddress("A2", "10.1.2.2")
     # Server IP
-    B = "10.2.1.2"
+    B = testAddress("B", "10.2.1.2")
     # FW IP
     C = "10.2.1.1"
 
@@ -30,15 +30,15 @@ def main():
         sub2 = s.registerNewSubflow(dst=A2, src=B)
 
         # test 1
-        t.fwCmd("iptables -D FORWARD -d 10.1.0.0/16 -p tcp -m conntrack --ctstate RELATED,ESTABLISHED -j ACCEPT", dst=C)
-        t.fwCmd("iptables -A FORWARD -d 10.1.0.0/16 -p tcp -m conntrack --ctstate ESTABLISHED -j ACCEPT", dst=C)
+        t.fwRules(["iptables -D FORWARD -d 10.1.0.0/16 -p tcp -m conntrack --ctstate RELATED,ESTABLISHED -j ACCEPT",
+            "iptables -A FORWARD -d 10.1.0.0/16 -p tcp -m conntrack --ctstate ESTABLISHED -j ACCEPT"], dst=C)
         t.sendpkt(m.JoinSYN, initstate=s, sub=sub2)
         
         t.syncWait()
 
         # test 2
-        t.fwCmd("iptables -D FORWARD -p tcp -d 10.1.0.0/16 -m conntrack --ctstate ESTABLISHED -j ACCEPT", dst=C)
-        t.fwCmd("iptables -A FORWARD -p tcp -d 10.1.0.0/16 -m conntrack --ctstate RELATED,ESTABLISHED -j ACCEPT", dst=C)
+        t.fwRules(["iptables -D FORWARD -p tcp -d 10.1.0.0/16 -m conntrack --ctstate ESTABLISHED -j ACCEPT",
+            "iptables -A FORWARD -p tcp -d 10.1.0.0/16 -m conntrack --ctstate RELATED,ESTABLISHED -j ACCEPT"], dst=C)
         t.sendpkt(m.JoinSYN, initstate=s, sub=sub2)
         
         join_init = [m.Wait, m.JoinACK, m.Wait]
@@ -0,0 +1,300 @@
+#!/usr/bin/env python2
+# Binary encoding of the states exchanged by the testers (sendState and
+# receiveState), with delta updates.
+from scapy.packet import Packet, Raw
+from scapy.config import conf as scapy_conf
+import struct
+import random
+
+MAGIC = "\xa5PS"
+VERSION = 1
+HEADER = struct.Struct("!3sBBIII") # magic, version, kind, stream, base, gen
+FULL = 0
+DELTA = 1
+
+# extension types: name -> (class, to plain value, from plain value)
+extensions = {}
+
+def registerType(cls, encode, decode, name=None):
+    """Make the instances of cls encodable: encode(obj) must return a value
+    of a basic type, which decode turns back into an instance"""
+    extensions[name or cls.__name__] = (cls, encode, decode)
+
+def varint(n):
+    """Encode the non-negative integer n on 7 bits per byte, the high bit
+    telling whether more bytes follow"""
+    if n < 0x80:
+        return chr(n)
+    out = []
+    while n >= 0x80:
+        out.append(chr(n & 0x7f | 0x80))
+        n >>= 7
+    out.append(chr(n))
+    return "".join(out)
+
+def readVarint(s, i):
+    n = shift = 0
+    while True:
+        b = ord(s[i])
+        i += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, i
+        shift += 7
+
+def lenPrefixed(s):
+    return varint(len(s)) + s
+
+def readPrefixed(s, i):
+    n, i = readVarint(s, i)
+    if i+n > len(s):
+        raise ValueError("truncated field at offset %i" % i)
+    return s[i:i+n], i+n
+
+def encodeInt(v):
+    # zigzag encoding: the small negative values are short as well
+    return "i" + varint(v << 1 if v >= 0 else ((-v) << 1) - 1)
+
+def encodeSeq(v):
+    return ("l" if type(v) is list else "t") + varint(len(v)) + \
+            "".join(encodeValue(x) for x in v)
+
+def encodeDict(v):
+    return "d" + varint(len(v)) + "".join(encodeValue(k) + encodeValue(x)
+            for k, x in v.iteritems())
+
+encoders = {type(None): lambda v: "N",
+            bool: lambda v: "T" if v else "F",
+            int: encodeInt,
+            long: encodeInt,
+            float: lambda v: "f" + struct.pack("!d", v),
+            str: lambda v: "s" + lenPrefixed(v),
+            unicode: lambda v: "u" + lenPrefixed(v.encode("utf-8")),
+            list: encodeSeq,
+            tuple: encodeSeq,
+            dict: encodeDict}
+
+def encodeValue(v):
+    """Return the encoding of v, of a basic type (None, bool, int, long,
+    float, str, unicode, list, tuple, dict), a Packet or a registered type.
+    Each value is a tag followed by its fields, length-prefixed if their
+    length varies"""
+    enc = encoders.get(type(v))
+    if enc is not None:
+        return enc(v)
+    if isinstance(v, Packet):
+        return "p" + lenPrefixed(v.__class__.__name__) + lenPrefixed(str(v))
+    for name, (cls, enc, dec) in extensions.iteritems():
+        if isinstance(v, cls):
+            return "x" + lenPrefixed(name) + encodeValue(enc(v))
+    raise TypeError("cannot encode %r of type %s" % (v, type(v).__name__))
+
+_layers = None
+
+def packetClass(name):
+    global _layers
+    if _layers is None:
+        _layers = dict((c.__name__, c) for c in scapy_conf.layers)
+    return _layers.get(name, Raw)
+
+def decodeValue(s, i=0):
+    """Decode the value encoded at offset i of s, return (value, offset of
+    its end)"""
+    tag = s[i]
+    i += 1
+    if tag == "i":
+        z, i = readVarint(s, i)
+        return (-((z+1) >> 1) if z & 1 else z >> 1), i
+    if tag == "s":
+        return readPrefixed(s, i)
+    if tag == "N":
+        return None, i
+    if tag == "T":
+        return True, i
+    if tag == "F":
+        return False, i
+    if tag == "f":
+        return struct.unpack_from("!d", s, i)[0], i+8
+    if tag == "u":
+        v, i = readPrefixed(s, i)
+        return v.decode("utf-8"), i
+    if tag in "lt":
+        n, i = readVarint(s, i)
+        v = []
+        for _ in xrange(n):
+            x, i = decodeValue(s, i)
+            v.append(x)
+        return (v if tag == "l" else tuple(v)), i
+    if tag == "d":
+        n, i = readVarint(s, i)
+        v = {}
+        for _ in xrange(n):
+            k, i = decodeValue(s, i)
+            v[k], i = decodeValue(s, i)
+        return v, i
+    if tag == "p":
+        name, i = readPrefixed(s, i)
+        raw, i = readPrefixed(s, i)
+        return packetClass(name)(raw), i
+    if tag == "x":
+        name, i = readPrefixed(s, i)
+        v, i = decodeValue(s, i)
+        if name not in extensions:
+            raise ValueError("unknown encoded type %s" % name)
+        return extensions[name][2](v), i
+    raise ValueError("unknown value tag %r at offset %i" % (tag, i-1))
+
+# A state is a dictionary. Its encoded form is a tree: a dictionary of the
+# encoded values, the dictionaries being nested trees, so that the values
+# are compared and sent one by one, at any depth.
+
+# Most values don't change from one version to the next: the encodings and
+# decodings of the immutable ones are cached, in bounded memos.
+IMMUTABLE = (type(None), bool, int, long, float, str, unicode)
+IMMUTABLE_TAGS = "isNTFfu"
+MEMO_SIZE = 4096
+
+def encodeTree(d, memo):
+    tree = {}
+    for k, v in d.iteritems():
+        t = type(v)
+        if t is dict:
+            tree[k] = encodeTree(v, memo)
+        elif t in IMMUTABLE:
+            e = memo.get((t, v))
+            if e is None:
+                if len(memo) >= MEMO_SIZE:
+                    memo.clear()
+                e = memo[(t, v)] = encodeValue(v)
+            tree[k] = e
+        else:
+            tree[k] = encodeValue(v)
+    return tree
+
+def decodeTree(tree, memo):
+    d = {}
+    for k, e in tree.iteritems():
+        if type(e) is dict:
+            d[k] = decodeTree(e, memo)
+        elif e[0] in IMMUTABLE_TAGS:
+            try:
+                d[k] = memo[e]
+            except KeyError:
+                if len(memo) >= MEMO_SIZE:
+                    memo.clear()
+                d[k] = memo[e] = decodeValue(e)[0]
+        else:
+            d[k] = decodeValue(e)[0]
+    return d
+
+def encodeDelta(old, new):
+    """Return the encoding of the changes from the tree old to new: a count
+    followed by the entries (key, operation), the operation being
+    "v" + value, "n" + nested delta or "x" (removed)"""
+    entries = []
+    for k, v in new.iteritems():
+        o = old.get(k)
+        if type(v) is dict:
+            if type(o) is dict:
+                delta = encodeDelta(o, v)
+                if delta != "\0":
+                    entries.append(encodeValue(k) + "n" + delta)
+            else:
+                entries.append(encodeValue(k) + "n" + encodeDelta({}, v))
+        elif v != o:
+            entries.append(encodeValue(k) + "v" + lenPrefixed(v))
+    for k in old:
+        if k not in new:
+            entries.append(encodeValue(k) + "x")
+    return varint(len(entries)) + "".join(entries)
+
+def applyDelta(tree, s, i=0):
+    """Apply the delta encoded at offset i of s to tree, return the offset
+    of its end"""
+    n, i = readVarint(s, i)
+    for _ in xrange(n):
+        k, i = decodeValue(s, i)
+        op = s[i]
+        i += 1
+        if op == "v":
+            tree[k], i = readPrefixed(s, i)
+        elif op == "n":
+            if type(tree.get(k)) is not dict:
+                tree[k] = {}
+            i = applyDelta(tree[k], s, i)
+        elif op == "x":
+            tree.pop(k, None)
+        else:
+            raise ValueError("unknown delta operation %r" % op)
+    return i
+
+
+class StateEncoder(object):
+    """Encoding of the successive versions of a state sent to a peer. Each
+    message has a generation number, and after the first one, only carries
+    the changes from the previous one (delta)"""
+    def __init__(self):
+        self.stream = random.SystemRandom().getrandbits(32)
+        self.gen = 0
+        self.tree = None # last version sent
+        self.memo = {}
+
+    def encode(self, d, delta=True):
+        """Return the message of the state dictionary d. It is a delta if
+        delta is True and a previous version was encoded. The peer must have
+        received the previous version"""
+        tree = encodeTree(d, self.memo)
+        base = self.gen if delta and self.tree is not None else 0
+        self.gen += 1
+        body = encodeDelta(self.tree if base else {}, tree)
+        self.tree = tree
+        return HEADER.pack(MAGIC, VERSION, DELTA if base else FULL,
+                self.stream, base, self.gen) + body
+
+
+class StateDecoder(object):
+    """Decoding of the messages of StateEncoders, keeping the last version
+    received of each stream, which the deltas apply to"""
+    def __init__(self):
+        self.streams = {} # stream -> (generation, tree)
+        self.memo = {}
+
+    def decode(self, data):
+        """Return the state dictionary of the message data. A message
+        received again gives the current state"""
+        if len(data) < HEADER.size:
+            raise ValueError("state message too short")
+        (magic, version, kind, stream, base, gen) = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError("not a state message")
+        if version != VERSION:
+            raise ValueError("unsupported state encoding version %i" % version)
+        (last, tree) = self.streams.get(stream, (None, None))
+        if last is not None and gen <= last:
+            # already received: sent again as its ack was lost (see
+            # ProtoTester.sendData)
+            return decodeTree(tree, self.memo)
+        if kind == FULL:
+            tree = {}
+        else:
+            if last is None:
+                raise ValueError("state delta of an unknown stream")
+            if last != base:
+                raise ValueError("state delta based on generation %i, "
+                        "%i received last" % (base, last))
+            # kept unchanged if the delta is invalid
+            tree = copyTree(tree)
+        end = applyDelta(tree, data, HEADER.size)
+        if end != len(data):
+            raise ValueError("trailing data in state message")
+        self.streams[stream] = (gen, tree)
+        return decodeTree(tree, self.memo)
+
+def copyTree(tree):
+    return dict((k, copyTree(v) if type(v) is dict else v)
+            for k, v in tree.iteritems())
+
+def isStateMessage(data):
+    return data.startswith(MAGIC)
+
+# vim: set ts=4 sts=4 sw=4 et:
@@ -1,7 +1,12 @@
 #!/usr/bin/env python
-import socket
-import sys
+# Server sides of the test scenarios, see runall.py.
+# Usage: tests/testserver.sh, or from tests/ with the root of the repository
+# in PYTHONPATH (for the tests package): PYTHONPATH=.. ./testserver.py
+import socket, select
+import sys, os, time
+import signal
 import subprocess
+from tests.runall import testEnv, TIMEOUT
 
 print("Test server started.")
 
@@ -12,25 +17,48 @@ sock = socket.socket(socket.AF_INET, # Internet
                      socket.SOCK_DGRAM) # UDP
 sock.bind((UDP_IP, UDP_PORT))
 
+# The server sides of the tests run concurrently, each one in the slot (address
+# set and ports) of its client side, see runall.py.
+# Request: EXECTEST <test ID> [<slot> <timeout>]
+# Once the test is over, "TESTDONE <test ID> <return code> <duration>" is sent
+# back to the sender of the request.
+running = {} # Popen -> (test ID, sender address, start time, timeout)
+
+def finished(p, retcode):
+    (testid, addr, start, timeout) = running.pop(p)
+    duration = time.time()-start
+    if retcode < 0:
+        print >>sys.stderr, "Test %s was terminated by signal" % testid, -retcode
+    else:
+        print >>sys.stderr, "Test %s returned" % testid, retcode
+    sock.sendto("TESTDONE %s %i %.3f" % (testid, retcode, duration), addr)
+
 while True:
+    for p in running.keys():
+        retcode = p.poll()
+        if retcode is None and time.time()-running[p][2] > running[p][3]:
+            os.killpg(p.pid, signal.SIGKILL)
+            retcode = p.wait()
+        if retcode is not None:
+            finished(p, retcode)
+    if not select.select([sock], [], [], 0.2)[0]:
+        continue
     data, addr = sock.recvfrom(1024) # buffer size is 1024 bytes
     print("received message: {}".format(data))
     try:
-        (request, testScript) = data.split()
-    except ValueError:
+        req = data.split()
+        request, testScript = req[0], req[1]
+        slot = int(req[2]) if len(req) > 2 else 0
+        timeout = float(req[3]) if len(req) > 3 else TIMEOUT
+    except (ValueError, IndexError):
         continue
     if request != "EXECTEST":
         print("Not a unit test request")
         continue
-    print("Executing unit test: {}".format(testScript))
+    print("Executing unit test: {} (slot {})".format(testScript, slot))
     try:
-        retcode = subprocess.call("server_%s" % testScript, shell=True)
-        if retcode < 0:
-            print >>sys.stderr, "Test was terminated by signal", -retcode
-        else:
-            print >>sys.stderr, "Test returned", retcode
+        p = subprocess.Popen("server_%s" % testScript, shell=True,
+                env=testEnv(slot, testScript), preexec_fn=os.setsid)
+        running[p] = (testScript, addr, time.time(), timeout)
     except OSError as e:
         print >>sys.stderr, "Test execution failed:", e
-
-
-
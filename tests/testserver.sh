@@ -0,0 +1,6 @@
+#!/bin/bash
+# Runs testserver.py, the server sides of the test scenarios, on the server.
+
+tests=$(cd "$(dirname "$0")" && pwd)
+export PYTHONPATH="$(dirname "$tests")${PYTHONPATH:+:$PYTHONPATH}"
+cd "$tests" && exec python2 testserver.py "$@"
@@ -0,0 +1,121 @@
+#!/usr/bin/env python2
+# In-memory network, to run the test scenarios without raw sockets, iptables
+# nor root privileges.
+from scapy.all import IP, IPv6, MTU
+from scapy.supersocket import SuperSocket
+from scapy.pton_ntop import inet_ntop
+from threading import Lock
+from collections import deque
+import socket, select
+import os
+import time
+
+class VirtualSocket(SuperSocket):
+    """L3 socket of a VirtualNetwork, owning one or several IP addresses.
+
+    Like automaton.ObjectPipe, the frames received are queued in memory and
+    a pipe makes the socket selectable. The pipe only holds one byte while
+    the queue is not empty, so that a sender is never blocked by a full
+    pipe. Frames are sent as strings and dissected on reception, as with a
+    real L3 socket"""
+    desc = "in-memory L3 socket of a VirtualNetwork"
+    def __init__(self, net, addrs):
+        self.net = net
+        self.addrs = list(addrs)
+        self.ins = self.outs = None
+        self.promisc = None
+        self.queue = deque()
+        self.lock = Lock()
+        self.rd, self.wr = os.pipe()
+
+    def send(self, x):
+        sx = str(x)
+        x.sent_time = time.time()
+        self.net.deliver(sx)
+        return len(sx)
+
+    def sendFrames(self, frames):
+        """Send already built frames"""
+        for f in frames:
+            self.net.deliver(f)
+
+    def push(self, frame):
+        """Queue frame, received from the network"""
+        with self.lock:
+            self.queue.append(frame)
+            if len(self.queue) == 1:
+                os.write(self.wr, "X")
+
+    def recv(self, x=MTU):
+        """Return the next packet received, blocking until there is one"""
+        while True:
+            with self.lock:
+                if self.queue:
+                    frame = self.queue.popleft()
+                    if not self.queue:
+                        os.read(self.rd, 1)
+                    break
+            select.select([self.rd], [], [])
+        if ord(frame[0]) >> 4 == 6:
+            return IPv6(frame)
+        return IP(frame)
+
+    def fileno(self):
+        return self.rd
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = 1
+        self.net.detach(self)
+        os.close(self.rd)
+        os.close(self.wr)
+
+
+class VirtualNetwork(object):
+    """Route frames between VirtualSockets by destination address. Frames
+    to an address without socket are dropped. Example, to connect two
+    testers running in the same process:
+
+        net = VirtualNetwork()
+        client = ProtoTester({"socket": net.socket("10.1.1.2", "10.1.2.2")})
+        server = ProtoTester({"socket": net.socket("10.2.1.2")})
+    """
+    def __init__(self):
+        self.hosts = {} # address -> VirtualSocket
+        self.dropped = 0
+
+    def socket(self, *addrs):
+        """Return a new VirtualSocket receiving the frames sent to addrs"""
+        for a in addrs:
+            if a in self.hosts:
+                raise Exception("address %s already used on the network" % a)
+        s = VirtualSocket(self, addrs)
+        for a in addrs:
+            self.hosts[a] = s
+        return s
+
+    def detach(self, sock):
+        for a in sock.addrs:
+            if self.hosts.get(a) is sock:
+                del(self.hosts[a])
+
+    def deliver(self, frame):
+        if ord(frame[0]) >> 4 == 6:
+            dst = inet_ntop(socket.AF_INET6, frame[24:40])
+        else:
+            dst = socket.inet_ntoa(frame[16:20])
+        s = self.hosts.get(dst)
+        if s is None:
+            self.dropped += 1
+            return
+        s.push(frame)
+
+
+def virtualLink(addrs1, addrs2):
+    """Return a pair of connected VirtualSockets, owning the addresses of
+    the lists addrs1 and addrs2"""
+    net = VirtualNetwork()
+    return net.socket(*addrs1), net.socket(*addrs2)
+
+# vim: set ts=4 sts=4 sw=4 et: